@@ -1,10 +1,11 @@
 document.addEventListener('DOMContentLoaded', () => {
     const API_BASE_URL = 'http://localhost:8000';
+    const PAGE_SIZE = 50;
 
     async function fetchDataAndRenderTable(endpoint, tableId) {
         try {
             const response = await fetch(`${API_BASE_URL}/${endpoint}`);
-            const data = await response.json();
+            const data = await parseResponse(response);
             renderTable(data, tableId);
         } catch (error) {
             console.error(`Error fetching ${endpoint}:`, error);
@@ -12,19 +13,84 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    function renderTable(data, tableId) {
+    // Cursor-paginated endpoints: load one page now and the next one whenever
+    // the bottom of the table scrolls into view.
+    function setupInfiniteTable(endpoint, tableId) {
         const tableContainer = document.getElementById(tableId);
-        if (!data || data.length === 0) {
-            tableContainer.innerHTML = '<p>No data available.</p>';
-            return;
+        tableContainer.classList.add('paged');
+        const state = { cursor: null, done: false, loading: false, headers: null, tbody: null };
+        const sentinel = document.createElement('div');
+        sentinel.className = 'sentinel';
+
+        async function loadNextPage() {
+            if (state.loading || state.done) {
+                return;
+            }
+            state.loading = true;
+            try {
+                const params = new URLSearchParams({ limit: PAGE_SIZE });
+                if (state.cursor) {
+                    params.set('cursor', state.cursor);
+                }
+                const response = await fetch(`${API_BASE_URL}/${endpoint}?${params}`);
+                const page = await response.json();
+                const items = page.items || [];
+                state.cursor = page.next_cursor;
+                state.done = !page.next_cursor;
+
+                if (!state.tbody) {
+                    if (items.length === 0) {
+                        tableContainer.innerHTML = '<p>No data available.</p>';
+                        return;
+                    }
+                    state.headers = Object.keys(items[0]);
+                    const table = createTable(state.headers);
+                    state.tbody = table.querySelector('tbody');
+                    tableContainer.innerHTML = '';
+                    tableContainer.appendChild(table);
+                    tableContainer.appendChild(sentinel);
+                }
+                appendRows(state.tbody, state.headers, items);
+                if (state.done) {
+                    observer.disconnect();
+                    sentinel.remove();
+                }
+            } catch (error) {
+                console.error(`Error fetching ${endpoint}:`, error);
+                if (!state.tbody) {
+                    tableContainer.innerHTML = `<p>Error loading ${endpoint} data.</p>`;
+                }
+            } finally {
+                state.loading = false;
+            }
+        }
+
+        const observer = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                loadNextPage();
+            }
+        }, { root: tableContainer });
+        observer.observe(sentinel);
+
+        loadNextPage();
+    }
+
+    async function parseResponse(response) {
+        // streamed endpoints (e.g. /ledger_entries) return one JSON object per line
+        const contentType = response.headers.get('content-type') || '';
+        if (!contentType.includes('ndjson')) {
+            return response.json();
         }
+        const text = await response.text();
+        return text.split('\n').filter(line => line.trim() !== '').map(line => JSON.parse(line));
+    }
 
+    function createTable(headers) {
         const table = document.createElement('table');
         const thead = document.createElement('thead');
         const tbody = document.createElement('tbody');
 
         // Create table headers
-        const headers = Object.keys(data[0]);
         const headerRow = document.createElement('tr');
         headers.forEach(headerText => {
             const th = document.createElement('th');
@@ -33,8 +99,11 @@ document.addEventListener('DOMContentLoaded', () => {
         });
         thead.appendChild(headerRow);
         table.appendChild(thead);
+        table.appendChild(tbody);
+        return table;
+    }
 
-        // Create table rows
+    function appendRows(tbody, headers, data) {
         data.forEach(rowData => {
             const row = document.createElement('tr');
             headers.forEach(headerText => {
@@ -56,7 +125,18 @@ document.addEventListener('DOMContentLoaded', () => {
             });
             tbody.appendChild(row);
         });
-        table.appendChild(tbody);
+    }
+
+    function renderTable(data, tableId) {
+        const tableContainer = document.getElementById(tableId);
+        if (!data || data.length === 0) {
+            tableContainer.innerHTML = '<p>No data available.</p>';
+            return;
+        }
+
+        const headers = Object.keys(data[0]);
+        const table = createTable(headers);
+        appendRows(table.querySelector('tbody'), headers, data);
 
         tableContainer.innerHTML = ''; // Clear previous content
         tableContainer.appendChild(table);
@@ -72,14 +152,14 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // Fetch and render data for each table
-    fetchDataAndRenderTable('accounts', 'accounts-table');
+    setupInfiniteTable('accounts', 'accounts-table');
     fetchDataAndRenderTable('ledger_entries', 'ledger-entries-table');
-    fetchDataAndRenderTable('idempotency_keys', 'idempotency-keys-table');
-    fetchDataAndRenderTable('notifications', 'notifications-table');
+    setupInfiniteTable('idempotency_keys', 'idempotency-keys-table');
+    setupInfiniteTable('notifications', 'notifications-table');
 
     // Make tables collapsible
     makeTableCollapsible('accounts-table');
     makeTableCollapsible('ledger-entries-table');
     makeTableCollapsible('idempotency-keys-table');
     makeTableCollapsible('notifications-table');
-});
\ No newline at end of file
+});
@@ -0,0 +1 @@
+"""Modules shared by every service image (each Dockerfile copies ``common/`` next to ``proto/``)."""
@@ -0,0 +1,168 @@
+"""Minimal in-process metrics with Prometheus text exposition.
+
+Counters, gauges and fixed-bucket histograms, updated with plain attribute
+arithmetic on the event loop thread (no locks, no allocation on the hot path).
+The gateway serves ``render()`` at ``GET /metrics``; the gRPC services use the
+tiny HTTP listener in ``serve`` so they can be scraped on their own port.
+"""
+
+import asyncio
+import bisect
+import functools
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# seconds; covers sub-ms Redis calls up to multi-second stalls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List["_Metric"] = []
+# called right before rendering, for gauges that are cheaper to sample than to track
+_collectors: List[Callable[[], None]] = []
+
+def _fmt_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(k)} {v}" for k, v in self._values.items()]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def set(self, value: float, **labels: str):
+        self._values[tuple(sorted(labels.items()))] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(k)} {v}" for k, v in self._values.items()]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[Tuple[str, str], ...], list] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            # [per-bucket counts..., +Inf count, sum]
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_fmt_labels(key + (('le', repr(bound)),))} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_fmt_labels(key + (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {cumulative}")
+        return lines
+
+def on_collect(fn: Callable[[], None]):
+    _collectors.append(fn)
+    return fn
+
+def timed(histogram: Histogram, **labels: str):
+    """Decorator: observe the wall time of an async function."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def inner(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return inner
+    return wrap
+
+# free-text failure messages -> bounded label values
+_REASONS = (
+    ("insufficient funds", "insufficient_funds"),
+    ("not found", "account_not_found"),
+    ("currency mismatch", "currency_mismatch"),
+    ("amount must be", "invalid_amount"),
+    ("must differ", "self_transfer"),
+    ("reused with different parameters", "key_reused"),
+    ("in progress", "in_progress"),
+    ("failed to acquire locks", "lock_timeout"),
+    ("aborted", "aborted"),
+    ("timed out", "timeout"),
+)
+
+def reason_label(message) -> str:
+    m = (message or "").lower()
+    if not m:
+        return ""
+    for needle, label in _REASONS:
+        if needle in m:
+            return label
+    return "other"
+
+def render() -> str:
+    for fn in _collectors:
+        fn()
+    out = []
+    for m in _registry:
+        out.append(f"# HELP {m.name} {m.help}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(m.render())
+    return "\n".join(out) + "\n"
+
+async def serve(port: int) -> asyncio.AbstractServer:
+    """Answer every HTTP request on ``port`` with the text exposition (for Prometheus scrapes)."""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            payload = render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(payload) + payload
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "0.0.0.0", port)
@@ -0,0 +1,250 @@
+"""Sampling profiler, slow-request profiles and event-loop block detection.
+
+``Sampler`` is a daemon thread that snapshots the event-loop thread's Python
+stack every few milliseconds (``sys._current_frames``), so it needs no
+tracing hooks and costs nothing when stopped. Samples render as collapsed
+stacks (``root;...;leaf count`` per line), which flamegraph.pl, speedscope
+and inferno read directly.
+
+* ``profile(seconds)`` profiles the whole process on demand (``GET /admin/profile``
+  in the gateway, the ``LedgerAdmin`` gRPC service in the ledger).
+* ``SlowRequestProfiler`` keeps a short rolling window of samples and, when a
+  request runs past a latency threshold, writes the samples taken during it
+  to ``<dir>/<time>-<trace id>.folded``. Each stack is rooted at
+  ``[this request]``, ``[other tasks]`` (something else held the loop) or ``[idle]``.
+  ``SlowRequestMiddleware`` applies it to HTTP requests, ``SlowRpcInterceptor``
+  to gRPC calls.
+* ``LoopWatchdog`` logs every event-loop block longer than a threshold
+  together with the stack that was running while the loop was blocked.
+"""
+
+import asyncio
+import contextlib
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Callable, Optional, Tuple
+
+import grpc
+from loguru import logger
+
+MAX_PROFILE_S = 60.0
+DEFAULT_INTERVAL_S = 0.005
+
+def _stack(frame) -> tuple:
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+def _label(code) -> str:
+    path = "/".join(code.co_filename.replace("\\", "/").rsplit("/", 2)[-2:])
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({path}:{code.co_firstlineno})"
+
+def _idle(stack: tuple) -> bool:
+    return bool(stack) and stack[-1].co_name == "select" and stack[-1].co_filename.endswith("selectors.py")
+
+def collapse(samples, own_task: Optional[int] = None) -> str:
+    """Collapsed-stack text for (time, task id, stack) samples; ``own_task`` adds the request/other/idle root."""
+    counts: Counter = Counter()
+    for _, task, stack in samples:
+        if _idle(stack):
+            counts[("[idle]",)] += 1
+            continue
+        key = tuple(_label(c) for c in stack)
+        if own_task is not None:
+            key = ("[this request]" if task == own_task else "[other tasks]",) + key
+        counts[key] += 1
+    return "".join(f"{';'.join(k)} {n}\n" for k, n in counts.most_common())
+
+class Sampler:
+    """Samples the stack of the event-loop thread it was started on."""
+
+    def __init__(self, interval_s: float = DEFAULT_INTERVAL_S, keep_s: float = 0.0):
+        self.interval_s = interval_s
+        self.samples: deque = deque(maxlen=int(keep_s / interval_s) if keep_s else None)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._tid = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(1.0)
+
+    def _run(self):
+        current_tasks = getattr(asyncio.tasks, "_current_tasks", {})
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self._tid)
+            if frame is None:
+                continue
+            task = current_tasks.get(self._loop)
+            self.samples.append((time.monotonic(), id(task) if task is not None else 0, _stack(frame)))
+            frame = None
+
+    def window(self, start: float, end: float) -> list:
+        return [s for s in list(self.samples) if start <= s[0] <= end]
+
+async def profile(seconds: float, interval_s: float = DEFAULT_INTERVAL_S) -> Tuple[str, int]:
+    """Sample the event loop for ``seconds`` (capped); returns (collapsed stacks, sample count)."""
+    sampler = Sampler(max(0.001, interval_s))
+    sampler.start()
+    try:
+        await asyncio.sleep(min(max(seconds, 0.0), MAX_PROFILE_S))
+    finally:
+        sampler.stop()
+    samples = list(sampler.samples)
+    return collapse(samples), len(samples)
+
+def _write(path: str, text: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+class SlowRequestProfiler:
+    """Always-on low-rate sampler; dumps the profile of any request slower than ``threshold_ms``."""
+
+    def __init__(
+        self, threshold_ms: float, out_dir: str, interval_s: float = DEFAULT_INTERVAL_S,
+        keep_s: float = 30.0, min_gap_s: float = 1.0,
+    ):
+        self.threshold_s = threshold_ms / 1000.0
+        self.out_dir = out_dir
+        self.min_gap_s = min_gap_s
+        self.sampler = Sampler(interval_s, keep_s)
+        self._last_dump = 0.0
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+
+    @contextlib.contextmanager
+    def track(self, name: str, tag: str = ""):
+        task = asyncio.current_task()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            # at most one dump per min_gap_s, so a latency spike cannot turn into a disk storm
+            if end - start >= self.threshold_s and end - self._last_dump >= self.min_gap_s:
+                self._last_dump = end
+                self._dump(name, tag, start, end, id(task))
+
+    def _dump(self, name: str, tag: str, start: float, end: float, task_id: int):
+        samples = self.sampler.window(start, end)
+        path = os.path.join(self.out_dir, f"{int(time.time() * 1000)}-{tag or 'request'}.folded")
+        asyncio.get_running_loop().run_in_executor(None, _write, path, collapse(samples, own_task=task_id))
+        logger.warning(f"Slow request {name}: {(end - start) * 1000:.0f} ms, {len(samples)} samples -> {path}")
+
+class LoopWatchdog:
+    """Logs event-loop blocks longer than ``threshold_ms`` with the stack that caused them.
+
+    A heartbeat task notes the time every ``threshold_ms / 2``; a watcher thread
+    that sees the heartbeat overdue grabs the loop thread's stack while the
+    block is still in progress. When the heartbeat finally runs it logs how long
+    the loop was stuck, with that stack.
+    """
+
+    def __init__(self, threshold_ms: float, on_block: Optional[Callable[[float], None]] = None):
+        self.threshold_s = threshold_ms / 1000.0
+        self.on_block = on_block
+        self.blocks = 0
+        self._stop = threading.Event()
+        self._stack: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._tid = threading.get_ident()
+        self._due = time.monotonic() + self.threshold_s / 2
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        period = self.threshold_s / 2
+        while True:
+            await asyncio.sleep(period)
+            now = time.monotonic()
+            lag = now - self._due
+            self._due = now + period
+            if lag >= self.threshold_s:
+                self.blocks += 1
+                stack, self._stack = self._stack, None
+                logger.warning(
+                    f"Event loop blocked for {lag * 1000:.0f} ms"
+                    + (f"; stack while blocked:\n{stack}" if stack else "")
+                )
+                if self.on_block is not None:
+                    self.on_block(lag)
+
+    def _watch(self):
+        captured_for = None
+        while not self._stop.wait(self.threshold_s / 4):
+            due = self._due
+            if time.monotonic() - due < self.threshold_s or captured_for == due:
+                continue
+            frame = sys._current_frames().get(self._tid)
+            if frame is not None:
+                self._stack = "".join(traceback.format_stack(frame, limit=15))
+                frame = None
+            captured_for = due
+
+class SlowRpcInterceptor(grpc.aio.ServerInterceptor):
+    """Feeds every unary-response RPC through ``SlowRequestProfiler.track``.
+
+    List it after the tracing interceptor so dumps are named by trace id.
+    """
+
+    def __init__(self, profiler: SlowRequestProfiler, tag: Callable[[], str] = lambda: ""):
+        self.profiler = profiler
+        self.tag = tag
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or not (handler.unary_unary or handler.stream_unary):
+            return handler
+        name = handler_call_details.method.lstrip("/").split(".")[-1]
+
+        def wrap(fn):
+            async def tracked(request, context):
+                with self.profiler.track(name, self.tag()):
+                    return await fn(request, context)
+            return tracked
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=wrap(handler.unary_unary))
+        return handler._replace(stream_unary=wrap(handler.stream_unary))
+
+class SlowRequestMiddleware:
+    """ASGI middleware feeding every HTTP request through ``SlowRequestProfiler.track``.
+
+    Install it inside the tracing middleware so dumps are named by trace id.
+    """
+
+    def __init__(self, app, profiler: SlowRequestProfiler, tag: Callable[[], str] = lambda: ""):
+        self.app = app
+        self.profiler = profiler
+        self.tag = tag
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        with self.profiler.track(f"{scope['method']} {scope['path']}", self.tag()):
+            await self.app(scope, receive, send)
@@ -0,0 +1,305 @@
+"""Lightweight request tracing with W3C ``traceparent`` propagation.
+
+A span is a named, timed piece of work inside a trace; the current span lives
+in a context variable, so it follows the request across ``await``s. The gateway
+starts one trace per HTTP request (continuing the caller's ``traceparent``
+header if there is one) and passes it to the ledger and notification services
+as gRPC metadata, where each RPC becomes a child span.
+
+Sampling is decided once, at the head of the trace (``TRACE_SAMPLE_RATE``),
+and carried downstream in the ``traceparent`` flags. Unsampled requests still
+get a trace id, which is stamped on every log line, but child spans are
+no-ops. Sampled spans are buffered and exported in OTLP/JSON once a second,
+off the event loop, to a JSON-lines file (``TRACE_FILE``) and/or an OTLP/HTTP
+collector (``TRACE_OTLP_ENDPOINT``, e.g. ``http://otel-collector:4318/v1/traces``).
+
+``TraceMiddleware`` opens the gateway's HTTP spans; ``ServerInterceptor`` turns
+each incoming RPC of the ledger and notification services into a server span.
+Every service image copies this package next to ``proto/``.
+"""
+
+import asyncio
+import contextvars
+import json
+import random
+import sys
+import time
+import urllib.request
+from typing import List, Optional
+
+import grpc
+from loguru import logger
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("trace_span", default=None)
+
+_service = ""
+_sample_rate = 0.0
+_exporter: Optional["_Exporter"] = None
+_task: Optional[asyncio.Task] = None
+
+_LOG_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "trace={extra[trace_id]} | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
+
+class Span:
+    __slots__ = (
+        "name", "kind", "trace_id", "span_id", "parent_id", "sampled", "attrs", "error", "start_ns", "end_ns", "_token",
+    )
+
+    def __init__(self, name: str, trace_id: str, parent_id: str, sampled: bool, kind: int = INTERNAL, attrs=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attrs = attrs or {}
+        self.error: Optional[str] = None
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self._token = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set(self, **attrs):
+        if self.sampled:
+            self.attrs.update(attrs)
+
+    def fail(self, message: str):
+        self.error = message
+
+    def end(self):
+        if self.end_ns:
+            return
+        self.end_ns = time.time_ns()
+        if self.sampled and _exporter is not None:
+            _exporter.add(self)
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        if exc_type is not None and self.error is None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.end()
+        return False
+
+class _NoopSpan:
+    """Stands in for child spans of unsampled (or absent) traces."""
+
+    def set(self, **attrs):
+        pass
+
+    def fail(self, message: str):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP = _NoopSpan()
+
+def _parse(traceparent: str):
+    parts = traceparent.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+def start_trace(name: str, traceparent: Optional[str] = None, kind: int = SERVER, **attrs) -> Span:
+    """Root span for an incoming request; continues ``traceparent`` when it is valid."""
+    parent = _parse(traceparent) if traceparent else None
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id, sampled = "%032x" % random.getrandbits(128), "", random.random() < _sample_rate
+    return Span(name, trace_id, parent_id, sampled, kind, attrs)
+
+def span(name: str, kind: int = INTERNAL, **attrs):
+    """Child of the current span. Use as a context manager, or call ``.end()`` for leaf spans."""
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        return _NOOP
+    return Span(name, parent.trace_id, parent.span_id, True, kind, attrs)
+
+def current_trace_id() -> str:
+    s = _current.get()
+    return s.trace_id if s is not None else "-"
+
+def metadata():
+    """gRPC metadata carrying the current span, or None outside a trace."""
+    s = _current.get()
+    return (("traceparent", s.traceparent),) if s is not None else None
+
+def _value(v):
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+def _otlp(spans: List[Span]) -> dict:
+    out = []
+    for s in spans:
+        d = {
+            "traceId": s.trace_id, "spanId": s.span_id, "name": s.name, "kind": s.kind,
+            "startTimeUnixNano": str(s.start_ns), "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _value(v)} for k, v in s.attrs.items()],
+        }
+        if s.parent_id:
+            d["parentSpanId"] = s.parent_id
+        if s.error is not None:
+            d["status"] = {"code": 2, "message": s.error}
+        out.append(d)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": _service}}]},
+            "scopeSpans": [{"scope": {"name": "easpayments"}, "spans": out}],
+        }]
+    }
+
+class _Exporter:
+    def __init__(self, path: str, endpoint: str, interval_s: float, max_queue: int):
+        self.path = path
+        self.endpoint = endpoint
+        self.interval_s = interval_s
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._buf: List[Span] = []
+
+    def add(self, s: Span):
+        if len(self._buf) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._buf.append(s)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval_s)
+            await self.flush()
+
+    async def flush(self):
+        if not self._buf:
+            return
+        batch, self._buf = self._buf, []
+        try:
+            await asyncio.to_thread(self._export, json.dumps(_otlp(batch), separators=(",", ":")))
+        except Exception as e:
+            logger.warning(f"Trace export failed, {len(batch)} spans dropped: {e}")
+
+    def _export(self, payload: str):
+        if self.path:
+            # unbuffered append: one write() per batch, so processes can share the file
+            with open(self.path, "ab", buffering=0) as f:
+                f.write(payload.encode() + b"\n")
+        if self.endpoint:
+            req = urllib.request.Request(
+                self.endpoint, data=payload.encode(), headers={"Content-Type": "application/json"}
+            )
+            urllib.request.urlopen(req, timeout=5).close()
+
+def _patch(record):
+    record["extra"]["trace_id"] = current_trace_id()
+
+def configure(
+    service: str, sample_rate: float = 0.0, path: str = "", endpoint: str = "",
+    interval_s: float = 1.0, max_queue: int = 10_000,
+):
+    """Set the service name and sampling, stamp trace ids on log lines, and set up the exporter."""
+    global _service, _sample_rate, _exporter
+    _service = service
+    _sample_rate = sample_rate
+    logger.configure(handlers=[{"sink": sys.stderr, "format": _LOG_FORMAT}], patcher=_patch)
+    _exporter = _Exporter(path, endpoint, interval_s, max_queue) if (path or endpoint) else None
+
+def start():
+    """Start the background exporter; call from a running event loop."""
+    global _task
+    if _exporter is not None and _task is None:
+        _task = asyncio.create_task(_exporter.run())
+
+async def shutdown():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    if _exporter is not None:
+        await _exporter.flush()
+
+class ServerInterceptor(grpc.aio.ServerInterceptor):
+    """Runs every unary-response RPC inside a server span continuing the caller's ``traceparent``."""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or not (handler.unary_unary or handler.stream_unary):
+            # response streams (ExportEntries) run untraced
+            return handler
+        traceparent = None
+        for k, v in handler_call_details.invocation_metadata or ():
+            if k == "traceparent":
+                traceparent = v
+                break
+        name = handler_call_details.method.lstrip("/").split(".")[-1]
+
+        def wrap(fn):
+            async def traced(request, context):
+                with start_trace(name, traceparent):
+                    return await fn(request, context)
+            return traced
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=wrap(handler.unary_unary))
+        return handler._replace(stream_unary=wrap(handler.stream_unary))
+
+class TraceMiddleware:
+    """ASGI middleware: one server span per HTTP request, with the trace id in ``X-Trace-Id``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        traceparent = None
+        for k, v in scope["headers"]:
+            if k == b"traceparent":
+                traceparent = v.decode("latin-1")
+                break
+        method = scope["method"]
+        with start_trace(f"{method} {scope['path']}", traceparent, **{"http.method": method}) as s:
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    s.set(**{"http.status_code": message["status"]})
+                    if message["status"] >= 500:
+                        s.fail(f"HTTP {message['status']}")
+                    message["headers"] = [*message.get("headers", ()), (b"x-trace-id", s.trace_id.encode())]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
+            route = scope.get("route")
+            if route is not None:
+                # the route template keeps span names low-cardinality
+                s.name = f"{method} {route.path}"
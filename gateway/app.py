@@ -3,193 +3,406 @@
 Public REST surface:
 
 POST /transfer        -> initiate transfer (idempotent)
-GET  /balance/{acct}  -> fetch balance
+GET  /balance/{acct}  -> fetch balance (cached; ?consistent=true reads the ledger primary,
+                         ?min_version= from a transfer response reads your own writes,
+                         ?at= returns the balance as of that time)
+GET  /accounts/{acct}/statement
+                      -> entries in time order with running balances (?since=&until=&cursor=&limit=)
+GET  /ledger_entries  -> NDJSON stream of transfers (?since=&account_id=)
+GET  /accounts, /notifications, /idempotency_keys
+                      -> cursor-paginated lists ({items, next_cursor})
+Reads are served from the read replica when one is configured; ?consistent=true reads the primary.
+GET  /metrics         -> Prometheus text exposition
+GET  /admin/profile   -> on-demand sampling profile, collapsed stacks (X-Admin-Token)
 GET  /health          -> liveness
 """
 
 import asyncio
-from fastapi import FastAPI, HTTPException
+import hmac
+import time
+from datetime import datetime
+from typing import Optional
+
+import grpc
+import orjson
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from loguru import logger
+
+from common import metrics, profiler, tracing
 
 from .config import settings
-from .schemas import TransferIn, TransferOut, BalanceOut
-from . import db, idempotency, redis_lock, grpc_clients, utils
+from .schemas import TransferIn, TransferOut, BalanceOut, StatementOut
+from . import (
+    db, idempotency, redis_lock, grpc_clients, utils, outbox, sharding, balance_cache,
+)
 
 app = FastAPI(title="EASPayments Gateway")
 
+PAGE_LIMIT_MAX = 500
+
+transfer_seconds = metrics.Histogram(
+    "gateway_transfer_seconds", "End-to-end POST /transfer latency",
+)
+transfer_outcomes_total = metrics.Counter(
+    "gateway_transfer_outcomes_total", "POST /transfer results by status (SUCCESS, FAILED or HTTP code) and reason",
+)
+loop_block_seconds = metrics.Histogram(
+    "gateway_event_loop_block_seconds", "Event-loop blocks longer than LOOP_BLOCK_THRESHOLD_MS",
+)
+
+slow_profiler = None
+if settings.profile_slow_request_ms > 0:
+    slow_profiler = profiler.SlowRequestProfiler(settings.profile_slow_request_ms, settings.profile_dir)
+    # added before the tracing middleware, so it runs inside it and can name dumps by trace id
+    app.add_middleware(profiler.SlowRequestMiddleware, profiler=slow_profiler, tag=tracing.current_trace_id)
+loop_watchdog = None
+if settings.loop_block_threshold_ms > 0:
+    loop_watchdog = profiler.LoopWatchdog(settings.loop_block_threshold_ms, on_block=loop_block_seconds.observe)
+
 app.mount("/ui", StaticFiles(directory="UI", html=True), name="ui")
+app.add_middleware(tracing.TraceMiddleware)
+
+tracing.configure(
+    "gateway", settings.trace_sample_rate, path=settings.trace_file, endpoint=settings.trace_otlp_endpoint,
+)
 
 @app.on_event("startup")
 async def _startup():
+    tracing.start()
+    if slow_profiler is not None:
+        slow_profiler.start()
+    if loop_watchdog is not None:
+        loop_watchdog.start()
     await db.ensure_tables_exist()
+    await db.warm_account_cache()
+    app.state.account_invalidation_task = asyncio.create_task(db.listen_account_invalidations())
+    app.state.outbox_task = asyncio.create_task(outbox.run_dispatcher())
+    app.state.shard_recovery_task = asyncio.create_task(sharding.run_recovery())
+    if settings.postgres_read_host:
+        app.state.replica_monitor_task = asyncio.create_task(db.monitor_replica())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if slow_profiler is not None:
+        slow_profiler.stop()
+    if loop_watchdog is not None:
+        loop_watchdog.stop()
+    await tracing.shutdown()
 
 @app.get("/health")
 async def health():
     return {"ok": True}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def _require_admin(token: Optional[str]):
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(
+    seconds: float = Query(10.0, gt=0, le=profiler.MAX_PROFILE_S),
+    interval_ms: float = Query(5.0, ge=1, le=1000),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """Sample this process for ``seconds``; returns collapsed stacks for flamegraph tools."""
+    _require_admin(x_admin_token)
+    text, samples = await profiler.profile(seconds, interval_ms / 1000.0)
+    return PlainTextResponse(text, headers={"X-Profile-Samples": str(samples)})
+
+@app.get("/account_cache/stats")
+async def account_cache_stats():
+    return db.account_cache.stats()
+
+async def _list_page(table, key_col, limit, cursor, since, until, consistent, filters=()):
+    filters = list(filters)
+    if since is not None:
+        filters.append(table.c.created_at >= since)
+    if until is not None:
+        filters.append(table.c.created_at < until)
+    pos = None
+    if cursor:
+        pos = utils.decode_cursor(cursor)
+        if pos is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    items, next_pos = await db.list_page(table, key_col, limit, cursor=pos, filters=filters, consistent=consistent)
+    return {"items": items, "next_cursor": utils.encode_cursor(next_pos) if next_pos else None}
+
 @app.get("/accounts")
-async def get_accounts():
-    session = await db.get_session()
-    async with session:
-        query = db.accounts.select()
-        result = await session.execute(query)
-        return [dict(r) for r in result.mappings().all()]
+async def get_accounts(
+    limit: int = Query(50, ge=1, le=PAGE_LIMIT_MAX),
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    consistent: bool = False,
+):
+    return await _list_page(db.accounts, "id", limit, cursor, since, until, consistent)
 
-@app.get("/ledger_entries")
-async def get_ledger_entries():
-    resp = await grpc_clients.ledger_get_all_entries()
-    return [
-        dict(
-            tx_id=e.tx_id,
-            from_account=e.from_account,
-            to_account=e.to_account,
-            amount=e.amount,
-            currency=e.currency,
-            created_at=e.created_at,
+@app.get("/accounts/{account_id}/statement", response_model=StatementOut)
+async def get_statement(
+    account_id: str,
+    limit: int = Query(100, ge=1, le=PAGE_LIMIT_MAX),
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    consistent: bool = False,
+):
+    """One page of the account's entries, oldest first, each with the balance after it.
+
+    The ledger seeds the page from its nearest balance checkpoint, so late
+    pages of old accounts cost the same as early ones.
+    """
+    if not utils.is_uuid(account_id):
+        raise HTTPException(status_code=400, detail="Invalid account_id")
+    try:
+        resp = await grpc_clients.ledger_get_statement(
+            account_id,
+            since=since.isoformat() if since else "",
+            until=until.isoformat() if until else "",
+            cursor=cursor or "",
+            limit=limit,
+            consistent=consistent,
         )
-        for e in resp.entries
-    ]
+    except grpc.aio.AioRpcError as e:
+        if e.code() == grpc.StatusCode.NOT_FOUND:
+            raise HTTPException(status_code=404, detail="Account not found")
+        if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+            raise HTTPException(status_code=400, detail=e.details())
+        raise
+    return StatementOut(
+        account_id=resp.account_id,
+        currency=resp.currency,
+        opening_balance=resp.opening_balance,
+        lines=[
+            dict(
+                tx_id=line.tx_id,
+                counterparty=line.counterparty,
+                direction=line.direction,
+                amount=line.amount,
+                balance_after=line.balance_after,
+                created_at=line.created_at,
+            )
+            for line in resp.lines
+        ],
+        next_cursor=resp.next_cursor or None,
+    )
+
+@app.get("/ledger_entries")
+async def get_ledger_entries(since: Optional[str] = None, account_id: Optional[str] = None, consistent: bool = False):
+    """Stream the ledger as NDJSON, one transfer per line, without buffering it."""
+    if account_id is not None and not utils.is_uuid(account_id):
+        raise HTTPException(status_code=400, detail="Invalid account_id")
+    if since is not None and not utils.is_iso_timestamp(since):
+        raise HTTPException(status_code=400, detail="Invalid since")
+
+    async def _lines():
+        async for e in grpc_clients.ledger_export_entries(
+            since=since or "", account_id=account_id or "", consistent=consistent
+        ):
+            yield orjson.dumps(dict(
+                tx_id=e.tx_id,
+                from_account=e.from_account,
+                to_account=e.to_account,
+                amount=e.amount,
+                currency=e.currency,
+                created_at=e.created_at,
+            )) + b"\n"
+
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
 
 @app.get("/idempotency_keys")
-async def get_idempotency_keys():
-    session = await db.get_session()
-    async with session:
-        query = db.idempotency_keys.select()
-        result = await session.execute(query)
-        return [dict(r) for r in result.mappings().all()]
+async def get_idempotency_keys(
+    limit: int = Query(50, ge=1, le=PAGE_LIMIT_MAX),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    consistent: bool = False,
+):
+    filters = [db.idempotency_keys.c.status == status] if status else []
+    return await _list_page(db.idempotency_keys, "key", limit, cursor, since, until, consistent, filters)
 
 @app.get("/balance/{account_id}", response_model=BalanceOut)
-async def get_balance(account_id: str):
+async def get_balance(
+    account_id: str, consistent: bool = False, min_version: int = Query(0, ge=0), at: Optional[datetime] = None,
+):
+    """Balance from the Redis cache when possible; ``consistent=true`` always reads the ledger primary.
+
+    ``min_version`` (a ``*_version`` from a transfer response) skips cache entries
+    and replica reads older than that transfer. ``at`` returns the posted
+    balance as of that time, which is never cached and has no version.
+    """
     if not utils.is_uuid(account_id):
         raise HTTPException(status_code=400, detail="Invalid account_id")
-    resp = await grpc_clients.ledger_get_balance(account_id)
-    return BalanceOut(account_id=resp.account_id, balance=resp.balance, currency=resp.currency)
+    if at is not None:
+        try:
+            resp = await grpc_clients.ledger_get_balance_at(account_id, at.isoformat(), consistent=consistent)
+        except grpc.aio.AioRpcError as e:
+            if e.code() == grpc.StatusCode.NOT_FOUND:
+                raise HTTPException(status_code=404, detail="Account not found")
+            raise
+        return BalanceOut(account_id=resp.account_id, balance=resp.balance, currency=resp.currency)
+    # hot-account bucket credits are unversioned, so those balances are never cached
+    cacheable = settings.balance_cache_enabled and not await db.is_hot_account(account_id)
+    if cacheable and not consistent:
+        cached = await balance_cache.get(account_id, min_version)
+        if cached is not None:
+            return BalanceOut(account_id=account_id, balance=cached[0], currency=cached[1], version=cached[2])
+    elif cacheable:
+        balance_cache.lookups_total.inc(result="bypass")
+    resp = await grpc_clients.ledger_get_balance(account_id, consistent=consistent, min_version=min_version)
+    if cacheable:
+        await balance_cache.put(account_id, resp.balance, resp.version, resp.currency)
+    return BalanceOut(account_id=resp.account_id, balance=resp.balance, currency=resp.currency, version=resp.version)
 
 @app.post("/transfer", response_model=TransferOut)
 async def transfer(req: TransferIn):
-    # idempotency pre-check
-    existing = await idempotency.check_idempotency(req.idempotency_key)
-    if existing and existing["status"] == "SUCCESS" and existing["response"]:
-        return existing["response"]
-
-    # create placeholder idempotency record (no-op if exists)
-    await idempotency.start_idempotency(req.idempotency_key)
+    start = time.perf_counter()
+    try:
+        # duplicates arriving while this key is in flight share the first request's outcome
+        resp = await idempotency.coalesce(req.idempotency_key, lambda: _transfer(req))
+    except HTTPException as e:
+        transfer_outcomes_total.inc(status=str(e.status_code), reason=metrics.reason_label(str(e.detail)))
+        raise
+    finally:
+        transfer_seconds.observe(time.perf_counter() - start)
+    transfer_outcomes_total.inc(status=resp["status"], reason=metrics.reason_label(resp.get("message")))
+    return resp
 
-    # validate accounts
-    if not await db.account_exists(req.from_account):
-        raise HTTPException(status_code=400, detail="from_account not found")
-    if not await db.account_exists(req.to_account):
-        raise HTTPException(status_code=400, detail="to_account not found")
+def _transfer_out(grpc_resp) -> dict:
+    return TransferOut(
+        tx_id=grpc_resp.tx_id,
+        from_account=grpc_resp.from_account,
+        to_account=grpc_resp.to_account,
+        amount=grpc_resp.amount,
+        currency=grpc_resp.currency,
+        from_balance_after=grpc_resp.from_balance_after,
+        to_balance_after=grpc_resp.to_balance_after,
+        status=grpc_resp.status,
+        message=grpc_resp.message or None,
+        from_version=grpc_resp.from_version,
+        to_version=grpc_resp.to_version,
+    ).model_dump()
 
-    # concurrency control: acquire account locks
-    locks = {}
+async def _lock_accounts(req: TransferIn) -> dict:
+    if not settings.gateway_account_locks:
+        return {}
+    ids = [req.from_account]
+    # credits to a hot account must not serialize on its lock; the ledger
+    # spreads them over bucket rows
+    if not await db.is_hot_account(req.to_account):
+        ids.append(req.to_account)
     try:
-        locks = await redis_lock.acquire_account_locks([req.from_account, req.to_account])
+        return await redis_lock.acquire_account_locks(ids)
     except TimeoutError as e:
         raise HTTPException(status_code=409, detail=str(e))
 
-    # call ledger
+async def _ledger_transfer(req: TransferIn, **kwargs):
     try:
-        grpc_resp = await grpc_clients.ledger_transfer(
+        return await grpc_clients.ledger_transfer(
             from_account=req.from_account,
             to_account=req.to_account,
             amount=req.amount,
             currency=req.currency,
             idempotency_key=req.idempotency_key,
+            **kwargs,
         )
+    except grpc.aio.AioRpcError as e:
+        # explicit rejections, so the transfer was not applied: a request the
+        # ledger can never accept as sent (e.g. wrong currency), or one it cannot
+        # accept in the current state. Anything else may have committed.
+        if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+            raise HTTPException(status_code=400, detail=e.details())
+        if e.code() == grpc.StatusCode.FAILED_PRECONDITION:
+            raise HTTPException(status_code=409, detail=e.details())
+        raise
+
+async def _transfer_fast(req: TransferIn):
+    """One gRPC call: the ledger dedupes, validates and writes in a single transaction."""
+    locks = await _lock_accounts(req)
+    try:
+        grpc_resp = await _ledger_transfer(req, ledger_dedupe=True)
     finally:
         await redis_lock.release_account_locks(locks)
 
-    # build response model
-    resp_obj = TransferOut(
-        tx_id=grpc_resp.tx_id,
-        from_account=grpc_resp.from_account,
-        to_account=grpc_resp.to_account,
-        amount=grpc_resp.amount,
-        currency=grpc_resp.currency,
-        from_balance_after=grpc_resp.from_balance_after,
-        to_balance_after=grpc_resp.to_balance_after,
-        status=grpc_resp.status,
-        message=grpc_resp.message or None,
-    ).model_dump()
+    await balance_cache.apply_transfer(grpc_resp)
+    # a replayed response already had its notifications enqueued
+    if grpc_resp.status == "SUCCESS" and not grpc_resp.replayed:
+        await db.enqueue_notifications(outbox.outbox_rows(grpc_resp))
+        outbox.notify_enqueued()
+    return _transfer_out(grpc_resp)
 
-    # persist idempotency final state
-    await idempotency.finalize_idempotency(
-        req.idempotency_key, grpc_resp.status, grpc_resp.tx_id, resp_obj
-    )
+async def _transfer(req: TransferIn):
+    if settings.transfer_fast_path:
+        return await _transfer_fast(req)
 
-    # fire notifications (don't block response)
-    asyncio.create_task(_notify_both(grpc_resp))
+    # idempotency: claim the key, or learn it is in flight / already done
+    claim = await idempotency.claim_idempotency(req.idempotency_key)
+    if claim.state == idempotency.COMPLETED:
+        return claim.response
+    if claim.state == idempotency.IN_FLIGHT:
+        # owned by another gateway replica; wait for its finalize notification
+        response = await idempotency.wait_for_completion(req.idempotency_key)
+        if response is None:
+            raise HTTPException(status_code=409, detail="Request with this idempotency_key is in progress")
+        return response
 
-    return resp_obj
+    # validate accounts
+    try:
+        if not await db.account_exists(req.from_account):
+            raise HTTPException(status_code=400, detail="from_account not found")
+        if not await db.account_exists(req.to_account):
+            raise HTTPException(status_code=400, detail="to_account not found")
 
-async def _notify_both(grpc_resp):
+        # concurrency control: acquire account locks
+        locks = await _lock_accounts(req)
+    except HTTPException:
+        # nothing reached the ledger; free the key for a retry
+        await idempotency.release_idempotency(req.idempotency_key, claim)
+        raise
+
+    # call ledger; it dedupes on the key too, so a retry after a lost reply or
+    # a crash (once the claim's lease expires) gets this call's outcome back
     try:
-        # Store notifications in the database
-        session = await db.get_session()
-        async with session:
-            async with session.begin():
-                await session.execute(
-                    db.notifications.insert().values(
-                        account_id=grpc_resp.from_account,
-                        tx_id=grpc_resp.tx_id,
-                        amount=grpc_resp.amount,
-                        direction="DEBIT",
-                        currency=grpc_resp.currency,
-                        message=f"Sent {grpc_resp.amount} {grpc_resp.currency} to {grpc_resp.to_account}",
-                    )
-                )
-                await session.execute(
-                    db.notifications.insert().values(
-                        account_id=grpc_resp.to_account,
-                        tx_id=grpc_resp.tx_id,
-                        amount=grpc_resp.amount,
-                        direction="CREDIT",
-                        currency=grpc_resp.currency,
-                        message=f"Received {grpc_resp.amount} {grpc_resp.currency} from {grpc_resp.from_account}",
-                    )
-                )
-
-        # Asynchronously send notifications
-        try:
-            await grpc_clients.send_notification(
-                account_id=grpc_resp.from_account,
-                tx_id=grpc_resp.tx_id,
-                amount=grpc_resp.amount,
-                direction="DEBIT",
-                currency=grpc_resp.currency,
-                message=f"Sent {grpc_resp.amount} {grpc_resp.currency} to {grpc_resp.to_account}",
-            )
-            logger.info(f"Notification sent for debit: {grpc_resp.from_account}")
-        except Exception as e:
-            logger.error(f"Error sending debit notification for {grpc_resp.from_account}: {e}")
+        grpc_resp = await _ledger_transfer(req, ledger_dedupe=True)
+    except HTTPException:
+        # the ledger rejected the request without applying it
+        await idempotency.release_idempotency(req.idempotency_key, claim)
+        raise
+    finally:
+        await redis_lock.release_account_locks(locks)
 
-        try:
-            await grpc_clients.send_notification(
-                account_id=grpc_resp.to_account,
-                tx_id=grpc_resp.tx_id,
-                amount=grpc_resp.amount,
-                direction="CREDIT",
-                currency=grpc_resp.currency,
-                message=f"Received {grpc_resp.amount} {grpc_resp.currency} from {grpc_resp.from_account}",
-            )
-            logger.info(f"Notification sent for credit: {grpc_resp.to_account}")
-        except Exception as e:
-            logger.error(f"Error sending credit notification for {grpc_resp.to_account}: {e}")
+    await balance_cache.apply_transfer(grpc_resp)
+    resp_obj = _transfer_out(grpc_resp)
+
+    # persist idempotency final state, enqueueing notifications in the same transaction.
+    # A replay means an earlier owner of the key lost its claim before finalizing,
+    # so its notifications were never enqueued; the fence lets one owner do it.
+    rows = outbox.outbox_rows(grpc_resp) if grpc_resp.status == "SUCCESS" else []
+    finalized = await idempotency.finalize_idempotency(
+        req.idempotency_key, claim, grpc_resp.status, grpc_resp.tx_id, resp_obj, rows
+    )
+    if finalized and rows:
+        outbox.notify_enqueued()
 
-    except Exception as e:
-        # swallow notification failures; they don't affect ledger
-        logger.error(f"Unhandled exception in _notify_both: {e}")
-        pass
+    return resp_obj
 
 @app.get("/notifications")
-async def get_notifications():
-    session = await db.get_session()
-    async with session:
-        query = db.notifications.select()
-        result = await session.execute(query)
-        return [dict(r) for r in result.mappings().all()]
+async def get_notifications(
+    limit: int = Query(50, ge=1, le=PAGE_LIMIT_MAX),
+    cursor: Optional[str] = None,
+    account_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    consistent: bool = False,
+):
+    filters = [db.notifications.c.account_id == account_id] if account_id else []
+    return await _list_page(db.notifications, "id", limit, cursor, since, until, consistent, filters)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,103 @@
+"""Redis read-through balance cache, updated from transfer responses.
+
+Each account's entry is a hash ``bal:<account_id>`` holding the balance, the
+ledger's ``account_balances.version`` it was read or written at, and the
+currency. ``GET /balance`` fills it on a miss, and every successful transfer
+writes both ``*_balance_after`` values through. All writes go through one Lua
+compare-and-set that keeps the entry with the higher version. A slow read can
+therefore never overwrite a newer transfer's balance, whatever order the
+writes arrive in.
+
+Responses without a version (credits into hot-account buckets, cross-shard
+transfers) delete the entry instead. Hot accounts are never cached, because
+their bucket credits do not bump the version. Entries expire after
+``balance_cache_ttl_s``, which bounds staleness from changes the gateway does
+not see: balance rebuilds and accounts newly marked hot.
+"""
+
+from typing import Optional, Tuple
+
+from common import metrics
+
+from . import redis_lock
+from .config import settings
+
+PREFIX = "bal:"
+
+# KEYS = [key], ARGV = [balance, version, currency, ttl_ms]; returns 1 if written
+_PUT_LUA = """
+local cur = redis.call('hget', KEYS[1], 'v')
+if cur and tonumber(cur) > tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('hset', KEYS[1], 'b', ARGV[1], 'v', ARGV[2], 'c', ARGV[3])
+redis.call('pexpire', KEYS[1], ARGV[4])
+return 1
+"""
+
+_put_script = None
+
+lookups_total = metrics.Counter(
+    "gateway_balance_cache_lookups_total", "Balance reads by result (hit, miss, stale, bypass)",
+)
+writes_total = metrics.Counter(
+    "gateway_balance_cache_writes_total", "Balance cache writes by outcome (stored, stale, invalidated)",
+)
+
+async def _script():
+    global _put_script
+    if _put_script is None:
+        r = await redis_lock.get_redis()
+        _put_script = r.register_script(_PUT_LUA)
+    return _put_script
+
+async def get(account_id: str, min_version: int = 0) -> Optional[Tuple[int, str, int]]:
+    """(balance, currency, version) from the cache; None on a miss or if older than ``min_version``."""
+    r = await redis_lock.get_redis()
+    balance, currency, version = await r.hmget(PREFIX + account_id, "b", "c", "v")
+    if balance is None:
+        lookups_total.inc(result="miss")
+        return None
+    if int(version) < min_version:
+        lookups_total.inc(result="stale")
+        return None
+    lookups_total.inc(result="hit")
+    return int(balance), currency, int(version)
+
+async def put(account_id: str, balance: int, version: int, currency: str):
+    """Store a balance read at ``version``; ignored if the entry already holds a newer one."""
+    if version <= 0:
+        await invalidate(account_id)
+        return
+    put_script = await _script()
+    stored = await put_script(
+        keys=[PREFIX + account_id], args=[balance, version, currency, int(settings.balance_cache_ttl_s * 1000)]
+    )
+    writes_total.inc(outcome="stored" if stored else "stale")
+
+async def invalidate(*account_ids: str):
+    if account_ids:
+        r = await redis_lock.get_redis()
+        await r.delete(*(PREFIX + a for a in account_ids))
+        writes_total.inc(len(account_ids), outcome="invalidated")
+
+async def apply_transfer(resp):
+    """Write both sides of a successful TransferResponse through, in one round trip."""
+    if not settings.balance_cache_enabled or resp.status != "SUCCESS":
+        return
+    put_script = await _script()
+    ttl_ms = int(settings.balance_cache_ttl_s * 1000)
+    sides = (
+        (resp.from_account, resp.from_balance_after, resp.from_version),
+        (resp.to_account, resp.to_balance_after, resp.to_version),
+    )
+    r = await redis_lock.get_redis()
+    async with r.pipeline(transaction=False) as pipe:
+        for account_id, balance, version in sides:
+            if version > 0:
+                await put_script(keys=[PREFIX + account_id], args=[balance, version, resp.currency, ttl_ms], client=pipe)
+            else:
+                pipe.delete(PREFIX + account_id)
+        results = await pipe.execute()
+    for (_, _, version), result in zip(sides, results):
+        writes_total.inc(outcome="invalidated" if version <= 0 else ("stored" if result else "stale"))
@@ -7,12 +7,73 @@ class Settings(BaseModel):
     postgres_db: str = Field(default_factory=lambda: os.getenv("POSTGRES_DB", "easpayments"))
     postgres_user: str = Field(default_factory=lambda: os.getenv("POSTGRES_USER", "easuser"))
     postgres_password: str = Field(default_factory=lambda: os.getenv("POSTGRES_PASSWORD", "easpass"))
+    # streaming replica for the list endpoints; empty = every read goes to the primary
+    postgres_read_host: str = Field(default_factory=lambda: os.getenv("POSTGRES_READ_HOST", ""))
+    postgres_read_port: int = Field(
+        default_factory=lambda: int(os.getenv("POSTGRES_READ_PORT", os.getenv("POSTGRES_PORT", "5432")))
+    )
+    # replica reads fall back to the primary while replay lag is above this or unknown
+    replica_max_lag_s: float = Field(default_factory=lambda: float(os.getenv("REPLICA_MAX_LAG_S", "1")))
+    replica_lag_check_s: float = Field(default_factory=lambda: float(os.getenv("REPLICA_LAG_CHECK_S", "0.5")))
 
     redis_url: str = Field(default_factory=lambda: os.getenv("REDIS_URL", "redis://redis:6379/0"))
 
+    # fast path: skip gateway idempotency/account checks and let the ledger dedupe
+    # on idempotency_key inside its transfer transaction
+    transfer_fast_path: bool = Field(default_factory=lambda: os.getenv("TRANSFER_FAST_PATH", "0") == "1")
+    # take Redis account locks around the ledger call
+    gateway_account_locks: bool = Field(default_factory=lambda: os.getenv("GATEWAY_ACCOUNT_LOCKS", "1") == "1")
+
+    # bounded wait for contended account locks (0 = fail fast with 409)
+    lock_wait_ms: int = Field(default_factory=lambda: int(os.getenv("LOCK_WAIT_MS", "0")))
+
     ledger_grpc_target: str = Field(default_factory=lambda: os.getenv("LEDGER_GRPC_TARGET", "localhost:50051"))
+    # comma-separated ledger shard targets, in shard order; empty = one ledger at ledger_grpc_target
+    ledger_shard_targets: str = Field(default_factory=lambda: os.getenv("LEDGER_SHARD_TARGETS", ""))
+    # connections per ledger shard; a multi-process ledger (SO_REUSEPORT) balances per connection
+    ledger_channels: int = Field(default_factory=lambda: int(os.getenv("LEDGER_CHANNELS", "1")))
+    # cross-shard transfers left unfinished this long are completed by the recovery loop
+    shard_recovery_grace_s: float = Field(default_factory=lambda: float(os.getenv("SHARD_RECOVERY_GRACE_S", "30")))
+    shard_recovery_interval_s: float = Field(default_factory=lambda: float(os.getenv("SHARD_RECOVERY_INTERVAL_S", "5")))
     notify_grpc_target: str = Field(default_factory=lambda: os.getenv("NOTIFY_GRPC_TARGET", "notifications:50052"))
 
+    # how long duplicate /transfer requests wait for the in-flight original
+    idempotency_wait_timeout_s: float = Field(default_factory=lambda: float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT_S", "10")))
+    # an IN_PROGRESS key older than this (its gateway died mid-request) can be re-claimed
+    idempotency_lease_s: float = Field(default_factory=lambda: float(os.getenv("IDEMPOTENCY_LEASE_S", "60")))
+
+    account_cache_size: int = Field(default_factory=lambda: int(os.getenv("ACCOUNT_CACHE_SIZE", "100000")))
+    account_cache_ttl_s: float = Field(default_factory=lambda: float(os.getenv("ACCOUNT_CACHE_TTL_S", "300")))
+    account_cache_negative_ttl_s: float = Field(default_factory=lambda: float(os.getenv("ACCOUNT_CACHE_NEGATIVE_TTL_S", "5")))
+    account_bloom_enabled: bool = Field(default_factory=lambda: os.getenv("ACCOUNT_BLOOM_ENABLED", "0") == "1")
+
+    # Redis balance cache for GET /balance, written through from transfer responses
+    balance_cache_enabled: bool = Field(default_factory=lambda: os.getenv("BALANCE_CACHE_ENABLED", "1") == "1")
+    balance_cache_ttl_s: float = Field(default_factory=lambda: float(os.getenv("BALANCE_CACHE_TTL_S", "60")))
+
+    # notification outbox dispatcher
+    outbox_batch_size: int = Field(default_factory=lambda: int(os.getenv("OUTBOX_BATCH_SIZE", "100")))
+    outbox_rpc_batch_size: int = Field(default_factory=lambda: int(os.getenv("OUTBOX_RPC_BATCH_SIZE", "25")))
+    outbox_concurrency: int = Field(default_factory=lambda: int(os.getenv("OUTBOX_CONCURRENCY", "16")))
+    outbox_poll_interval_s: float = Field(default_factory=lambda: float(os.getenv("OUTBOX_POLL_INTERVAL_S", "1")))
+    outbox_lease_s: float = Field(default_factory=lambda: float(os.getenv("OUTBOX_LEASE_S", "30")))
+    outbox_max_attempts: int = Field(default_factory=lambda: int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10")))
+    outbox_max_backoff_s: float = Field(default_factory=lambda: float(os.getenv("OUTBOX_MAX_BACKOFF_S", "300")))
+    outbox_backlog_interval_s: float = Field(default_factory=lambda: float(os.getenv("OUTBOX_BACKLOG_INTERVAL_S", "5")))
+
+    # tracing: head sampling rate for new traces, JSON-lines file and/or OTLP/HTTP endpoint for sampled spans
+    trace_sample_rate: float = Field(default_factory=lambda: float(os.getenv("TRACE_SAMPLE_RATE", "0")))
+    trace_file: str = Field(default_factory=lambda: os.getenv("TRACE_FILE", ""))
+    trace_otlp_endpoint: str = Field(default_factory=lambda: os.getenv("TRACE_OTLP_ENDPOINT", ""))
+
+    # /admin/* endpoints require this in X-Admin-Token; empty = admin endpoints disabled
+    admin_token: str = Field(default_factory=lambda: os.getenv("ADMIN_TOKEN", ""))
+    # write a profile of every request slower than this (0 = off) into profile_dir
+    profile_slow_request_ms: float = Field(default_factory=lambda: float(os.getenv("PROFILE_SLOW_REQUEST_MS", "0")))
+    profile_dir: str = Field(default_factory=lambda: os.getenv("PROFILE_DIR", "/tmp/profiles"))
+    # log event-loop blocks longer than this, with the blocking stack (0 = off)
+    loop_block_threshold_ms: float = Field(default_factory=lambda: float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100")))
+
     api_host: str = Field(default_factory=lambda: os.getenv("API_HOST", "0.0.0.0"))
     api_port: int = Field(default_factory=lambda: int(os.getenv("API_PORT", "8000")))
 
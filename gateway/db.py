@@ -2,27 +2,46 @@
 
 We maintain lightweight access to Postgres for:
   * idempotency key table
-  * accounts table read (for validation)
+  * accounts table read (for validation), fronted by an in-process LRU/TTL cache
+    with negative entries, an optional Bloom filter and Redis-driven invalidation
+  * the list endpoints, served from a streaming read replica when one is
+    configured and within ``replica_max_lag_s`` of the primary
 
 The actual ledger writes are done by the ledger gRPC service; however we do a quick existence
 check here so we can return 400 quickly instead of calling ledger for obviously bad input.
 """
 
+import asyncio
+import hashlib
+import math
+import time
 import uuid
-from typing import Optional
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from loguru import logger
 
 from sqlalchemy import (
-    MetaData, Table, Column, String, BigInteger, DateTime, text, select, insert, JSON as SA_JSON
+    MetaData, Table, Column, Index, String, BigInteger, Boolean, Integer, DateTime, text, select, func, tuple_, event,
+    JSON as SA_JSON
 )
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
+from common import metrics, tracing
+
 from .config import settings
+from . import redis_lock
 
 DATABASE_URL = (
     f"postgresql+asyncpg://{settings.postgres_user}:{settings.postgres_password}"
     f"@{settings.postgres_host}:{settings.postgres_port}/{settings.postgres_db}"
 )
+READ_DATABASE_URL = (
+    f"postgresql+asyncpg://{settings.postgres_user}:{settings.postgres_password}"
+    f"@{settings.postgres_read_host}:{settings.postgres_read_port}/{settings.postgres_db}"
+)
 
 metadata = MetaData()
 
@@ -33,6 +52,9 @@ accounts = Table(
     Column("currency", String, nullable=False, server_default=text("'INR'")),
     Column("start_balance", BigInteger, nullable=False, server_default=text("0")),
     Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+    # > 0: hot account, credited through per-bucket sub-balances (see ledger/crud.py)
+    Column("hot_buckets", Integer, nullable=False, server_default=text("0")),
+    Index("idx_accounts_created", "created_at", "id"),
 )
 
 idempotency_keys = Table(
@@ -42,6 +64,11 @@ idempotency_keys = Table(
     Column("status", String, nullable=False, server_default=text("'IN_PROGRESS'")),
     Column("response", SA_JSON, nullable=True),
     Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+    # when the current owner claimed the key; an IN_PROGRESS row older than
+    # ``idempotency_lease_s`` belongs to a dead request and can be taken over
+    Column("claimed_at", DateTime(timezone=True), nullable=False, server_default=text("now()")),
+    Index("idx_idem_created", "created_at", "key"),
+    Index("idx_idem_status_created", "status", "created_at", "key"),
 )
 
 notifications = Table(
@@ -54,15 +81,113 @@ notifications = Table(
     Column("currency", String, nullable=False),
     Column("message", String, nullable=False),
     Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+    # transactional outbox state, see gateway/outbox.py
+    Column("status", String, nullable=False, server_default=text("'PENDING'")),
+    Column("attempts", Integer, nullable=False, server_default=text("0")),
+    Column("next_attempt_at", DateTime(timezone=True), nullable=False, server_default=text("now()")),
+    Column("delivered_at", DateTime(timezone=True), nullable=True),
+    Column("last_error", String, nullable=True),
+    Index("idx_notif_created", "created_at", "id"),
+    Index("idx_notif_acct_created", "account_id", "created_at", "id"),
+    Index("idx_notif_pending", "next_attempt_at", postgresql_where=text("status = 'PENDING'")),
+)
+
+# recovery log of cross-shard transfers, see gateway/sharding.py
+shard_transfers = Table(
+    "shard_transfers", metadata,
+    Column("tx_id", String, primary_key=True),
+    Column("idempotency_key", String, nullable=True),
+    Column("from_account", String, nullable=False),
+    Column("to_account", String, nullable=False),
+    Column("amount", BigInteger, nullable=False),
+    Column("currency", String, nullable=False),
+    Column("from_shard", Integer, nullable=False),
+    Column("to_shard", Integer, nullable=False),
+    Column("state", String, nullable=False, server_default=text("'PREPARING'")),
+    Column("message", String, nullable=True),
+    Column("from_balance_after", BigInteger, nullable=True),
+    Column("to_balance_after", BigInteger, nullable=True),
+    Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+    Column("updated_at", DateTime(timezone=True), server_default=text("now()")),
+    # a key can be retried once its earlier attempt aborted
+    Index(
+        "uq_shard_transfers_key", "idempotency_key", unique=True,
+        postgresql_where=text("state <> 'ABORTED'"),
+    ),
+    Index(
+        "idx_shard_transfers_open", "updated_at",
+        postgresql_where=text("state IN ('PREPARING', 'COMMITTING', 'ABORTING')"),
+    ),
 )
 
+# Columns added after the table first shipped; create_all does not alter existing tables.
+# Rows written before the outbox existed were already sent fire-and-forget.
+_UPGRADES = [
+    "ALTER TABLE notifications ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'DELIVERED'",
+    "ALTER TABLE notifications ALTER COLUMN status SET DEFAULT 'PENDING'",
+    "ALTER TABLE notifications ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE notifications ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+    "ALTER TABLE notifications ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMPTZ",
+    "ALTER TABLE notifications ADD COLUMN IF NOT EXISTS last_error TEXT",
+    "ALTER TABLE accounts ADD COLUMN IF NOT EXISTS hot_buckets INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+]
+
 _engine: Optional[AsyncEngine] = None
 _async_session = None
+_read_engine: Optional[AsyncEngine] = None
+_read_session = None
+# last sampled replay lag; None = not checked yet or replica unreachable
+_replica_lag: Optional[float] = None
+
+db_query_seconds = metrics.Histogram(
+    "gateway_db_query_seconds", "Postgres statement latency by statement type",
+)
+db_pool_connections = metrics.Gauge(
+    "gateway_db_pool_connections", "Connections in the SQLAlchemy pool by state",
+)
+db_reads_total = metrics.Counter(
+    "gateway_db_reads_total", "Read-only sessions by target (replica, primary) and routing reason",
+)
+replica_lag_seconds = metrics.Gauge(
+    "gateway_replica_lag_seconds", "Read replica replay lag at the last check (-1 = unreachable)",
+)
+
+def _instrument(engine: AsyncEngine):
+    # the async driver runs inside these hooks, so the span covers the round trip
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        op = statement.lstrip().split(None, 1)[0].upper()
+        s = tracing.span(f"db {op}", kind=tracing.CLIENT, **{"db.statement": statement[:500]})
+        conn.info.setdefault("query_start", []).append((time.perf_counter(), op, s))
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        start, op, s = conn.info["query_start"].pop()
+        db_query_seconds.observe(time.perf_counter() - start, op=op)
+        s.end()
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _error(exc_context):
+        conn = exc_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            _, _, s = conn.info["query_start"].pop()
+            s.fail(str(exc_context.original_exception))
+            s.end()
+
+@metrics.on_collect
+def _sample_pool():
+    for role, engine in (("primary", _engine), ("replica", _read_engine)):
+        if engine is not None:
+            pool = engine.pool
+            db_pool_connections.set(pool.checkedout(), state="checked_out", role=role)
+            db_pool_connections.set(pool.checkedin(), state="idle", role=role)
 
 async def get_engine() -> AsyncEngine:
     global _engine
     if _engine is None:
         _engine = create_async_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
+        _instrument(_engine)
     return _engine
 
 async def get_session() -> AsyncSession:
@@ -72,38 +197,314 @@ async def get_session() -> AsyncSession:
         _async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
     return _async_session()
 
+async def get_read_engine() -> AsyncEngine:
+    global _read_engine
+    if _read_engine is None:
+        _read_engine = create_async_engine(READ_DATABASE_URL, echo=False, pool_pre_ping=True)
+        _instrument(_read_engine)
+    return _read_engine
+
+def _read_route(consistent: bool) -> str:
+    """Why a read goes to the primary, or ``ok`` for the replica."""
+    if consistent:
+        return "consistent"
+    if not settings.postgres_read_host:
+        return "no_replica"
+    if _replica_lag is None:
+        return "unreachable"
+    if _replica_lag > settings.replica_max_lag_s:
+        return "lagging"
+    return "ok"
+
+async def get_read_session(consistent: bool = False) -> AsyncSession:
+    """Session for read-only queries: the replica while it is within ``replica_max_lag_s``, else the primary.
+
+    ``consistent`` forces the primary, for callers that must see their own writes.
+    """
+    global _read_session
+    route = _read_route(consistent)
+    if route != "ok":
+        db_reads_total.inc(target="primary", reason=route)
+        return await get_session()
+    db_reads_total.inc(target="replica", reason=route)
+    if _read_session is None:
+        engine = await get_read_engine()
+        _read_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    return _read_session()
+
+# an idle primary sends no new WAL, so a replica that has replayed everything it received is current
+_REPLICA_LAG_SQL = text("""
+SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                     ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0)
+""")
+
+async def _sample_replica_lag() -> float:
+    engine = await get_read_engine()
+    async with engine.connect() as conn:
+        return float((await conn.execute(_REPLICA_LAG_SQL)).scalar_one())
+
+async def monitor_replica():
+    """Sample the replica's replay lag every ``replica_lag_check_s``; get_read_session routes on the last sample."""
+    global _replica_lag
+    while True:
+        try:
+            lag = await asyncio.wait_for(_sample_replica_lag(), timeout=max(2.0, settings.replica_lag_check_s))
+        except Exception as e:
+            if _replica_lag is not None:
+                logger.warning(f"Read replica unreachable, reading from the primary: {e!r}")
+            lag = None
+        if lag is not None and _replica_lag is None:
+            logger.info(f"Read replica available (lag {lag:.3f}s)")
+        _replica_lag = lag
+        replica_lag_seconds.set(-1 if lag is None else lag)
+        await asyncio.sleep(settings.replica_lag_check_s)
+
+def _create_all(sync_conn):
+    metadata.create_all(sync_conn)
+    for stmt in _UPGRADES:
+        sync_conn.execute(text(stmt))
+    # create_all skips indexes on tables that already exist (e.g. created by the ledger)
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
 async def ensure_tables_exist():
     # This only creates tables if missing; ledger service also applies migrations.
     engine = await get_engine()
     async with engine.begin() as conn:
-        await conn.run_sync(metadata.create_all)
+        await conn.run_sync(_create_all)
 
-async def account_exists(account_id: str) -> bool:
-    async with await get_session() as session:
-        q = select(accounts.c.id).where(accounts.c.id == account_id)
+async def list_page(
+    table: Table,
+    key_col: str,
+    limit: int,
+    cursor: Optional[Tuple[datetime, str]] = None,
+    filters: Sequence = (),
+    consistent: bool = False,
+) -> Tuple[List[dict], Optional[Tuple[datetime, str]]]:
+    """Keyset page over ``table`` ordered by (created_at, key_col), read from the replica unless ``consistent``.
+
+    Returns the rows and the (created_at, key) position of the last one when more
+    rows may follow, else None.
+    """
+    created_at, key = table.c.created_at, table.c[key_col]
+    q = select(table).where(*filters).order_by(created_at, key).limit(limit + 1)
+    if cursor is not None:
+        q = q.where(tuple_(created_at, key) > tuple_(*cursor))
+    async with await get_read_session(consistent) as session:
         res = await session.execute(q)
-        return res.scalar_one_or_none() is not None
+        rows = [dict(r) for r in res.mappings().all()]
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]["created_at"], rows[-1][key_col])
 
-async def get_account_currency(account_id: str) -> Optional[str]:
+# --- account metadata cache -------------------------------------------------
+
+ACCOUNTS_CHANGED_CHANNEL = "accounts:changed"
+
+class _BloomFilter:
+    """Fixed-size Bloom filter over account ids (no false negatives)."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+class AccountMeta(NamedTuple):
+    currency: str
+    hot_buckets: int = 0
+
+class AccountCache:
+    """Bounded LRU of account id -> AccountMeta (None = known missing) with per-entry TTL."""
+
+    def __init__(self, max_size: int, ttl_s: float, negative_ttl_s: float):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        self._entries: "OrderedDict[str, Tuple[Optional[AccountMeta], float]]" = OrderedDict()
+        self.bloom: Optional[_BloomFilter] = None
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.bloom_rejects = 0
+
+    def get(self, account_id: str):
+        """Return (found, meta); found is False on a miss."""
+        entry = self._entries.get(account_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[account_id]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(account_id)
+        if entry[0] is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, entry[0]
+
+    def put(self, account_id: str, meta: Optional[AccountMeta]):
+        ttl = self.ttl_s if meta is not None else self.negative_ttl_s
+        self._entries[account_id] = (meta, time.monotonic() + ttl)
+        self._entries.move_to_end(account_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, account_id: Optional[str] = None):
+        if account_id is None:
+            self._entries.clear()
+            return
+        self._entries.pop(account_id, None)
+        if self.bloom is not None:
+            self.bloom.add(account_id)
+
+    def stats(self) -> dict:
+        return dict(
+            size=len(self._entries), hits=self.hits, misses=self.misses,
+            negative_hits=self.negative_hits, bloom_rejects=self.bloom_rejects,
+        )
+
+account_cache = AccountCache(
+    max_size=settings.account_cache_size,
+    ttl_s=settings.account_cache_ttl_s,
+    negative_ttl_s=settings.account_cache_negative_ttl_s,
+)
+
+async def warm_account_cache():
+    """Bulk-load account metadata (and the Bloom filter, if enabled) at startup."""
     async with await get_session() as session:
-        q = select(accounts.c.currency).where(accounts.c.id == account_id)
-        res = await session.execute(q)
-        return res.scalar_one_or_none()
+        if settings.account_bloom_enabled:
+            count = (await session.execute(select(func.count()).select_from(accounts))).scalar_one()
+            bloom = _BloomFilter(int(count * 1.5) + 1024)
+        else:
+            bloom = None
+        result = await session.stream(
+            select(accounts.c.id, accounts.c.currency, accounts.c.hot_buckets).execution_options(yield_per=5000)
+        )
+        loaded = 0
+        async for acct_id, currency, hot_buckets in result:
+            if bloom is not None:
+                bloom.add(acct_id)
+            if loaded < account_cache.max_size:
+                account_cache.put(acct_id, AccountMeta(currency, hot_buckets))
+                loaded += 1
+    account_cache.bloom = bloom
+    logger.info(f"Account cache warmed with {loaded} account(s); bloom={'on' if bloom else 'off'}")
 
-async def create_idempotency_record(key: str, tx_id: Optional[str] = None, status: str = "IN_PROGRESS"):
-    from sqlalchemy.exc import IntegrityError
+async def listen_account_invalidations():
+    """Drop cache entries named on ``accounts:changed`` ("*" clears everything)."""
+    r = await redis_lock.get_redis()
+    pubsub = r.pubsub()
+    await pubsub.subscribe(ACCOUNTS_CHANGED_CHANNEL)
+    try:
+        async for msg in pubsub.listen():
+            if msg["type"] != "message":
+                continue
+            account_cache.invalidate(None if msg["data"] == "*" else msg["data"])
+    finally:
+        await pubsub.aclose()
 
+async def publish_account_changed(account_id: Optional[str] = None):
+    r = await redis_lock.get_redis()
+    await r.publish(ACCOUNTS_CHANGED_CHANNEL, account_id or "*")
+
+async def get_account_meta(account_id: str) -> Optional[AccountMeta]:
+    found, meta = account_cache.get(account_id)
+    if found:
+        return meta
+    bloom = account_cache.bloom
+    if bloom is not None and account_id not in bloom:
+        account_cache.bloom_rejects += 1
+        return None
     async with await get_session() as session:
-        try:
-            stmt = insert(idempotency_keys).values(key=key, tx_id=tx_id, status=status)
-            await session.execute(stmt)
+        q = select(accounts.c.currency, accounts.c.hot_buckets).where(accounts.c.id == account_id)
+        row = (await session.execute(q)).first()
+    meta = AccountMeta(row.currency, row.hot_buckets) if row is not None else None
+    account_cache.put(account_id, meta)
+    return meta
+
+async def get_account_currency(account_id: str) -> Optional[str]:
+    meta = await get_account_meta(account_id)
+    return meta.currency if meta is not None else None
+
+async def is_hot_account(account_id: str) -> bool:
+    meta = await get_account_meta(account_id)
+    return meta is not None and meta.hot_buckets > 0
+
+async def account_exists(account_id: str) -> bool:
+    return await get_account_currency(account_id) is not None
+
+# One statement: claim the key (or re-claim a FAILED one, or an IN_PROGRESS one
+# whose owner has not finished within the lease) and otherwise return the
+# current owner's row. A row committed by a concurrent claimer after this
+# statement's snapshot conflicts on insert but is invisible to the SELECT arm,
+# so an empty result means "retry". The new claimed_at is the owner's token:
+# releasing and finalizing only apply while it is still current. Taking over a
+# live owner's key is safe because the gateway always asks the ledger to dedupe.
+_CLAIM_SQL = text("""
+WITH claimed AS (
+    INSERT INTO idempotency_keys (key, status) VALUES (:key, 'IN_PROGRESS')
+    ON CONFLICT (key) DO UPDATE
+        SET status = 'IN_PROGRESS', tx_id = NULL, response = NULL, created_at = now(), claimed_at = now()
+        WHERE idempotency_keys.status = 'FAILED'
+           OR (idempotency_keys.status = 'IN_PROGRESS'
+               AND idempotency_keys.claimed_at < now() - make_interval(secs => :lease_s))
+    RETURNING key, claimed_at
+)
+SELECT TRUE AS claimed, NULL AS status, NULL AS response, claimed_at AS token FROM claimed
+UNION ALL
+SELECT FALSE, status, response, NULL FROM idempotency_keys
+WHERE key = :key AND NOT EXISTS (SELECT 1 FROM claimed)
+""").columns(claimed=Boolean, status=String, response=SA_JSON, token=DateTime(timezone=True))
+
+async def claim_idempotency_record(key: str, attempts: int = 3) -> Optional[dict]:
+    """Atomically claim ``key``; returns {claimed, status, response, token} or None if unresolved."""
+    params = {"key": key, "lease_s": settings.idempotency_lease_s}
+    async with await get_session() as session:
+        for _ in range(attempts):
+            res = await session.execute(_CLAIM_SQL, params)
+            row = res.mappings().first()
             await session.commit()
-        except IntegrityError:
-            # Idempotency key already exists, which is fine
-            await session.rollback()
-        except Exception:
-            await session.rollback()
-            raise
+            if row is not None:
+                return dict(row)
+    return None
+
+def _owned(key: str, token):
+    return (
+        idempotency_keys.c.key == key,
+        idempotency_keys.c.status == "IN_PROGRESS",
+        idempotency_keys.c.claimed_at == token,
+    )
+
+async def release_idempotency_record(key: str, token) -> bool:
+    """Drop a claim whose transfer never reached the ledger so the client can retry.
+
+    False if the claim was taken over in the meantime (the row is then left alone).
+    """
+    async with await get_session() as session:
+        res = await session.execute(idempotency_keys.delete().where(*_owned(key, token)))
+        await session.commit()
+        return res.rowcount == 1
+
+async def enqueue_notifications(rows: Sequence[dict]):
+    async with await get_session() as session:
+        await session.execute(notifications.insert(), list(rows))
+        await session.commit()
 
 async def get_idempotency_record(key: str):
     async with await get_session() as session:
@@ -112,12 +513,82 @@ async def get_idempotency_record(key: str):
         row = res.mappings().first()
         return dict(row) if row else None
 
-async def finalize_idempotency_record(key: str, status: str, tx_id: Optional[str], response_obj):
+async def finalize_idempotency_record(
+    key: str, token, status: str, tx_id: Optional[str], response_obj, outbox_rows: Sequence[dict] = ()
+) -> bool:
+    """Store the final response; any notification rows are enqueued in the same transaction.
+
+    False, with nothing written, if another request has taken the claim over
+    since ``token``; that request finalizes the key instead.
+    """
     async with await get_session() as session:
         stmt = (
             idempotency_keys.update()
-            .where(idempotency_keys.c.key == key)
+            .where(*_owned(key, token))
             .values(status=status, tx_id=tx_id, response=response_obj)
         )
-        await session.execute(stmt)
+        res = await session.execute(stmt)
+        if res.rowcount != 1:
+            await session.rollback()
+            return False
+        if outbox_rows:
+            await session.execute(notifications.insert(), list(outbox_rows))
+        await session.commit()
+        return True
+
+# --- cross-shard transfer log -------------------------------------------------
+
+_SHARD_TRANSFER_INSERT_SQL = text("""
+INSERT INTO shard_transfers (tx_id, idempotency_key, from_account, to_account, amount, currency, from_shard, to_shard)
+VALUES (:tx_id, :idempotency_key, :from_account, :to_account, :amount, :currency, :from_shard, :to_shard)
+ON CONFLICT (idempotency_key) WHERE state <> 'ABORTED' DO NOTHING
+RETURNING tx_id
+""")
+
+_SHARD_TRANSFER_STALLED_SQL = text("""
+UPDATE shard_transfers t SET updated_at = now()
+WHERE t.tx_id IN (
+    SELECT tx_id FROM shard_transfers
+    WHERE state IN ('PREPARING', 'COMMITTING', 'ABORTING')
+      AND updated_at < now() - make_interval(secs => :grace_s)
+    ORDER BY updated_at
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING t.*
+""")
+
+async def log_shard_transfer(row: dict) -> Optional[dict]:
+    """Insert a PREPARING log row; returns the live row holding the same idempotency key instead, if any."""
+    async with await get_session() as session:
+        res = await session.execute(_SHARD_TRANSFER_INSERT_SQL, row)
+        inserted = res.scalar_one_or_none()
+        await session.commit()
+        if inserted is not None:
+            return None
+        q = select(shard_transfers).where(
+            shard_transfers.c.idempotency_key == row["idempotency_key"], shard_transfers.c.state != "ABORTED"
+        )
+        existing = (await session.execute(q)).mappings().first()
+        # an abort landing between the two statements frees the key; treat as in flight
+        return dict(existing) if existing else dict(row, state="PREPARING")
+
+async def transition_shard_transfer(tx_id: str, from_states: Sequence[str], to_state: str, **values) -> bool:
+    """Compare-and-set the state of a logged transfer; False if it was not in ``from_states``."""
+    async with await get_session() as session:
+        stmt = (
+            shard_transfers.update()
+            .where(shard_transfers.c.tx_id == tx_id, shard_transfers.c.state.in_(list(from_states)))
+            .values(state=to_state, updated_at=func.now(), **values)
+        )
+        res = await session.execute(stmt)
+        await session.commit()
+        return res.rowcount == 1
+
+async def claim_stalled_shard_transfers(grace_s: float, limit: int = 100) -> List[dict]:
+    """Lease unfinished transfers older than ``grace_s`` (bumps updated_at so replicas skip them)."""
+    async with await get_session() as session:
+        res = await session.execute(_SHARD_TRANSFER_STALLED_SQL, {"grace_s": grace_s, "limit": limit})
+        rows = [dict(r) for r in res.mappings()]
         await session.commit()
+        return rows
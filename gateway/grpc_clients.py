@@ -1,22 +1,63 @@
+import heapq
+import itertools
+import time
+from datetime import datetime
+from typing import List
+
 import grpc
 
+from common import metrics, tracing
+
 from .config import settings
+from . import utils
 
 # generated stubs live in gateway/ (installed at build step)
 from . import payment_pb2
 from . import payment_pb2_grpc
 
-_ledger_channel = None
-_ledger_stub = None
+_ledger_channels: List = []
+_ledger_stubs: List = []
 _notify_channel = None
 _notify_stub = None
 
-async def get_ledger_stub():
-    global _ledger_channel, _ledger_stub
-    if _ledger_stub is None:
-        _ledger_channel = grpc.aio.insecure_channel(settings.ledger_grpc_target)
-        _ledger_stub = payment_pb2_grpc.LedgerServiceStub(_ledger_channel)
-    return _ledger_stub
+ledger_rpc_seconds = metrics.Histogram(
+    "gateway_ledger_rpc_seconds", "Ledger RPC latency by shard and method",
+)
+notify_rpc_seconds = metrics.Histogram(
+    "gateway_notify_rpc_seconds", "Notification RPC latency by method",
+)
+ledger_transfers_total = metrics.Counter(
+    "gateway_ledger_transfers_total", "Transfers per ledger shard by kind (local/cross) and status",
+)
+
+def ledger_targets() -> List[str]:
+    targets = [t.strip() for t in settings.ledger_shard_targets.split(",") if t.strip()]
+    return targets or [settings.ledger_grpc_target]
+
+def shard_of(account_id: str) -> int:
+    return utils.shard_for(account_id, len(ledger_targets()))
+
+async def get_ledger_stub(shard: int = 0):
+    """A stub for ``shard``, round-robin over ``ledger_channels`` separate connections."""
+    if not _ledger_stubs:
+        for target in ledger_targets():
+            stubs = []
+            for _ in range(max(1, settings.ledger_channels)):
+                # a local subchannel pool keeps channels to the same target on distinct connections
+                channel = grpc.aio.insecure_channel(target, options=[("grpc.use_local_subchannel_pool", 1)])
+                _ledger_channels.append(channel)
+                stubs.append(payment_pb2_grpc.LedgerServiceStub(channel))
+            _ledger_stubs.append(itertools.cycle(stubs))
+    return next(_ledger_stubs[shard])
+
+async def _ledger_call(shard: int, method: str, req):
+    stub = await get_ledger_stub(shard)
+    t0 = time.perf_counter()
+    try:
+        with tracing.span(f"LedgerService/{method}", kind=tracing.CLIENT, shard=shard):
+            return await getattr(stub, method)(req, metadata=tracing.metadata())
+    finally:
+        ledger_rpc_seconds.observe(time.perf_counter() - t0, shard=str(shard), method=method)
 
 async def get_notify_stub():
     global _notify_channel, _notify_stub
@@ -26,23 +67,77 @@ async def get_notify_stub():
     return _notify_stub
 
 async def ledger_transfer(**kwargs):
-    stub = await get_ledger_stub()
-    req = payment_pb2.TransferRequest(**kwargs)
-    resp = await stub.Transfer(req)
+    """Route a transfer to the shard owning both accounts, or run it as a cross-shard transfer."""
+    from_shard = shard_of(kwargs["from_account"])
+    to_shard = shard_of(kwargs["to_account"])
+    if from_shard == to_shard:
+        resp = await _ledger_call(from_shard, "Transfer", payment_pb2.TransferRequest(**kwargs))
+        ledger_transfers_total.inc(shard=str(from_shard), kind="local", status=resp.status)
+        return resp
+    from . import sharding  # the coordinator calls back into this module
+    resp = await sharding.cross_shard_transfer(from_shard, to_shard, **kwargs)
+    for shard in (from_shard, to_shard):
+        ledger_transfers_total.inc(shard=str(shard), kind="cross", status=resp.status)
     return resp
 
-async def ledger_get_balance(account_id: str):
-    stub = await get_ledger_stub()
-    req = payment_pb2.BalanceRequest(account_id=account_id)
-    resp = await stub.GetBalance(req)
-    return resp
+async def ledger_leg(shard: int, method: str, **leg):
+    """ReserveLeg / CommitLeg / AbortLeg on one shard."""
+    return await _ledger_call(shard, method, payment_pb2.LegRequest(**leg))
 
-async def ledger_get_all_entries():
-    stub = await get_ledger_stub()
-    req = payment_pb2.GetAllRequest()
-    resp = await stub.GetAllEntries(req)
-    return resp
+async def ledger_get_balance(account_id: str, consistent: bool = False, min_version: int = 0):
+    req = payment_pb2.BalanceRequest(account_id=account_id, consistent=consistent, min_version=min_version)
+    return await _ledger_call(shard_of(account_id), "GetBalance", req)
 
+async def ledger_get_balance_at(account_id: str, at: str, consistent: bool = False):
+    req = payment_pb2.BalanceAtRequest(account_id=account_id, at=at, consistent=consistent)
+    return await _ledger_call(shard_of(account_id), "GetBalanceAt", req)
+
+async def ledger_get_statement(
+    account_id: str, since: str = "", until: str = "", cursor: str = "", limit: int = 0, consistent: bool = False,
+):
+    req = payment_pb2.StatementRequest(
+        account_id=account_id, since=since, until=until, cursor=cursor, limit=limit, consistent=consistent,
+    )
+    return await _ledger_call(shard_of(account_id), "GetStatement", req)
+
+async def ledger_export_entries(since: str = "", account_id: str = "", page_size: int = 0, consistent: bool = False):
+    """Async iterator over LedgerEntry messages from the server-streaming export.
+
+    An account export comes from the account's shard; a full export merges every
+    shard's stream by (created_at, entry_id). Cross-shard transfers are exported
+    by the debit side's shard only.
+    """
+    req = payment_pb2.ExportEntriesRequest(
+        since=since, account_id=account_id, page_size=page_size, consistent=consistent
+    )
+    shards = [shard_of(account_id)] if account_id else range(len(ledger_targets()))
+    calls = [(await get_ledger_stub(s)).ExportEntries(req, metadata=tracing.metadata()) for s in shards]
+    try:
+        streams = [call.__aiter__() for call in calls]
+        heap = []
+        for i, stream in enumerate(streams):
+            entry = await anext(stream, None)
+            if entry is not None:
+                heap.append((_export_key(entry), i, entry))
+        heapq.heapify(heap)
+        while heap:
+            _, i, entry = heap[0]
+            yield entry
+            nxt = await anext(streams[i], None)
+            if nxt is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (_export_key(nxt), i, nxt))
+    finally:
+        # a client that disconnects mid-export must not leave the other shards streaming
+        for call in calls:
+            call.cancel()
+
+def _export_key(entry):
+    # created_at is str(datetime): it drops a zero fraction, so it does not sort as a string
+    return datetime.fromisoformat(entry.created_at), entry.entry_id
+
+@metrics.timed(notify_rpc_seconds, method="Notify")
 async def send_notification(account_id: str, tx_id: str, amount: int, direction: str, currency: str, message: str):
     stub = await get_notify_stub()
     req = payment_pb2.NotificationRequest(
@@ -53,4 +148,16 @@ async def send_notification(account_id: str, tx_id: str, amount: int, direction:
         currency=currency,
         message=message,
     )
-    await stub.Notify(req)
+    with tracing.span("NotificationService/Notify", kind=tracing.CLIENT):
+        await stub.Notify(req, metadata=tracing.metadata())
+
+@metrics.timed(notify_rpc_seconds, method="NotifyBatch")
+async def send_notification_batch(notifications):
+    """Send many notifications (dicts with NotificationRequest fields) in one RPC."""
+    stub = await get_notify_stub()
+    req = payment_pb2.NotificationBatchRequest(
+        notifications=[payment_pb2.NotificationRequest(**n) for n in notifications]
+    )
+    with tracing.span("NotificationService/NotifyBatch", kind=tracing.CLIENT, notifications=len(req.notifications)):
+        resp = await stub.NotifyBatch(req, metadata=tracing.metadata())
+    return resp
@@ -1,17 +1,109 @@
-"""Idempotency utilities bridging the gateway DB + request flow."""
+"""Idempotency utilities bridging the gateway DB + request flow.
 
-from typing import Optional
+Duplicate requests for a key that is already being processed are coalesced:
+within one gateway process they await the original's future, and across
+replicas they wait on a Redis pub/sub message published when the key is
+finalized (falling back to 409 after a timeout).
+"""
 
-from . import db
+import asyncio
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
 
-async def check_idempotency(key: str):
-    rec = await db.get_idempotency_record(key)
-    if not rec:
+from loguru import logger
+
+from . import db, redis_lock
+from .config import settings
+
+# claim outcomes
+OWNER = "OWNER"          # caller inserted the key and must run the transfer
+IN_FLIGHT = "IN_FLIGHT"  # another request holds the key and has not finished
+COMPLETED = "COMPLETED"  # a stored SUCCESS response exists
+
+DONE_CHANNEL_PREFIX = "idem:done:"
+
+_inflight: Dict[str, asyncio.Future] = {}
+
+@dataclass
+class Claim:
+    state: str
+    response: Optional[dict] = None
+    # OWNER only: fences release/finalize against a later owner taking the key over
+    token: Optional[datetime] = None
+
+async def claim_idempotency(key: str) -> Claim:
+    """Claim ``key`` in a single round trip (see db.claim_idempotency_record)."""
+    rec = await db.claim_idempotency_record(key)
+    if rec is None:
+        return Claim(IN_FLIGHT)
+    if rec["claimed"]:
+        return Claim(OWNER, token=rec["token"])
+    if rec["status"] == "SUCCESS" and rec["response"]:
+        return Claim(COMPLETED, rec["response"])
+    return Claim(IN_FLIGHT)
+
+async def release_idempotency(key: str, claim: Claim):
+    if await db.release_idempotency_record(key, claim.token):
+        await _publish_done(key, None)
+
+async def finalize_idempotency(
+    key: str, claim: Claim, status: str, tx_id: Optional[str], response_obj, outbox_rows=()
+) -> bool:
+    """Store the response; False if the claim was taken over (the new owner finalizes)."""
+    if not await db.finalize_idempotency_record(key, claim.token, status, tx_id, response_obj, outbox_rows):
+        logger.warning(f"Idempotency claim on {key} was taken over; leaving it to the new owner")
+        return False
+    await _publish_done(key, response_obj)
+    return True
+
+async def _publish_done(key: str, response_obj: Optional[dict]):
+    # wakes waiters in other gateway replicas; best effort, they also read the DB once
+    try:
+        r = await redis_lock.get_redis()
+        await r.publish(DONE_CHANNEL_PREFIX + key, json.dumps(response_obj))
+    except Exception as e:
+        logger.warning(f"Failed to publish idempotency completion for {key}: {e}")
+
+async def wait_for_completion(key: str, timeout: Optional[float] = None) -> Optional[dict]:
+    """Wait for another replica to finalize ``key``; returns its stored response or None."""
+    timeout = settings.idempotency_wait_timeout_s if timeout is None else timeout
+    r = await redis_lock.get_redis()
+    pubsub = r.pubsub()
+    await pubsub.subscribe(DONE_CHANNEL_PREFIX + key)
+    try:
+        # subscribed first, so a racing finalize is seen either here or on the channel
+        rec = await db.get_idempotency_record(key)
+        if rec and rec["status"] != "IN_PROGRESS" and rec["response"]:
+            return rec["response"]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (remaining := deadline - loop.time()) > 0:
+            msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if msg is not None:
+                return json.loads(msg["data"])
         return None
-    return rec
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+
+async def coalesce(key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """Single-flight: concurrent calls for ``key`` in this process share one ``fn()`` outcome.
 
-async def start_idempotency(key: str):
-    await db.create_idempotency_record(key)
+    ``fn()`` runs in its own task and every caller, the first included, awaits it
+    through ``shield``: a caller that is cancelled (e.g. its client disconnected)
+    stops waiting but neither aborts the transfer nor cancels the other callers.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fn())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _forget(key, t))
+    return await asyncio.shield(task)
 
-async def finalize_idempotency(key: str, status: str, tx_id: Optional[str], response_obj):
-    await db.finalize_idempotency_record(key, status, tx_id, response_obj)
+def _forget(key: str, task: asyncio.Future):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()  # mark retrieved; every caller may have been cancelled
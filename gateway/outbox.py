@@ -0,0 +1,171 @@
+"""Transactional outbox dispatcher for transfer notifications.
+
+``/transfer`` writes its two notification rows as ``PENDING`` in the same
+transaction that finalizes the idempotency key, so nothing is lost if the
+gateway restarts. A background dispatcher in every gateway replica claims due
+rows in batches with ``FOR UPDATE SKIP LOCKED`` (replicas never claim the same
+row), leases them by pushing ``next_attempt_at`` forward, sends them as
+``NotifyBatch`` RPCs with bounded concurrency and marks them ``DELIVERED``. Failures are retried with
+exponential backoff until ``outbox_max_attempts``, then parked as ``FAILED``.
+A dispatcher that dies mid-batch simply lets its lease expire.
+"""
+
+import asyncio
+from typing import List
+
+from loguru import logger
+from sqlalchemy import text
+
+from common import metrics, tracing
+
+from . import db, grpc_clients
+from .config import settings
+
+_CLAIM_SQL = text("""
+UPDATE notifications n
+SET next_attempt_at = now() + make_interval(secs => :lease_s), attempts = n.attempts + 1
+WHERE n.id IN (
+    SELECT id FROM notifications
+    WHERE status = 'PENDING' AND next_attempt_at <= now()
+    ORDER BY next_attempt_at
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING n.id, n.account_id, n.tx_id, n.amount, n.direction, n.currency, n.message, n.attempts
+""")
+
+_DELIVERED_SQL = text("""
+UPDATE notifications SET status = 'DELIVERED', delivered_at = now(), last_error = NULL
+WHERE id = ANY(:ids)
+""")
+
+_RETRY_SQL = text("""
+UPDATE notifications
+SET status = CASE WHEN attempts >= :max_attempts THEN 'FAILED' ELSE 'PENDING' END,
+    next_attempt_at = now() + make_interval(secs => :delay_s),
+    last_error = :error
+WHERE id = :id
+""")
+
+_BACKLOG_SQL = text("SELECT count(*) FROM notifications WHERE status = 'PENDING'")
+
+outbox_sent_total = metrics.Counter(
+    "gateway_outbox_sent_total", "Outbox notifications by delivery outcome",
+)
+outbox_backlog = metrics.Gauge(
+    "gateway_outbox_backlog", "Notifications waiting in the outbox",
+)
+outbox_inflight_rpcs = metrics.Gauge(
+    "gateway_outbox_inflight_rpcs", "NotifyBatch RPCs currently in flight from the dispatcher",
+)
+
+_wakeup = asyncio.Event()
+
+def outbox_rows(grpc_resp) -> List[dict]:
+    """The debit + credit notification rows for a successful transfer."""
+    return [
+        dict(
+            account_id=grpc_resp.from_account,
+            tx_id=grpc_resp.tx_id,
+            amount=grpc_resp.amount,
+            direction="DEBIT",
+            currency=grpc_resp.currency,
+            message=f"Sent {grpc_resp.amount} {grpc_resp.currency} to {grpc_resp.to_account}",
+        ),
+        dict(
+            account_id=grpc_resp.to_account,
+            tx_id=grpc_resp.tx_id,
+            amount=grpc_resp.amount,
+            direction="CREDIT",
+            currency=grpc_resp.currency,
+            message=f"Received {grpc_resp.amount} {grpc_resp.currency} from {grpc_resp.from_account}",
+        ),
+    ]
+
+def notify_enqueued():
+    """Wake the local dispatcher instead of waiting for the next poll."""
+    _wakeup.set()
+
+async def _claim_batch():
+    async with await db.get_session() as session:
+        res = await session.execute(
+            _CLAIM_SQL, {"limit": settings.outbox_batch_size, "lease_s": settings.outbox_lease_s}
+        )
+        rows = res.mappings().all()
+        await session.commit()
+    return rows
+
+_NOTIFY_FIELDS = ("account_id", "tx_id", "amount", "direction", "currency", "message")
+
+async def _send_chunk(chunk, sem: asyncio.Semaphore):
+    # one NotifyBatch RPC per chunk; the chunk succeeds or is retried as a whole
+    async with sem:
+        outbox_inflight_rpcs.inc()
+        try:
+            await grpc_clients.send_notification_batch(
+                [{f: row[f] for f in _NOTIFY_FIELDS} for row in chunk]
+            )
+            return None
+        except Exception as e:
+            return e
+        finally:
+            outbox_inflight_rpcs.dec()
+
+async def dispatch_once() -> int:
+    """Claim and send one batch; returns how many rows were claimed."""
+    rows = await _claim_batch()
+    if not rows:
+        return 0
+    # the originating requests are long gone; each dispatched batch is its own trace
+    with tracing.start_trace("outbox.dispatch", kind=tracing.INTERNAL, rows=len(rows)):
+        sem = asyncio.Semaphore(settings.outbox_concurrency)
+        size = max(1, settings.outbox_rpc_batch_size)
+        chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+        chunk_results = await asyncio.gather(*(_send_chunk(c, sem) for c in chunks))
+        results = [err for chunk, err in zip(chunks, chunk_results) for _ in chunk]
+
+        delivered = [row["id"] for row, err in zip(rows, results) if err is None]
+        async with await db.get_session() as session:
+            if delivered:
+                await session.execute(_DELIVERED_SQL, {"ids": delivered})
+            for row, err in zip(rows, results):
+                if err is None:
+                    continue
+                delay = min(settings.outbox_max_backoff_s, 2 ** (row["attempts"] - 1))
+                await session.execute(_RETRY_SQL, {
+                    "id": row["id"], "max_attempts": settings.outbox_max_attempts,
+                    "delay_s": float(delay), "error": str(err)[:500],
+                })
+                outbox_sent_total.inc(outcome="retry" if row["attempts"] < settings.outbox_max_attempts else "failed")
+                logger.warning(f"Notification {row['id']} attempt {row['attempts']} failed: {err}")
+            await session.commit()
+    outbox_sent_total.inc(len(delivered), outcome="delivered")
+    return len(rows)
+
+async def _refresh_backlog():
+    async with await db.get_session() as session:
+        outbox_backlog.set((await session.execute(_BACKLOG_SQL)).scalar_one())
+
+async def run_dispatcher():
+    """Background loop; drains full batches back to back, otherwise waits for a wakeup or the poll interval."""
+    loop = asyncio.get_running_loop()
+    next_backlog_at = 0.0
+    while True:
+        # cleared before the claim so a row enqueued mid-batch still wakes us
+        _wakeup.clear()
+        try:
+            if loop.time() >= next_backlog_at:
+                await _refresh_backlog()
+                next_backlog_at = loop.time() + settings.outbox_backlog_interval_s
+            claimed = await dispatch_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Outbox dispatcher error: {e}")
+            claimed = 0
+        if claimed >= settings.outbox_batch_size:
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), settings.outbox_poll_interval_s)
+        except asyncio.TimeoutError:
+            pass
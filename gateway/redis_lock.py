@@ -3,53 +3,149 @@
 We acquire locks for *both* accounts involved in a transfer to avoid race conditions.
 Locks auto-expire (safety valve) but we also explicitly release.
 
-We sort account IDs to provide a deterministic lock acquisition ordering across callers,
-which reduces deadlock risk.
+All keys are taken by one Lua script (all or none, one round trip) and released
+by another, so there is no partial acquisition to roll back and no lock-ordering
+deadlock. On contention the caller may wait a bounded time, retrying with
+exponential backoff and full jitter.
 """
 
+import asyncio
+import random
+import time
 import uuid
-from typing import Iterable, Dict
+from typing import Iterable, Dict, Optional
 
 import redis.asyncio as redis
 
+from common import metrics, tracing
+
 from .config import settings
 
 _redis_client = None
 
+redis_op_seconds = metrics.Histogram(
+    "gateway_redis_op_seconds", "Redis command latency by command",
+)
+
+class _TimedRedis(redis.Redis):
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"redis {command}", kind=tracing.CLIENT):
+                return await super().execute_command(*args, **options)
+        finally:
+            redis_op_seconds.observe(time.perf_counter() - start, command=command)
+
 async def get_redis():
     global _redis_client
     if _redis_client is None:
-        _redis_client = redis.from_url(settings.redis_url, decode_responses=True)
+        _redis_client = _TimedRedis.from_url(settings.redis_url, decode_responses=True)
     return _redis_client
 
 LOCK_PREFIX = "acctlock:"
 DEFAULT_TTL_MS = 10_000  # 10s
+BACKOFF_BASE_MS = 2
+BACKOFF_CAP_MS = 50
 
-async def acquire_account_locks(account_ids: Iterable[str], ttl_ms: int = DEFAULT_TTL_MS) -> Dict[str, str]:
-    """Acquire locks for all account_ids; return dict {acct_id: lock_token}. Raises TimeoutError."""
-    r = await get_redis()
-    tokens = {}
-    # sort to avoid deadlock
-    for acct in sorted(account_ids):
-        token = str(uuid.uuid4())
-        ok = await r.set(LOCK_PREFIX + acct, token, nx=True, px=ttl_ms)
-        if not ok:
-            # rollback previously acquired
-            await release_account_locks(tokens)
-            raise TimeoutError(f"Failed to acquire lock for account {acct}")
-        tokens[acct] = token
-    return tokens
+# KEYS = lock keys, ARGV = [token, ttl_ms]; returns 1 if every key was set, else 0
+_ACQUIRE_LUA = """
+for _, key in ipairs(KEYS) do
+  if redis.call('exists', key) == 1 then
+    return 0
+  end
+end
+for _, key in ipairs(KEYS) do
+  redis.call('set', key, ARGV[1], 'PX', ARGV[2])
+end
+return 1
+"""
 
-async def release_account_locks(tokens: Dict[str, str]):
-    r = await get_redis()
-    # lua script to release only if token matches
-    lua = """
-    if redis.call('get', KEYS[1]) == ARGV[1] then
-      return redis.call('del', KEYS[1])
-    else
-      return 0
-    end
+# KEYS = lock keys, ARGV = [token]; deletes only keys still holding our token
+_RELEASE_LUA = """
+local n = 0
+for _, key in ipairs(KEYS) do
+  if redis.call('get', key) == ARGV[1] then
+    n = n + redis.call('del', key)
+  end
+end
+return n
+"""
+
+_acquire_script = None
+_release_script = None
+_acquired_at: Dict[str, float] = {}
+
+lock_wait_seconds = metrics.Histogram(
+    "gateway_lock_wait_seconds", "Time spent acquiring account locks",
+)
+lock_hold_seconds = metrics.Histogram(
+    "gateway_lock_hold_seconds", "Time account locks were held",
+)
+lock_acquire_total = metrics.Counter(
+    "gateway_lock_acquire_total", "Account lock acquisitions by outcome",
+)
+
+async def _scripts():
+    global _acquire_script, _release_script
+    if _acquire_script is None:
+        r = await get_redis()
+        # register_script uses EVALSHA and falls back to EVAL on NOSCRIPT
+        _acquire_script = r.register_script(_ACQUIRE_LUA)
+        _release_script = r.register_script(_RELEASE_LUA)
+    return _acquire_script, _release_script
+
+async def acquire_account_locks(
+    account_ids: Iterable[str], ttl_ms: int = DEFAULT_TTL_MS, wait_ms: Optional[int] = None
+) -> Dict[str, str]:
+    """Acquire locks for all account_ids; return dict {acct_id: lock_token}.
+
+    Retries for up to ``wait_ms`` (default ``settings.lock_wait_ms``) before raising TimeoutError.
     """
+    acquire, _ = await _scripts()
+    accts = sorted(set(account_ids))
+    keys = [LOCK_PREFIX + a for a in accts]
+    token = str(uuid.uuid4())
+    wait_ms = settings.lock_wait_ms if wait_ms is None else wait_ms
+    start = time.monotonic()
+    deadline = start + wait_ms / 1000.0
+    attempt = 0
+    with tracing.span("lock.acquire", accounts=len(accts)) as s:
+        while True:
+            if await acquire(keys=keys, args=[token, ttl_ms]):
+                now = time.monotonic()
+                lock_wait_seconds.observe(now - start)
+                lock_acquire_total.inc(outcome="acquired")
+                s.set(attempts=attempt + 1)
+                _acquired_at[token] = now
+                return {a: token for a in accts}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                lock_wait_seconds.observe(time.monotonic() - start)
+                lock_acquire_total.inc(outcome="timeout")
+                s.set(attempts=attempt + 1)
+                raise TimeoutError(f"Failed to acquire locks for accounts {', '.join(accts)}")
+            backoff = min(BACKOFF_CAP_MS, BACKOFF_BASE_MS * 2 ** attempt) / 1000.0
+            await asyncio.sleep(min(remaining, random.uniform(0, backoff)))
+            attempt += 1
+
+async def release_account_locks(tokens: Dict[str, str]):
+    if not tokens:
+        return
+    _, release = await _scripts()
+    # one token covers every key from a single acquire, but callers may merge dicts
+    by_token: Dict[str, list] = {}
     for acct, token in tokens.items():
-        key = LOCK_PREFIX + acct
-        await r.eval(lua, 1, key, token)
+        by_token.setdefault(token, []).append(LOCK_PREFIX + acct)
+    r = await get_redis()
+    async with r.pipeline(transaction=False) as pipe:
+        for token, keys in by_token.items():
+            await release(keys=keys, args=[token], client=pipe)
+        start = time.perf_counter()
+        with tracing.span("redis PIPELINE", kind=tracing.CLIENT, commands=len(by_token)):
+            await pipe.execute()
+        redis_op_seconds.observe(time.perf_counter() - start, command="PIPELINE")
+    for token in by_token:
+        acquired_at = _acquired_at.pop(token, None)
+        if acquired_at is not None:
+            lock_hold_seconds.observe(time.monotonic() - acquired_at)
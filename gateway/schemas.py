@@ -24,8 +24,28 @@ class TransferOut(BaseModel):
     to_balance_after: int
     status: str
     message: str | None = None
+    # account_balances versions after the transfer; pass as GET /balance?min_version= to read your writes
+    from_version: int = 0
+    to_version: int = 0
 
 class BalanceOut(BaseModel):
     account_id: str
     balance: int
     currency: str
+    version: int = 0
+
+class StatementLineOut(BaseModel):
+    tx_id: str
+    counterparty: str
+    direction: str
+    amount: int
+    balance_after: int
+    created_at: str
+
+class StatementOut(BaseModel):
+    account_id: str
+    currency: str
+    # balance before the first line; each line carries the balance after it
+    opening_balance: int
+    lines: list[StatementLineOut]
+    next_cursor: str | None = None
@@ -0,0 +1,162 @@
+"""Cross-shard transfers: two-phase reserve/commit coordinated by the gateway.
+
+Accounts are spread over the ledger shards by ``utils.shard_for``. A transfer
+whose accounts live on different shards is logged in ``shard_transfers``
+(gateway DB) before any shard is called, and every state change is written
+before the RPCs it implies:
+
+  PREPARING  -> ReserveLeg on both shards (the debit holds the funds, the
+                credit checks the account)
+  COMMITTING -> both legs reserved: CommitLeg on both shards writes each entry
+  ABORTING   -> a reserve failed: AbortLeg on both shards releases the hold
+  COMMITTED / ABORTED
+
+Leg RPCs are idempotent per (tx_id, direction), and states only move by
+compare-and-set, so ``run_recovery`` (in every gateway replica) can finish
+whatever a crashed coordinator left behind: stalled PREPARING and ABORTING rows
+are aborted (presumed abort), stalled COMMITTING rows are committed.
+"""
+
+import asyncio
+import uuid
+
+import grpc
+from loguru import logger
+
+from common import tracing
+
+from . import balance_cache, db, grpc_clients, payment_pb2
+from .config import settings
+
+PREPARING, COMMITTING, ABORTING = "PREPARING", "COMMITTING", "ABORTING"
+COMMITTED, ABORTED = "COMMITTED", "ABORTED"
+
+def _legs(t: dict):
+    debit = dict(
+        tx_id=t["tx_id"], account_id=t["from_account"], direction="DEBIT",
+        amount=t["amount"], currency=t["currency"], counterparty=t["to_account"],
+    )
+    credit = dict(
+        tx_id=t["tx_id"], account_id=t["to_account"], direction="CREDIT",
+        amount=t["amount"], currency=t["currency"], counterparty=t["from_account"],
+    )
+    return (t["from_shard"], debit), (t["to_shard"], credit)
+
+async def _call_legs(t: dict, method: str):
+    """Run ``method`` on both legs concurrently; returns [(ok, response-or-error)].
+
+    The error is the leg's failure message, or the exception the call raised.
+    """
+    with tracing.span(f"2pc {method}", tx_id=t["tx_id"]):
+        results = await asyncio.gather(
+            *(grpc_clients.ledger_leg(shard, method, **leg) for shard, leg in _legs(t)), return_exceptions=True
+        )
+    out = []
+    for r in results:
+        if isinstance(r, BaseException):
+            out.append((False, r))
+        else:
+            out.append((r.ok, r if r.ok else r.message))
+    return out
+
+async def _abort(t: dict, message: str) -> bool:
+    """Release both legs and mark the transfer ABORTED; False if a leg could not be reached."""
+    results = await _call_legs(t, "AbortLeg")
+    if not all(ok for ok, _ in results):
+        logger.warning(f"Abort of cross-shard tx {t['tx_id']} incomplete: {results}; recovery will retry")
+        return False
+    await db.transition_shard_transfer(t["tx_id"], [ABORTING], ABORTED, message=message)
+    # the debit's hold moved its balance, unversioned like a commit
+    await balance_cache.invalidate(t["from_account"], t["to_account"])
+    return True
+
+async def _commit(t: dict):
+    """Commit both legs; returns (from_balance_after, to_balance_after) or None if a leg is still pending."""
+    (debit_ok, debit), (credit_ok, credit) = await _call_legs(t, "CommitLeg")
+    if not (debit_ok and credit_ok):
+        logger.warning(f"Commit of cross-shard tx {t['tx_id']} incomplete; recovery will retry")
+        return None
+    await db.transition_shard_transfer(
+        t["tx_id"], [COMMITTING], COMMITTED,
+        from_balance_after=debit.balance_after, to_balance_after=credit.balance_after,
+    )
+    # leg balances are unversioned; drop cached balances (recovery commits have no HTTP caller to do it)
+    await balance_cache.invalidate(t["from_account"], t["to_account"])
+    return debit.balance_after, credit.balance_after
+
+def _response(t: dict, status: str, message: str = "", from_bal: int = 0, to_bal: int = 0, replayed: bool = False):
+    return payment_pb2.TransferResponse(
+        tx_id=t["tx_id"] if status == "SUCCESS" else "",
+        from_account=t["from_account"], to_account=t["to_account"], amount=t["amount"], currency=t["currency"],
+        from_balance_after=from_bal, to_balance_after=to_bal, status=status, message=message, replayed=replayed,
+    )
+
+async def cross_shard_transfer(
+    from_shard: int, to_shard: int, from_account: str, to_account: str, amount: int, currency: str = "INR",
+    idempotency_key: str = "", ledger_dedupe: bool = False,
+):
+    """Same contract as the ledger's Transfer RPC, for accounts on two different shards."""
+    t = dict(
+        tx_id=str(uuid.uuid4()), idempotency_key=idempotency_key if ledger_dedupe and idempotency_key else None,
+        from_account=from_account, to_account=to_account, amount=amount, currency=currency or "INR",
+        from_shard=from_shard, to_shard=to_shard,
+    )
+    if amount <= 0:
+        return _response(t, "FAILED", "Amount must be > 0")
+    existing = await db.log_shard_transfer(t)
+    if existing is not None:
+        if (existing["from_account"], existing["to_account"], existing["amount"]) != (from_account, to_account, amount):
+            return _response(t, "FAILED", "idempotency_key reused with different parameters")
+        if existing["state"] == COMMITTED:
+            return _response(
+                existing, "SUCCESS", from_bal=existing["from_balance_after"] or 0,
+                to_bal=existing["to_balance_after"] or 0, replayed=True,
+            )
+        return _response(t, "FAILED", "Request with this idempotency_key is in progress")
+
+    (debit_ok, debit), (credit_ok, credit) = await _call_legs(t, "ReserveLeg")
+    if not (debit_ok and credit_ok):
+        error = debit if not debit_ok else credit
+        rejected = isinstance(error, grpc.aio.AioRpcError) and error.code() == grpc.StatusCode.INVALID_ARGUMENT
+        message = error.details() if rejected else str(error)
+        if await db.transition_shard_transfer(t["tx_id"], [PREPARING], ABORTING):
+            await _abort(t, message)
+        if rejected:
+            # as from a same-shard Transfer (e.g. a currency mismatch): the client gets a 400
+            raise error
+        return _response(t, "FAILED", message)
+
+    if not await db.transition_shard_transfer(t["tx_id"], [PREPARING], COMMITTING):
+        # recovery presumed this transfer dead and is aborting it
+        return _response(t, "FAILED", "Transfer timed out")
+    balances = await _commit(t)
+    if balances is None:
+        # decided but not yet applied everywhere; report the reserved view
+        balances = debit.balance_after, credit.balance_after + amount
+    return _response(t, "SUCCESS", from_bal=balances[0], to_bal=balances[1])
+
+async def recover_once(limit: int = 100) -> int:
+    """Finish stalled transfers; returns how many were picked up."""
+    rows = await db.claim_stalled_shard_transfers(settings.shard_recovery_grace_s, limit)
+    for t in rows:
+        try:
+            if t["state"] == COMMITTING:
+                await _commit(t)
+            elif t["state"] == ABORTING or await db.transition_shard_transfer(t["tx_id"], [PREPARING], ABORTING):
+                await _abort(t, t.get("message") or "Transfer timed out")
+        except Exception as e:
+            logger.error(f"Recovery of cross-shard tx {t['tx_id']} failed: {e}")
+    if rows:
+        logger.info(f"Recovered {len(rows)} cross-shard transfer(s)")
+    return len(rows)
+
+async def run_recovery():
+    """Background loop; a no-op until more than one ledger shard is configured."""
+    if len(grpc_clients.ledger_targets()) < 2:
+        return
+    while True:
+        try:
+            await recover_once()
+        except Exception as e:
+            logger.error(f"Cross-shard recovery pass failed: {e}")
+        await asyncio.sleep(settings.shard_recovery_interval_s)
@@ -1,4 +1,9 @@
+import base64
+import hashlib
+import json
 import uuid
+from datetime import datetime
+from typing import Optional, Tuple
 
 def is_uuid(s: str) -> bool:
     try:
@@ -6,3 +11,36 @@ def is_uuid(s: str) -> bool:
         return True
     except Exception:
         return False
+
+def is_iso_timestamp(s: str) -> bool:
+    try:
+        datetime.fromisoformat(s)
+        return True
+    except Exception:
+        return False
+
+def shard_for(account_id: str, shards: int) -> int:
+    """Ledger shard owning ``account_id`` (identical in every process).
+
+    The 64-bit blake2b space is cut into ``shards`` equal contiguous ranges, and
+    shard i owns the i-th. Doubling the shard count splits every range in two,
+    so the accounts of shard i end up on shards 2i and 2i+1. Accounts are not
+    moved between shards automatically.
+    """
+    if shards <= 1:
+        return 0
+    digest = hashlib.blake2b(account_id.encode(), digest_size=8).digest()
+    return (int.from_bytes(digest, "big") * shards) >> 64
+
+def encode_cursor(pos: Tuple[datetime, str]) -> str:
+    """Opaque pagination cursor for a (created_at, key) keyset position."""
+    raw = json.dumps([pos[0].isoformat(), str(pos[1])]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, str]]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, key = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(key)
+    except Exception:
+        return None
@@ -0,0 +1,242 @@
+"""Parquet files of archived ledger months, and reading them back.
+
+``ledger.partitions archive`` writes each closed month as two zstd-compressed
+Parquet files under ``LEDGER_ARCHIVE_DIR/<database>``: ``transfers_<name>``
+in (created_at, id) order and ``account_entries_<name>`` in (account_id,
+created_at, transfer_id, direction) order, so the row group statistics skip
+everything but one account's legs. Uuids are stored as text, so DuckDB,
+pandas or Spark can read the files directly.
+
+``iter_transfers`` replays archived transfers in the same order and shape as
+``crud.get_entries_page``. The export RPCs serve archived months from it
+before they read the live partitions, and ``statement_lines`` serves statement
+pages that start in an archived month. Current balances never read the files:
+they use the per-account totals in ``ledger_archive_deltas``. Balances as of a
+time inside an archived month (``balances_at``) add that month's legs up to it.
+"""
+
+import asyncio
+import os
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from . import db
+from .db import accounts, ledger_archives, ledger_archive_deltas
+
+LEDGER_ARCHIVE_DIR = os.getenv("LEDGER_ARCHIVE_DIR", "/app/archive")
+# rows per Parquet row group, and per fetch from the partition being exported
+ARCHIVE_BATCH_ROWS = int(os.getenv("LEDGER_ARCHIVE_BATCH_ROWS", "65536"))
+
+_TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+TRANSFERS_SCHEMA = pa.schema([
+    ("id", pa.int64()), ("tx_id", pa.string()), ("from_account", pa.string()), ("to_account", pa.string()),
+    ("amount", pa.int64()), ("currency", pa.string()), ("created_at", _TIMESTAMP), ("has_debit", pa.bool_()),
+])
+ENTRIES_SCHEMA = pa.schema([
+    ("transfer_id", pa.int64()), ("account_id", pa.string()), ("amount", pa.int64()),
+    ("created_at", _TIMESTAMP), ("direction", pa.int8()),
+])
+
+_EXPORT_SQL = {
+    "transfers": (
+        "SELECT id, tx_id::text, from_account::text, to_account::text, amount, currency, created_at, has_debit "
+        "FROM {table} ORDER BY created_at, id"
+    ),
+    "account_entries": (
+        "SELECT transfer_id, account_id::text, amount, created_at, direction "
+        "FROM {table} ORDER BY account_id, created_at, transfer_id, direction"
+    ),
+}
+
+class ArchivedTransfer(NamedTuple):
+    id: int
+    tx_id: str
+    from_account: str
+    to_account: str
+    amount: int
+    currency: str
+    created_at: datetime
+
+class ArchivedStatementLine(NamedTuple):
+    created_at: datetime
+    transfer_id: int
+    direction: int
+    amount: int
+    balance_after: int
+    tx_id: str
+    counterparty: str
+
+def archive_dir() -> str:
+    # one directory per database: shards may share the volume
+    return os.path.join(LEDGER_ARCHIVE_DIR, db.POSTGRES_DB)
+
+async def export_table(conn: AsyncConnection, kind: str, table: str, path: str) -> Tuple[int, int]:
+    """Stream partition ``table`` of ``kind`` into a Parquet file at ``path``; returns (rows, sum of amount).
+
+    The file is written next to ``path`` and renamed into place once it is
+    complete and fsynced, so a crash never leaves a truncated archive behind.
+    """
+    schema = TRANSFERS_SCHEMA if kind == "transfers" else ENTRIES_SCHEMA
+    tmp = path + ".tmp"
+    rows = total = 0
+    result = await conn.stream(text(_EXPORT_SQL[kind].format(table=table)))
+    with pq.ParquetWriter(tmp, schema, compression="zstd") as writer:
+        async for chunk in result.partitions(ARCHIVE_BATCH_ROWS):
+            batch = pa.Table.from_pylist([dict(r._mapping) for r in chunk], schema=schema)
+            writer.write_table(batch, row_group_size=ARCHIVE_BATCH_ROWS)
+            rows += batch.num_rows
+            total += pc.sum(batch["amount"]).as_py() or 0
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return rows, total
+
+def file_totals(path: str) -> Tuple[int, int]:
+    """(rows, sum of amount) of an archive file, read back from disk."""
+    amounts = pq.read_table(path, columns=["amount"])["amount"]
+    return len(amounts), pc.sum(amounts).as_py() or 0
+
+async def list_archives(session: AsyncSession, since: Optional[datetime] = None):
+    """Archives holding rows at or after ``since``, oldest first."""
+    query = select(ledger_archives).order_by(ledger_archives.c.range_end)
+    if since is not None:
+        query = query.where(ledger_archives.c.range_end > since)
+    return (await session.execute(query)).all()
+
+async def opening_balance(session: AsyncSession, account_id: str, first) -> int:
+    """The account's balance at the start of archive ``first``: start_balance plus the archives before it."""
+    deltas = (
+        select(func.coalesce(func.sum(ledger_archive_deltas.c.delta), 0))
+        .select_from(
+            ledger_archive_deltas.join(ledger_archives, ledger_archives.c.name == ledger_archive_deltas.c.archive)
+        )
+        .where(ledger_archive_deltas.c.account_id == account_id, ledger_archives.c.range_end < first.range_end)
+        .scalar_subquery()
+    )
+    res = await session.execute(select(accounts.c.start_balance + deltas).where(accounts.c.id == account_id))
+    return int(res.scalar_one_or_none() or 0)
+
+def _account_transfer_ids(entries_path: str, account_id: str) -> Optional[pa.Array]:
+    legs = pq.read_table(entries_path, columns=["transfer_id"], filters=[("account_id", "=", account_id)])
+    return legs["transfer_id"].combine_chunks() if legs.num_rows else None
+
+def _batches(path: str, batch_size: int):
+    columns = list(ArchivedTransfer._fields) + ["has_debit"]
+    return pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+
+def _select(batch: pa.RecordBatch, since: Optional[datetime], ids: Optional[pa.Array]) -> List[ArchivedTransfer]:
+    # same rows as get_entries_page: an account's own legs, or the transfers whose debit is on this shard
+    mask = pc.is_in(batch.column("id"), value_set=ids) if ids is not None else batch.column("has_debit")
+    if since is not None:
+        mask = pc.and_(mask, pc.greater_equal(batch.column("created_at"), pa.scalar(since, type=_TIMESTAMP)))
+    return [
+        ArchivedTransfer(*(r[f] for f in ArchivedTransfer._fields))
+        for r in batch.filter(mask).to_pylist()
+    ]
+
+async def iter_transfers(
+    archives, since: Optional[datetime] = None, account_id: Optional[str] = None, batch_size: int = ARCHIVE_BATCH_ROWS,
+) -> AsyncIterator[List[ArchivedTransfer]]:
+    """Pages of archived transfers in (created_at, id) order; file reads run in a worker thread."""
+    for a in archives:
+        ids = None
+        if account_id:
+            ids = await asyncio.to_thread(_account_transfer_ids, a.entries_path, account_id)
+            if ids is None:
+                continue
+        batches = await asyncio.to_thread(_batches, a.transfers_path, batch_size)
+        while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+            page = _select(batch, since, ids)
+            if page:
+                yield page
+
+def _account_legs(entries_path: str, account_id: str) -> List[Tuple[datetime, int, int, int]]:
+    columns = ["created_at", "transfer_id", "direction", "amount"]
+    legs = pq.read_table(entries_path, columns=columns, filters=[("account_id", "=", account_id)])
+    return sorted(zip(*(legs[c].to_pylist() for c in columns)))
+
+def _counterparties(transfers_path: str, ids: List[int]) -> dict:
+    rows = pq.read_table(
+        transfers_path, columns=["id", "tx_id", "from_account", "to_account"], filters=[("id", "in", ids)],
+    ).to_pylist()
+    return {r["id"]: r for r in rows}
+
+async def statement_lines(
+    archives, account_id: str, pos: Tuple[datetime, int, int], until: datetime, limit: int, balance: int,
+) -> Tuple[Optional[int], List[ArchivedStatementLine]]:
+    """(opening balance or None, lines): archived legs of the account after ``pos``, like crud.get_statement_page.
+
+    ``archives`` are the archives ending after ``pos``, oldest first, and
+    ``balance`` is the account's balance at the start of the first one. The
+    running balance is carried over from there in Python.
+    """
+    opening = None
+    picked = []  # (archive index, leg with its balance after)
+    for i, a in enumerate(archives):
+        if len(picked) >= limit or (a.range_start is not None and a.range_start >= until):
+            break
+        for created_at, transfer_id, direction, amount in await asyncio.to_thread(
+            _account_legs, a.entries_path, account_id,
+        ):
+            listed = (created_at, transfer_id, direction) > pos
+            if listed and (created_at >= until or len(picked) >= limit):
+                break
+            if listed and opening is None:
+                opening = balance
+            balance += amount * direction
+            if listed:
+                picked.append((i, (created_at, transfer_id, direction, amount, balance)))
+    lines = []
+    for i in sorted({i for i, _ in picked}):
+        legs = [leg for j, leg in picked if j == i]
+        parties = await asyncio.to_thread(_counterparties, archives[i].transfers_path, [leg[1] for leg in legs])
+        for created_at, transfer_id, direction, amount, after in legs:
+            t = parties[transfer_id]
+            counterparty = t["to_account"] if direction < 0 else t["from_account"]
+            lines.append(
+                ArchivedStatementLine(created_at, transfer_id, direction, amount, after, t["tx_id"], counterparty)
+            )
+    return opening, lines
+
+# start_balance plus the archives ending before :first_end, for the accounts in :ids (all when NULL)
+_BALANCES_BEFORE_SQL = text("""
+SELECT a.id, a.currency, a.start_balance + COALESCE((
+    SELECT SUM(d.delta) FROM ledger_archive_deltas d JOIN ledger_archives r ON r.name = d.archive
+    WHERE d.account_id = CAST(a.id AS uuid) AND r.range_end < :first_end
+), 0) AS balance
+FROM accounts a
+WHERE CAST(:ids AS text[]) IS NULL OR a.id = ANY(CAST(:ids AS text[]))
+ORDER BY a.id
+""")
+
+def _deltas_until(entries_path: str, at: datetime, account_ids: Optional[List[str]]) -> Dict[str, int]:
+    filters = [("created_at", "<=", at)]
+    if account_ids is not None:
+        filters.append(("account_id", "in", account_ids))
+    legs = pq.read_table(entries_path, columns=["account_id", "amount", "direction"], filters=filters)
+    signed = pc.multiply(legs["amount"], pc.cast(legs["direction"], pa.int64()))
+    sums = pa.table({"account_id": legs["account_id"], "delta": signed}).group_by("account_id").aggregate(
+        [("delta", "sum")]
+    )
+    return dict(zip(sums["account_id"].to_pylist(), sums["delta_sum"].to_pylist()))
+
+async def balances_at(
+    session: AsyncSession, first, at: datetime, account_ids: Optional[List[str]] = None,
+    batch: int = ARCHIVE_BATCH_ROWS,
+):
+    """Pages of (account_id, currency, balance) as of ``at``, inside archive ``first``, like crud.balances_at.
+
+    The balance at the start of the month comes from the archived deltas. The
+    month's legs up to ``at`` are summed from its Parquet file.
+    """
+    deltas = await asyncio.to_thread(_deltas_until, first.entries_path, at, account_ids)
+    result = await session.stream(_BALANCES_BEFORE_SQL, {"first_end": first.range_end, "ids": account_ids})
+    async for chunk in result.partitions(batch):
+        yield [(r.id, r.currency, int(r.balance) + deltas.get(r.id, 0)) for r in chunk]
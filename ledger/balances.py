@@ -0,0 +1,172 @@
+"""Maintenance commands for the materialized ``account_balances`` table.
+
+Usage (inside the ledger container):
+  python -m ledger.balances rebuild [--account ID]
+  python -m ledger.balances verify  [--account ID]
+  python -m ledger.balances consolidate [--account ID]
+  python -m ledger.balances hot --account ID --buckets N
+  python -m ledger.balances checkpoint [--min-entries N]
+  python -m ledger.balances as-of --at TIMESTAMP [--account ID]
+
+``rebuild`` recomputes every balance from ``account_entries`` (plus the per-account
+totals of archived months) in one transaction.
+``verify`` compares the materialized value against the entry sum and exits
+non-zero if any account drifted.
+``consolidate`` folds hot-account bucket rows into the main balance rows (the
+ledger server also does this periodically).
+``hot`` marks an account as hot with N credit buckets (0 turns it back into a
+regular account). Gateways pick the change up when their account cache entry
+expires, or immediately after a publish on ``accounts:changed``.
+``checkpoint`` records the balance of every account with at least N legs since
+its latest checkpoint in ``account_balance_checkpoints``. Worker 0 of the
+ledger server also does this every ``LEDGER_CHECKPOINT_INTERVAL_S``.
+Statements and balances as of a past time start summing from there instead of
+from the account's first leg.
+``as-of`` prints ``account_id,currency,balance`` as of TIMESTAMP for one or
+every account, from one streamed query.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+from loguru import logger
+
+from . import archive, db, crud
+
+# checkpoints stop this far behind now(), past any transaction still adding legs
+LEDGER_CHECKPOINT_SETTLE_S = float(os.getenv("LEDGER_CHECKPOINT_SETTLE_S", "60"))
+# legs since an account's latest checkpoint before it gets a new one
+LEDGER_CHECKPOINT_MIN_ENTRIES = int(os.getenv("LEDGER_CHECKPOINT_MIN_ENTRIES", "500"))
+# how often the ledger writes checkpoints (0 = never, run `checkpoint` from cron instead)
+LEDGER_CHECKPOINT_INTERVAL_S = float(os.getenv("LEDGER_CHECKPOINT_INTERVAL_S", "900"))
+
+async def rebuild(account_id: str | None = None) -> int:
+    session = await db.get_session()
+    async with session.begin():
+        count = await crud.rebuild_balances(session, account_id)
+    logger.info(f"Rebuilt {count} account balance(s)")
+    return count
+
+async def verify(account_id: str | None = None) -> list:
+    session = await db.get_session()
+    async with session.begin():
+        mismatches = await crud.verify_balances(session, account_id)
+    for m in mismatches:
+        logger.error(
+            f"Balance drift acct={m['account_id']} materialized={m['materialized']} expected={m['expected']}"
+        )
+    if not mismatches:
+        logger.info("All materialized balances match the ledger entries")
+    return list(mismatches)
+
+async def consolidate(account_id: str | None = None) -> int:
+    """Consolidate one or every hot account, one short transaction each."""
+    session = await db.get_session()
+    if account_id is not None:
+        ids = [account_id]
+    else:
+        async with session.begin():
+            ids = await crud.hot_account_ids(session)
+    for acct in ids:
+        async with session.begin():
+            await crud.consolidate_account(session, acct)
+    return len(ids)
+
+async def run_consolidator(interval_s: float):
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            await consolidate()
+        except Exception as e:
+            logger.error(f"Hot account consolidation failed: {e}")
+
+async def checkpoint(min_entries: int = LEDGER_CHECKPOINT_MIN_ENTRIES, batch: int = 1000) -> int:
+    """Checkpoint every account that needs it, ``batch`` accounts per transaction."""
+    upto = datetime.now(timezone.utc) - timedelta(seconds=LEDGER_CHECKPOINT_SETTLE_S)
+    session = await db.get_session()
+    after, total = "", 0
+    while after is not None:
+        async with session.begin():
+            after, written = await crud.write_checkpoints(session, upto, max(1, min_entries), after, batch)
+        total += written
+    logger.info(f"Wrote {total} balance checkpoint(s) up to {upto.isoformat()}")
+    return total
+
+async def run_checkpointer(interval_s: float):
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            await checkpoint()
+        except Exception as e:
+            logger.error(f"Balance checkpoint failed: {e}")
+
+async def balances_at(session, at: datetime, account_ids=None):
+    """Pages of (account_id, currency, balance) as of ``at``; an archived month is read from its files."""
+    async with session.begin():
+        archives = await archive.list_archives(session, at)
+    if archives:
+        pages = archive.balances_at(session, archives[0], at, account_ids)
+    else:
+        pages = crud.balances_at(session, at, account_ids)
+    async with session.begin():
+        async for page in pages:
+            yield page
+
+async def print_balances_at(at: datetime, account_id: str | None = None) -> int:
+    session = await db.get_read_session()
+    count = 0
+    async with session:
+        async for page in balances_at(session, at, [account_id] if account_id else None):
+            for acct, currency, balance in page:
+                print(f"{acct},{currency},{balance}")
+            count += len(page)
+    return count
+
+async def set_hot(account_id: str, buckets: int):
+    session = await db.get_session()
+    async with session.begin():
+        await crud.set_hot_buckets(session, account_id, buckets)
+    logger.info(f"Account {account_id} hot_buckets={buckets}")
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="ledger.balances")
+    parser.add_argument("command", choices=["rebuild", "verify", "consolidate", "hot", "checkpoint", "as-of"])
+    parser.add_argument("--account", default=None, help="limit to a single account id")
+    parser.add_argument("--buckets", type=int, default=16, help="credit buckets for `hot` (0 = not hot)")
+    parser.add_argument(
+        "--min-entries", type=int, default=LEDGER_CHECKPOINT_MIN_ENTRIES, help="legs since the last checkpoint",
+    )
+    parser.add_argument("--at", default=None, help="ISO-8601 timestamp for `as-of`")
+    args = parser.parse_args(argv)
+
+    await db.apply_migrations()
+    if args.command == "rebuild":
+        await rebuild(args.account)
+        return 0
+    if args.command == "consolidate":
+        count = await consolidate(args.account)
+        logger.info(f"Consolidated {count} hot account(s)")
+        return 0
+    if args.command == "hot":
+        if args.account is None or args.buckets < 0:
+            parser.error("hot needs --account and --buckets >= 0")
+        await set_hot(args.account, args.buckets)
+        return 0
+    if args.command == "checkpoint":
+        await checkpoint(args.min_entries)
+        return 0
+    if args.command == "as-of":
+        try:
+            at = datetime.fromisoformat(args.at or "")
+        except ValueError:
+            parser.error("as-of needs --at with an ISO-8601 timestamp")
+        await print_balances_at(at if at.tzinfo else at.replace(tzinfo=timezone.utc), args.account)
+        return 0
+    mismatches = await verify(args.account)
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
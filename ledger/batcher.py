@@ -0,0 +1,139 @@
+"""Group-commit micro-batching for ledger transfers.
+
+Concurrent ``Transfer`` RPCs are queued and applied by a single worker in one
+DB transaction: each item runs its checks and balance updates inside its own
+SAVEPOINT (so a failing item is rolled back alone), and the transfers and legs
+of every successful item go out in one INSERT statement before a single COMMIT.
+
+Before the first item, the batch locks the balance rows of every account it
+touches in id order, the order every other writer uses. Two batches (in two
+workers) sharing accounts therefore queue behind each other instead of each
+holding rows the other needs. Credits to hot accounts go through their (already
+locked) main row, because a batch that took bucket rows of several accounts
+could take them in a different order than another batch.
+
+A batch closes when ``max_batch`` items are queued or ``max_wait_ms`` elapsed
+since the first one arrived, whichever comes first.
+"""
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from loguru import logger
+
+from common import tracing
+
+from . import crud
+from .db import get_session
+
+LEDGER_BATCH_ENABLED = os.getenv("LEDGER_BATCH_ENABLED", "0") == "1"
+LEDGER_BATCH_MAX_WAIT_MS = float(os.getenv("LEDGER_BATCH_MAX_WAIT_MS", "2"))
+LEDGER_BATCH_MAX_SIZE = int(os.getenv("LEDGER_BATCH_MAX_SIZE", "64"))
+
+@dataclass
+class _Item:
+    from_acct: str
+    to_acct: str
+    amount: int
+    currency: str
+    idempotency_key: str
+    future: asyncio.Future
+    result: Optional[Tuple[dict, bool]] = None
+    rows: List[dict] = field(default_factory=list)
+
+class TransferBatcher:
+    def __init__(self, max_wait_ms: float = LEDGER_BATCH_MAX_WAIT_MS, max_batch: int = LEDGER_BATCH_MAX_SIZE):
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        # counters, exposed for the benchmark / logs
+        self.commits = 0
+        self.transfers = 0
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def submit(
+        self, from_acct: str, to_acct: str, amount: int, currency: str, idempotency_key: str = ""
+    ) -> Tuple[dict, bool]:
+        """Queue a transfer and wait for its batch to commit; same contract as crud.apply_transfer."""
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        # the batch's statements run in the batcher task, outside this trace
+        with tracing.span("batch.wait"):
+            await self._queue.put(_Item(from_acct, to_acct, amount, currency, idempotency_key, fut))
+            return await fut
+
+    async def _collect(self) -> List[_Item]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._apply(batch)
+            except Exception as e:
+                # the shared commit failed; fall back to one transaction per item
+                logger.warning(f"Batch of {len(batch)} failed ({e}); retrying individually")
+                for item in batch:
+                    if item.future.done():
+                        continue
+                    try:
+                        await self._apply([item])
+                    except Exception as item_err:
+                        item.future.set_exception(item_err)
+
+    async def _apply(self, batch: List[_Item]):
+        pending = [i for i in batch if not i.future.done()]
+        errors = {}
+        session = await get_session()
+        async with session.begin():
+            await crud.lock_balances(session, [a for i in pending for a in (i.from_acct, i.to_acct)])
+            for item in pending:
+                item.result, item.rows = None, []
+                rows: List[dict] = []
+                try:
+                    async with session.begin_nested():
+                        item.result = await crud.apply_transfer(
+                            session, item.from_acct, item.to_acct, item.amount, item.currency,
+                            idempotency_key=item.idempotency_key, pending_rows=rows, bucket_credits=False,
+                        )
+                except Exception as e:
+                    item.result = None
+                    errors[id(item)] = e
+                    continue
+                item.rows = rows
+            await crud.insert_transfers(session, [r for i in pending for r in i.rows])
+        self.commits += 1
+        self.transfers += sum(1 for i in pending if i.rows)
+        for item in pending:
+            if item.future.done():  # caller went away; its transfer still committed
+                continue
+            if item.result is not None:
+                item.future.set_result(item.result)
+            else:
+                item.future.set_exception(errors[id(item)])
@@ -0,0 +1,250 @@
+"""Online migration from the two-row ``ledger_entries`` layout to ``transfers`` + ``account_entries``.
+
+Usage (inside the ledger container):
+  python -m ledger.compact migrate [--batch 5000] [--pause-ms 20]
+  python -m ledger.compact verify
+  python -m ledger.compact sizes
+  python -m ledger.compact drop-legacy
+
+The old layout stored every transfer as two TEXT-keyed rows that had to be
+joined on ``tx_id`` to list transfers. The new one has a ``transfers`` row per
+transfer (native uuid columns, currency included) and a narrow leg row per
+side with a smallint direction.
+
+``migrate`` can run while the old ledger version is still serving:
+
+1. It creates the new tables and installs a statement-level trigger on
+   ``ledger_entries`` that writes every new legacy insert into them, in the
+   inserting transaction.
+2. It copies the existing rows over in short transactions of ``--batch``
+   legacy ids, pausing between batches. Progress is kept in
+   ``ledger_compact_progress``, so an interrupted run resumes where it stopped.
+3. After the last batch it recomputes ``account_balances`` from the copied
+   history and marks the copy done.
+
+The new ledger version refuses to start while ``ledger_entries`` exists and
+``migrate`` has not finished, since its balances would miss the legacy
+history. Once ``migrate`` has finished, roll out the new ledger version; old and new
+workers can run side by side. ``verify`` checks that every legacy row has its
+leg. ``sizes`` prints table and index sizes of both layouts. ``drop-legacy``
+removes the old table and the trigger; run it after no old worker is left.
+"""
+
+import argparse
+import asyncio
+import sys
+
+from loguru import logger
+from sqlalchemy import text
+
+from . import crud, db, partitions
+
+# Writes the legacy rows in {src} (all legs of each transfer they contain) into
+# the new tables. The other side of a cross-shard transfer is on another shard;
+# its account comes from transfer_legs.counterparty. A leg takes its transfer's
+# created_at, so both rows land in the same monthly partition.
+_COPY_TRANSFERS_SQL = """
+INSERT INTO transfers (tx_id, from_account, to_account, amount, currency, created_at, has_debit)
+SELECT s.tx_id::uuid,
+       COALESCE(MAX(s.account_id) FILTER (WHERE s.direction = 'DEBIT'), MAX(l.counterparty))::uuid,
+       COALESCE(MAX(s.account_id) FILTER (WHERE s.direction = 'CREDIT'), MAX(l.counterparty))::uuid,
+       MAX(s.amount), MAX(a.currency), MIN(s.created_at), bool_or(s.direction = 'DEBIT')
+FROM {src} s
+JOIN accounts a ON a.id = s.account_id
+LEFT JOIN transfer_legs l ON l.tx_id = s.tx_id AND l.direction = s.direction
+WHERE NOT EXISTS (SELECT 1 FROM transfers t WHERE t.tx_id = s.tx_id::uuid)
+GROUP BY s.tx_id
+"""
+
+_COPY_LEGS_SQL = """
+INSERT INTO account_entries (transfer_id, account_id, amount, created_at, direction)
+SELECT t.id, s.account_id::uuid, s.amount, t.created_at, CASE WHEN s.direction = 'DEBIT' THEN -1 ELSE 1 END
+FROM {src} s
+JOIN transfers t ON t.tx_id = s.tx_id::uuid
+ON CONFLICT (transfer_id, direction, created_at) DO NOTHING
+"""
+
+_MIRROR_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION ledger_entries_mirror() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    {_COPY_TRANSFERS_SQL.format(src="new_rows")};
+    {_COPY_LEGS_SQL.format(src="new_rows")};
+    RETURN NULL;
+END
+$$
+"""
+
+# every leg of the transfers that have a leg in (lo, hi]
+_BATCH_SRC = """(
+    SELECT e.* FROM ledger_entries e
+    WHERE e.tx_id IN (SELECT tx_id FROM ledger_entries WHERE id > :lo AND id <= :hi)
+)"""
+
+_MISSING_LEGS_SQL = text("""
+SELECT count(*) FROM ledger_entries e
+WHERE NOT EXISTS (
+    SELECT 1 FROM transfers t JOIN account_entries n ON n.transfer_id = t.id
+    WHERE t.tx_id = e.tx_id::uuid
+      AND n.direction = CASE WHEN e.direction = 'DEBIT' THEN -1 ELSE 1 END
+      AND n.account_id = e.account_id::uuid
+      AND n.amount = e.amount
+)
+""")
+
+# summed over the partitions of the partitioned tables (a plain table is its own single leaf)
+_SIZES_SQL = text("""
+SELECT t.name, SUM(pg_table_size(p.relid))::bigint, SUM(pg_indexes_size(p.relid))::bigint,
+       SUM(GREATEST(c.reltuples, 0))::bigint
+FROM unnest(ARRAY['ledger_entries', 'transfers', 'account_entries']) AS t(name)
+CROSS JOIN LATERAL pg_partition_tree(to_regclass(t.name)) p
+JOIN pg_class c ON c.oid = p.relid
+WHERE p.isleaf
+GROUP BY t.name
+""")
+
+async def _legacy_exists(conn) -> bool:
+    res = await conn.execute(text("SELECT to_regclass('ledger_entries') IS NOT NULL"))
+    return bool(res.scalar_one())
+
+async def pending(conn=None) -> bool:
+    """True while ``ledger_entries`` exists and ``migrate`` has not finished copying it."""
+    if conn is None:
+        engine = await db.get_engine()
+        async with engine.connect() as conn:
+            return await pending(conn)
+    if not await _legacy_exists(conn):
+        return False
+    res = await conn.execute(text("SELECT to_regclass('ledger_compact_progress') IS NOT NULL"))
+    if not res.scalar_one():
+        return True
+    res = await conn.execute(text("SELECT done FROM ledger_compact_progress WHERE id = 1"))
+    return not res.scalar_one_or_none()
+
+async def _install_mirror(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text(_MIRROR_FUNCTION_SQL))
+        # waits for in-flight legacy inserts; every later insert is mirrored
+        await conn.execute(text("DROP TRIGGER IF EXISTS ledger_entries_mirror ON ledger_entries"))
+        await conn.execute(text(
+            "CREATE TRIGGER ledger_entries_mirror AFTER INSERT ON ledger_entries "
+            "REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION ledger_entries_mirror()"
+        ))
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS ledger_compact_progress (id INT PRIMARY KEY, last_id BIGINT NOT NULL)"
+        ))
+        await conn.execute(text(
+            "ALTER TABLE ledger_compact_progress ADD COLUMN IF NOT EXISTS done BOOLEAN NOT NULL DEFAULT false"
+        ))
+        await conn.execute(text(
+            "INSERT INTO ledger_compact_progress (id, last_id) VALUES (1, 0) ON CONFLICT (id) DO NOTHING"
+        ))
+
+async def migrate(batch: int, pause_s: float) -> int:
+    """Mirror new legacy inserts and copy the existing rows; returns the number of legacy rows walked."""
+    await db.apply_migrations()
+    engine = await db.get_engine()
+    async with engine.connect() as conn:
+        if not await _legacy_exists(conn):
+            logger.info("No ledger_entries table, nothing to migrate")
+            return 0
+    async with engine.connect() as conn:
+        oldest = (await conn.execute(text("SELECT MIN(created_at) FROM ledger_entries"))).scalar_one()
+    # the legacy history needs its monthly partitions before anything is copied
+    await partitions.ensure(first=oldest)
+    await _install_mirror(engine)
+    async with engine.connect() as conn:
+        # rows above this were inserted with the trigger in place
+        high = (await conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM ledger_entries"))).scalar_one()
+        lo = (await conn.execute(text("SELECT last_id FROM ledger_compact_progress WHERE id = 1"))).scalar_one()
+    start = lo
+    copy_transfers = text(_COPY_TRANSFERS_SQL.format(src=_BATCH_SRC))
+    copy_legs = text(_COPY_LEGS_SQL.format(src=_BATCH_SRC))
+    while lo < high:
+        hi = min(lo + batch, high)
+        async with engine.begin() as conn:
+            await conn.execute(copy_transfers, {"lo": lo, "hi": hi})
+            await conn.execute(copy_legs, {"lo": lo, "hi": hi})
+            await conn.execute(text("UPDATE ledger_compact_progress SET last_id = :hi WHERE id = 1"), {"hi": hi})
+        lo = hi
+        logger.info(f"Copied legacy ids up to {hi} of {high}")
+        await asyncio.sleep(pause_s)
+    # the balances seeded before the copy (migrations.sql skips them) miss the legacy history
+    session = await db.get_session()
+    async with session.begin():
+        rebuilt = await crud.rebuild_balances(session)
+        await session.execute(text("UPDATE ledger_compact_progress SET done = true WHERE id = 1"))
+    logger.info(f"Legacy rows copied and {rebuilt} balance(s) rebuilt; new inserts are mirrored until drop-legacy")
+    return high - start
+
+async def verify() -> int:
+    """Number of legacy rows without a matching leg in the new tables."""
+    engine = await db.get_engine()
+    async with engine.connect() as conn:
+        if not await _legacy_exists(conn):
+            logger.info("No ledger_entries table, nothing to verify")
+            return 0
+        missing = (await conn.execute(_MISSING_LEGS_SQL)).scalar_one()
+    if missing:
+        logger.error(f"{missing} legacy row(s) have no leg in account_entries")
+    else:
+        logger.info("Every legacy row has its leg in account_entries")
+    return missing
+
+async def sizes() -> dict:
+    """Print heap (with TOAST) and index size of both layouts, in total and per row."""
+    engine = await db.get_engine()
+    async with engine.connect() as conn:
+        await conn.execute(text("ANALYZE transfers, account_entries"))
+        if await _legacy_exists(conn):
+            await conn.execute(text("ANALYZE ledger_entries"))
+        rows = {r[0]: r[1:] for r in await conn.execute(_SIZES_SQL)}
+    print(f"{'table':<18} {'rows':>12} {'heap MB':>10} {'index MB':>10} {'heap B/row':>11} {'index B/row':>12}")
+    for name in ("ledger_entries", "transfers", "account_entries"):
+        if name not in rows:
+            continue
+        heap, index, n = rows[name]
+        print(
+            f"{name:<18} {n:>12} {heap / 2**20:>10.1f} {index / 2**20:>10.1f}"
+            f" {heap / max(n, 1):>11.0f} {index / max(n, 1):>12.0f}"
+        )
+    if "ledger_entries" in rows and rows.get("transfers", (0, 0, 0))[2]:
+        # a legacy transfer is two rows; a compact one is a transfers row plus two legs
+        legacy = sum(rows["ledger_entries"][:2]) / max(rows["ledger_entries"][2] / 2, 1)
+        compact = (sum(rows["transfers"][:2]) + sum(rows["account_entries"][:2])) / rows["transfers"][2]
+        print(f"bytes per transfer (heap + indexes): legacy {legacy:.0f}, compact {compact:.0f}")
+    return rows
+
+async def drop_legacy() -> bool:
+    if await verify():
+        logger.error("Not dropping ledger_entries while rows are missing from the new tables")
+        return False
+    engine = await db.get_engine()
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP TABLE IF EXISTS ledger_entries"))
+        await conn.execute(text("DROP FUNCTION IF EXISTS ledger_entries_mirror()"))
+        await conn.execute(text("DROP TABLE IF EXISTS ledger_compact_progress"))
+    logger.info("Dropped ledger_entries")
+    return True
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="ledger.compact")
+    parser.add_argument("command", choices=["migrate", "verify", "sizes", "drop-legacy"])
+    parser.add_argument("--batch", type=int, default=5000, help="legacy ids copied per transaction")
+    parser.add_argument("--pause-ms", type=float, default=20, help="sleep between batches")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "migrate":
+            await migrate(max(1, args.batch), args.pause_ms / 1000.0)
+            return 1 if await verify() else 0
+        if args.command == "verify":
+            return 1 if await verify() else 0
+        if args.command == "sizes":
+            await sizes()
+            return 0
+        return 0 if await drop_legacy() else 1
+    finally:
+        await db.dispose_engine()
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
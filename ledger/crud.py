@@ -1,56 +1,770 @@
 """Core ledger operations."""
 
+import random
+import time
 import uuid
-from typing import Tuple
-from sqlalchemy import select, insert, func, case
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select, insert, update, delete, func, case, cast, literal, text, tuple_, and_, union
+from sqlalchemy.dialects.postgresql import insert as pg_insert, UUID
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .db import accounts, ledger_entries
+from common import metrics
+
+from .db import (
+    accounts, transfers, account_entries, account_balances, account_balance_buckets, transfer_legs, ledger_idempotency_keys,
+    ledger_archive_deltas, DIRECTIONS,
+)
+
+row_lock_wait_seconds = metrics.Histogram(
+    "ledger_row_lock_wait_seconds", "Time spent waiting for SELECT ... FOR UPDATE on balance rows",
+)
+
+_signed_amount = account_entries.c.amount * account_entries.c.direction
+
+class InvalidTransfer(ValueError):
+    """A transfer request that can never succeed as sent; the Transfer RPC answers INVALID_ARGUMENT."""
 
 async def get_account_currency(session: AsyncSession, account_id: str) -> str | None:
     res = await session.execute(select(accounts.c.currency).where(accounts.c.id == account_id))
     return res.scalar_one_or_none()
 
-async def get_balance(session: AsyncSession, account_id: str) -> int:
-    # start_balance + credits - debits
+async def get_account_meta(session: AsyncSession, account_id: str):
+    """(currency, hot_buckets) row for ``account_id``, or None."""
+    res = await session.execute(
+        select(accounts.c.currency, accounts.c.hot_buckets).where(accounts.c.id == account_id)
+    )
+    return res.first()
+
+async def compute_balance(session: AsyncSession, account_id: str) -> int:
+    """Recompute start_balance + credits - debits from the raw entries (O(live history))."""
     sb_res = await session.execute(select(accounts.c.start_balance).where(accounts.c.id == account_id))
     start_balance = sb_res.scalar_one_or_none() or 0
-    sum_expr = func.sum(
-        case((ledger_entries.c.direction == 'CREDIT', ledger_entries.c.amount), else_=-ledger_entries.c.amount)
-    )
     le_res = await session.execute(
-        select(func.coalesce(sum_expr, 0)).where(ledger_entries.c.account_id == account_id)
+        select(func.coalesce(func.sum(_signed_amount), 0)).where(account_entries.c.account_id == account_id)
     )
     delta = le_res.scalar_one_or_none() or 0
-    return int(start_balance + delta)
+    ar_res = await session.execute(
+        select(func.coalesce(func.sum(ledger_archive_deltas.c.delta), 0))
+        .where(ledger_archive_deltas.c.account_id == account_id)
+    )
+    archived = ar_res.scalar_one_or_none() or 0
+    return int(start_balance + delta + archived)
+
+_UUID_RE = "^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
+
+def _entry_sum_subquery():
+    """Sum of the account's legs: live partitions plus the per-account totals of archived months."""
+    # accounts.id is TEXT; cast that side so the account_entries index is used
+    # (legs only exist for UUID ids, and casting any other id would fail)
+    acct = case((accounts.c.id.op("~*")(_UUID_RE), cast(accounts.c.id, UUID(as_uuid=False))))
+    live = (
+        select(func.coalesce(func.sum(_signed_amount), 0))
+        .where(account_entries.c.account_id == acct)
+        .scalar_subquery()
+    )
+    archived = (
+        select(func.coalesce(func.sum(ledger_archive_deltas.c.delta), 0))
+        .where(ledger_archive_deltas.c.account_id == acct)
+        .scalar_subquery()
+    )
+    return live + archived
+
+def _bucket_sum(account_id):
+    return (
+        select(func.coalesce(func.sum(account_balance_buckets.c.delta), 0))
+        .where(account_balance_buckets.c.account_id == account_id)
+        .scalar_subquery()
+    )
+
+def _reserved_sum(account_id):
+    # funds held by RESERVED cross-shard debits: out of the balance, not yet in the entries
+    return (
+        select(func.coalesce(func.sum(transfer_legs.c.amount), 0))
+        .where(
+            transfer_legs.c.account_id == account_id,
+            transfer_legs.c.state == 'RESERVED',
+            transfer_legs.c.direction == 'DEBIT',
+        )
+        .scalar_subquery()
+    )
+
+async def _materialize_balance(session: AsyncSession, account_id: str) -> None:
+    # accounts inserted after the migration ran have no balance row yet
+    stmt = pg_insert(account_balances).from_select(
+        ["account_id", "balance"],
+        select(accounts.c.id, accounts.c.start_balance + _entry_sum_subquery())
+        .where(accounts.c.id == account_id),
+    ).on_conflict_do_nothing(index_elements=[account_balances.c.account_id])
+    await session.execute(stmt)
+
+async def get_balance_version(session: AsyncSession, account_id: str) -> Tuple[int, int]:
+    """(balance, version) of ``account_id``; the version is its main row's change counter.
+
+    Credits into hot-account buckets do not bump it, so callers caching by
+    version must not cache hot accounts.
+    """
+    # main row plus any unconsolidated hot-account buckets (an empty PK probe otherwise)
+    query = (
+        select(account_balances.c.balance + _bucket_sum(account_id), account_balances.c.version)
+        .where(account_balances.c.account_id == account_id)
+    )
+    row = (await session.execute(query)).first()
+    if row is None:
+        await _materialize_balance(session, account_id)
+        row = (await session.execute(query)).first()
+    if row is None:
+        return 0, 0
+    return int(row[0]), int(row[1])
+
+async def get_balance(session: AsyncSession, account_id: str) -> int:
+    return (await get_balance_version(session, account_id))[0]
+
+async def _apply_delta(session: AsyncSession, account_id: str, delta: int) -> Tuple[int, int]:
+    """Add ``delta`` to the main balance row; returns (balance, version) after."""
+    stmt = (
+        update(account_balances)
+        .where(account_balances.c.account_id == account_id)
+        .values(
+            balance=account_balances.c.balance + delta,
+            version=account_balances.c.version + 1,
+            updated_at=func.now(),
+        )
+        .returning(account_balances.c.balance, account_balances.c.version)
+    )
+    row = (await session.execute(stmt)).first()
+    if row is None:
+        await _materialize_balance(session, account_id)
+        row = (await session.execute(stmt)).one()
+    return int(row[0]), int(row[1])
+
+async def lock_balances(session: AsyncSession, account_ids) -> Dict[str, int]:
+    """SELECT ... FOR UPDATE the balance rows of ``account_ids`` in id order.
+
+    Every writer locks in the same order, so two transfers touching the same
+    accounts serialize on the rows instead of deadlocking, and the balance read
+    here cannot change until the caller's transaction ends.
+    """
+    ids = sorted(set(account_ids))
+    query = (
+        select(account_balances.c.account_id, account_balances.c.balance)
+        .where(account_balances.c.account_id.in_(ids))
+        .order_by(account_balances.c.account_id)
+        .with_for_update()
+    )
+    start = time.perf_counter()
+    res = await session.execute(query)
+    locked_at = time.perf_counter()
+    row_lock_wait_seconds.observe(locked_at - start)
+    session.info.setdefault("locked_at", locked_at)
+    balances = {r.account_id: int(r.balance) for r in res}
+    missing = [i for i in ids if i not in balances]
+    if missing:
+        for acct in missing:
+            await _materialize_balance(session, acct)
+        res = await session.execute(query)
+        balances = {r.account_id: int(r.balance) for r in res}
+    return balances
+
+async def consolidate_account(session: AsyncSession, account_id: str) -> int:
+    """Fold a hot account's bucket rows into its main row; returns the new balance.
+
+    Locks the main row before the bucket rows, the same order transfers use, and
+    waits for in-flight credits to the buckets it takes.
+    """
+    balances = await lock_balances(session, [account_id])
+    res = await session.execute(
+        delete(account_balance_buckets)
+        .where(account_balance_buckets.c.account_id == account_id)
+        .returning(account_balance_buckets.c.delta)
+    )
+    moved = sum(int(d) for d in res.scalars())
+    if not moved:
+        return balances.get(account_id, 0)
+    balance, _ = await _apply_delta(session, account_id, moved)
+    return balance
+
+async def hot_account_ids(session: AsyncSession) -> List[str]:
+    """Accounts whose buckets need folding: the hot ones, and demoted ones that still have bucket rows.
+
+    A credit that read the account as hot before ``set_hot_buckets`` demoted it
+    can add a bucket row after the demotion consolidated, so the consolidator
+    keeps sweeping those until none is left.
+    """
+    ids = union(
+        select(accounts.c.id).where(accounts.c.hot_buckets > 0),
+        select(account_balance_buckets.c.account_id),
+    ).subquery()
+    res = await session.execute(select(ids.c.id).order_by(ids.c.id))
+    return list(res.scalars())
+
+async def set_hot_buckets(session: AsyncSession, account_id: str, buckets: int) -> None:
+    """Mark (buckets > 0) or unmark (0) ``account_id`` as hot."""
+    # the main row must exist before credits start landing in buckets
+    await _materialize_balance(session, account_id)
+    if buckets == 0:
+        await consolidate_account(session, account_id)
+    res = await session.execute(
+        update(accounts).where(accounts.c.id == account_id).values(hot_buckets=buckets)
+    )
+    if res.rowcount == 0:
+        raise ValueError("Account not found")
+
+async def validate_transfer(
+    session: AsyncSession, from_acct: str, to_acct: str, amount: int, bucket_credits: bool = True,
+) -> Tuple[str, int]:
+    """Check accounts, currency and funds; returns (currency, to_buckets) or raises ValueError.
+
+    Leaves the balance rows locked for the rest of the caller's transaction. A hot
+    receiver (``to_buckets`` > 0) is credited through a bucket row, so its main
+    row is not locked and concurrent credits to it do not serialize. Without
+    ``bucket_credits`` every receiver is credited through its main row.
+    """
+    if from_acct == to_acct:
+        raise InvalidTransfer("from_account and to_account must differ")
+    src = await get_account_meta(session, from_acct)
+    dst = await get_account_meta(session, to_acct)
+    if src is None or dst is None:
+        raise ValueError("Account not found")
+    if src.currency != dst.currency:
+        raise ValueError("Currency mismatch")
+    # a transaction only ever takes one account's bucket rows (and always after
+    # every main row), so hot-to-hot transfers credit the receiver's main row
+    to_buckets = dst.hot_buckets if bucket_credits and to_acct != from_acct and not src.hot_buckets else 0
+    balances = await lock_balances(session, [from_acct] if to_buckets else [from_acct, to_acct])
+    available = balances.get(from_acct, 0)
+    if src.hot_buckets:
+        # debits from a hot account see (and fold in) every committed credit first
+        available = await consolidate_account(session, from_acct)
+    if available < amount:
+        raise ValueError("Insufficient funds")
+    return src.currency, to_buckets
+
+async def _credit_bucket(session: AsyncSession, account_id: str, amount: int, buckets: int) -> int:
+    stmt = pg_insert(account_balance_buckets).values(
+        account_id=account_id, bucket=random.randrange(buckets), delta=amount
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[account_balance_buckets.c.account_id, account_balance_buckets.c.bucket],
+        set_=dict(delta=account_balance_buckets.c.delta + stmt.excluded.delta),
+    )
+    await session.execute(stmt)
+    # unlocked read: other buckets may still move under concurrent credits
+    return await get_balance(session, account_id)
+
+async def apply_balance_deltas(
+    session: AsyncSession, from_acct: str, to_acct: str, amount: int, to_buckets: int = 0
+) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """Returns (balance, version) after for both accounts; a bucket credit has version 0 (unversioned)."""
+    # materialized balances move in the same transaction as the entries;
+    # rows are updated in id order so concurrent opposite transfers cannot deadlock
+    if to_buckets:
+        # main rows first, bucket rows last, like every other writer
+        from_after = await _apply_delta(session, from_acct, -amount)
+        return from_after, (await _credit_bucket(session, to_acct, amount, to_buckets), 0)
+    deltas: Dict[str, int] = {}
+    for acct, delta in ((from_acct, -amount), (to_acct, amount)):
+        deltas[acct] = deltas.get(acct, 0) + delta
+    after = {acct: await _apply_delta(session, acct, deltas[acct]) for acct in sorted(deltas)}
+    return after[from_acct], after[to_acct]
+
+# Header rows and both legs in one statement. The arrays keep the SQL text (and
+# its prepared statement) the same for any number of transfers.
+_INSERT_TRANSFERS_SQL = text("""
+WITH t AS (
+    INSERT INTO transfers (tx_id, from_account, to_account, amount, currency)
+    SELECT * FROM unnest(
+        CAST(:tx_ids AS uuid[]), CAST(:from_accounts AS uuid[]), CAST(:to_accounts AS uuid[]),
+        CAST(:amounts AS bigint[]), CAST(:currencies AS text[])
+    )
+    RETURNING id, from_account, to_account, amount, created_at
+)
+INSERT INTO account_entries (transfer_id, account_id, amount, created_at, direction)
+SELECT id, from_account, amount, created_at, -1 FROM t
+UNION ALL
+SELECT id, to_account, amount, created_at, 1 FROM t
+""")
+
+def transfer_row(tx_id: str, from_acct: str, to_acct: str, amount: int, currency: str) -> dict:
+    return dict(tx_id=tx_id, from_account=from_acct, to_account=to_acct, amount=amount, currency=currency)
+
+async def insert_transfers(session: AsyncSession, rows: List[dict]) -> None:
+    """Write the ``transfers`` rows and both legs of each, in one round trip."""
+    if rows:
+        await session.execute(_INSERT_TRANSFERS_SQL, dict(
+            tx_ids=[r["tx_id"] for r in rows],
+            from_accounts=[r["from_account"] for r in rows],
+            to_accounts=[r["to_account"] for r in rows],
+            amounts=[r["amount"] for r in rows],
+            currencies=[r["currency"] for r in rows],
+        ))
+
+async def record_transfer(
+    session: AsyncSession, from_acct: str, to_acct: str, amount: int, currency: str,
+    pending_rows: Optional[List[dict]] = None, to_buckets: int = 0,
+) -> Tuple[str, Tuple[int, int], Tuple[int, int]]:
+    """Move balances and write the transfer; with ``pending_rows`` it is collected for a later bulk insert.
 
-async def record_transfer(session: AsyncSession, from_acct: str, to_acct: str, amount: int, currency: str) -> Tuple[str, int, int]:
+    Returns (tx_id, (from balance, version), (to balance, version)).
+    """
     tx_id = str(uuid.uuid4())
-    # insert two rows
-    await session.execute(insert(ledger_entries).values(tx_id=tx_id, account_id=from_acct, direction='DEBIT', amount=amount))
-    await session.execute(insert(ledger_entries).values(tx_id=tx_id, account_id=to_acct, direction='CREDIT', amount=amount))
-    # compute balances
-    from_bal = await get_balance(session, from_acct)
-    to_bal = await get_balance(session, to_acct)
-    return tx_id, from_bal, to_bal
-
-async def get_all_entries(session: AsyncSession):
-    # join ledger_entries with accounts to get from_account and to_account
-    debit_leg = ledger_entries.alias("debit_leg")
-    credit_leg = ledger_entries.alias("credit_leg")
+    from_after, to_after = await apply_balance_deltas(session, from_acct, to_acct, amount, to_buckets)
+    row = transfer_row(tx_id, from_acct, to_acct, amount, currency)
+    if pending_rows is None:
+        await insert_transfers(session, [row])
+    else:
+        pending_rows.append(row)
+    return tx_id, from_after, to_after
+
+async def claim_idempotency_key(session: AsyncSession, key: str) -> Optional[dict]:
+    """Insert ``key`` for this transaction; returns the stored response if it already exists.
+
+    A concurrent transaction holding the same key makes the insert wait for it,
+    so a duplicate sees either its committed response or (after a rollback) wins
+    the key itself. The key lives in ``ledger_idempotency_keys``, apart from the
+    gateway's re-claimable claims, so a gateway retrying a call whose outcome it
+    never learned gets the first call's response back.
+    """
+    res = await session.execute(
+        pg_insert(ledger_idempotency_keys).values(key=key)
+        .on_conflict_do_nothing(index_elements=[ledger_idempotency_keys.c.key])
+        .returning(ledger_idempotency_keys.c.key)
+    )
+    if res.scalar_one_or_none() is not None:
+        return None
+    res = await session.execute(
+        select(ledger_idempotency_keys.c.response).where(ledger_idempotency_keys.c.key == key)
+    )
+    response = res.scalar_one_or_none()
+    if not response:
+        # rows are only ever committed together with their response
+        raise ValueError("Request with this idempotency_key is in progress")
+    return response
+
+async def store_idempotency_response(session: AsyncSession, key: str, tx_id: str, response: dict) -> None:
+    await session.execute(
+        update(ledger_idempotency_keys).where(ledger_idempotency_keys.c.key == key)
+        .values(tx_id=tx_id, response=response)
+    )
+
+def transfer_response(
+    tx_id: str, from_acct: str, to_acct: str, amount: int, currency: str, from_bal: int, to_bal: int,
+    from_version: int = 0, to_version: int = 0,
+) -> dict:
+    # same shape as the gateway's TransferOut (plus balance versions) so either side can replay it
+    return dict(
+        tx_id=tx_id, from_account=from_acct, to_account=to_acct, amount=amount, currency=currency,
+        from_balance_after=from_bal, to_balance_after=to_bal, status='SUCCESS', message=None,
+        from_version=from_version, to_version=to_version,
+    )
+
+async def apply_transfer(
+    session: AsyncSession, from_acct: str, to_acct: str, amount: int, currency: str,
+    idempotency_key: str = "", pending_rows: Optional[List[dict]] = None, bucket_credits: bool = True,
+) -> Tuple[dict, bool]:
+    """Dedupe, validate and record one transfer in the caller's transaction.
+
+    Returns (response, replayed). Raises ValueError when the transfer is rejected;
+    the caller's transaction (or savepoint) must then be rolled back.
+    ``bucket_credits`` is passed on to validate_transfer.
+    """
+    if idempotency_key:
+        stored = await claim_idempotency_key(session, idempotency_key)
+        if stored is not None:
+            if (stored["from_account"], stored["to_account"], stored["amount"]) != (from_acct, to_acct, amount):
+                raise ValueError("idempotency_key reused with different parameters")
+            return stored, True
+    account_currency, to_buckets = await validate_transfer(session, from_acct, to_acct, amount, bucket_credits)
+    if currency != account_currency:
+        raise InvalidTransfer(f"Currency mismatch: accounts hold {account_currency}, request is {currency}")
+    tx_id, (from_bal, from_version), (to_bal, to_version) = await record_transfer(
+        session, from_acct, to_acct, amount, currency, pending_rows=pending_rows, to_buckets=to_buckets
+    )
+    response = transfer_response(
+        tx_id, from_acct, to_acct, amount, currency, from_bal, to_bal, from_version, to_version
+    )
+    if idempotency_key:
+        await store_idempotency_response(session, idempotency_key, tx_id, response)
+    return response, False
+
+LEG_RESERVED, LEG_COMMITTED, LEG_ABORTED = 'RESERVED', 'COMMITTED', 'ABORTED'
+
+async def _lock_leg(session: AsyncSession, tx_id: str, direction: str):
+    res = await session.execute(
+        select(transfer_legs)
+        .where(transfer_legs.c.tx_id == tx_id, transfer_legs.c.direction == direction)
+        .with_for_update()
+    )
+    return res.first()
+
+async def _set_leg_state(session: AsyncSession, tx_id: str, direction: str, state: str) -> None:
+    await session.execute(
+        update(transfer_legs)
+        .where(transfer_legs.c.tx_id == tx_id, transfer_legs.c.direction == direction)
+        .values(state=state, updated_at=func.now())
+    )
+
+async def reserve_leg(
+    session: AsyncSession, tx_id: str, account_id: str, direction: str, amount: int, currency: str, counterparty: str,
+) -> int:
+    """Phase one of a cross-shard transfer for the leg this shard owns; returns the balance.
+
+    A DEBIT takes the funds out of the balance now (held, with no entry yet); a
+    CREDIT only checks the account. Reserving a reserved or committed leg again
+    is a no-op, reserving an aborted one raises ValueError. A leg that can never
+    be reserved as sent raises InvalidTransfer.
+    """
+    # the leg row goes in before any balance row is touched (see rebuild_balances)
+    res = await session.execute(
+        pg_insert(transfer_legs).values(
+            tx_id=tx_id, direction=direction, account_id=account_id,
+            counterparty=counterparty, amount=amount, state=LEG_RESERVED,
+        ).on_conflict_do_nothing().returning(transfer_legs.c.tx_id)
+    )
+    if res.scalar_one_or_none() is None:
+        leg = await _lock_leg(session, tx_id, direction)
+        if leg.state == LEG_ABORTED:
+            raise ValueError("Transfer already aborted")
+        return await get_balance(session, account_id)
+    meta = await get_account_meta(session, account_id)
+    if meta is None:
+        raise ValueError("Account not found")
+    if meta.currency != currency:
+        raise InvalidTransfer(f"Currency mismatch: account holds {meta.currency}, request is {currency}")
+    if direction == 'CREDIT':
+        return await get_balance(session, account_id)
+    balances = await lock_balances(session, [account_id])
+    available = balances.get(account_id, 0)
+    if meta.hot_buckets:
+        available = await consolidate_account(session, account_id)
+    if available < amount:
+        raise ValueError("Insufficient funds")
+    balance, _ = await _apply_delta(session, account_id, -amount)
+    return balance
+
+async def _insert_leg_entry(session: AsyncSession, leg) -> None:
+    """This shard's ``transfers`` row and single leg of a cross-shard transfer."""
+    debit = leg.direction == 'DEBIT'
+    # Both legs land here only if two shards share a database. tx_id cannot be
+    # unique on the partitioned table, so the two commits take turns on it.
+    await session.execute(select(func.pg_advisory_xact_lock(func.hashtextextended(leg.tx_id, 0))))
+    res = await session.execute(
+        update(transfers).where(transfers.c.tx_id == leg.tx_id)
+        .values(has_debit=transfers.c.has_debit | debit)
+        .returning(transfers.c.id, transfers.c.created_at)
+    )
+    row = res.first()
+    if row is None:
+        currency = await get_account_currency(session, leg.account_id)
+        row = (await session.execute(
+            insert(transfers).values(
+                tx_id=leg.tx_id,
+                from_account=leg.account_id if debit else leg.counterparty,
+                to_account=leg.counterparty if debit else leg.account_id,
+                amount=leg.amount, currency=currency, has_debit=debit,
+            ).returning(transfers.c.id, transfers.c.created_at)
+        )).one()
+    transfer_id, created_at = row
+    await session.execute(insert(account_entries).values(
+        transfer_id=transfer_id, account_id=leg.account_id, amount=leg.amount,
+        created_at=created_at, direction=DIRECTIONS[leg.direction],
+    ))
+
+async def commit_leg(session: AsyncSession, tx_id: str, direction: str) -> int:
+    """Phase two: write the leg's entry (and apply a credit); returns the balance after."""
+    leg = await _lock_leg(session, tx_id, direction)
+    if leg is None:
+        raise ValueError("Unknown transfer leg")
+    if leg.state == LEG_ABORTED:
+        raise ValueError("Transfer already aborted")
+    if leg.state == LEG_COMMITTED:
+        return await get_balance(session, leg.account_id)
+    await _set_leg_state(session, tx_id, direction, LEG_COMMITTED)
+    await _insert_leg_entry(session, leg)
+    if direction == 'DEBIT':
+        return await get_balance(session, leg.account_id)
+    meta = await get_account_meta(session, leg.account_id)
+    if meta.hot_buckets:
+        return await _credit_bucket(session, leg.account_id, leg.amount, meta.hot_buckets)
+    await lock_balances(session, [leg.account_id])
+    balance, _ = await _apply_delta(session, leg.account_id, leg.amount)
+    return balance
+
+async def abort_leg(
+    session: AsyncSession, tx_id: str, account_id: str, direction: str, amount: int, counterparty: str,
+) -> None:
+    """Release a reserved leg. Aborting a leg that was never reserved leaves an
+    ABORTED tombstone so a late reserve for it fails; a committed leg raises."""
+    res = await session.execute(
+        pg_insert(transfer_legs).values(
+            tx_id=tx_id, direction=direction, account_id=account_id,
+            counterparty=counterparty, amount=amount, state=LEG_ABORTED,
+        ).on_conflict_do_nothing().returning(transfer_legs.c.tx_id)
+    )
+    if res.scalar_one_or_none() is not None:
+        return
+    leg = await _lock_leg(session, tx_id, direction)
+    if leg.state == LEG_COMMITTED:
+        raise ValueError("Transfer already committed")
+    if leg.state == LEG_ABORTED:
+        return
+    await _set_leg_state(session, tx_id, direction, LEG_ABORTED)
+    if direction == 'DEBIT':
+        await lock_balances(session, [leg.account_id])
+        await _apply_delta(session, leg.account_id, leg.amount)
+
+async def rebuild_balances(session: AsyncSession, account_id: str | None = None) -> int:
+    """Recompute materialized balances from the entries; returns the number of rows written.
+
+    Locks the main balance rows first, in id order like every writer, then sums
+    in one statement. Every transaction that moves a main row (transfers, leg
+    reserves and aborts, consolidation) has either committed before that
+    statement or waits for the caller's transaction. Writes that leave the main
+    row alone (bucket credits, committed debit legs) change the entries together
+    with the bucket or leg that offsets them, so the sum sees both or neither.
+    Hot-account buckets are left in place; the main row gets whatever they do not
+    already hold, minus the funds held by reserved cross-shard debits.
+    """
+    # accounts without a row get a placeholder so that they are locked as well
+    missing = select(accounts.c.id, literal(0))
+    locked = select(account_balances.c.account_id).order_by(account_balances.c.account_id).with_for_update()
+    if account_id is not None:
+        missing = missing.where(accounts.c.id == account_id)
+        locked = locked.where(account_balances.c.account_id == account_id)
+    await session.execute(
+        pg_insert(account_balances).from_select(["account_id", "balance"], missing)
+        .on_conflict_do_nothing(index_elements=[account_balances.c.account_id])
+    )
+    await session.execute(locked)
+    src = select(
+        accounts.c.id,
+        accounts.c.start_balance + _entry_sum_subquery() - _bucket_sum(accounts.c.id) - _reserved_sum(accounts.c.id),
+    )
+    if account_id is not None:
+        src = src.where(accounts.c.id == account_id)
+    stmt = pg_insert(account_balances).from_select(["account_id", "balance"], src)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[account_balances.c.account_id],
+        set_=dict(
+            balance=stmt.excluded.balance,
+            version=account_balances.c.version + 1,
+            updated_at=func.now(),
+        ),
+    )
+    res = await session.execute(stmt)
+    return res.rowcount
+
+async def verify_balances(session: AsyncSession, account_id: str | None = None):
+    """Return rows whose materialized balance disagrees with the entry sum."""
+    expected = accounts.c.start_balance + _entry_sum_subquery() - _reserved_sum(accounts.c.id)
     query = (
         select(
-            debit_leg.c.tx_id,
-            debit_leg.c.account_id.label("from_account"),
-            credit_leg.c.account_id.label("to_account"),
-            debit_leg.c.amount,
-            accounts.c.currency,
-            debit_leg.c.created_at,
+            accounts.c.id.label("account_id"),
+            (account_balances.c.balance + _bucket_sum(accounts.c.id)).label("materialized"),
+            expected.label("expected"),
         )
-        .join(credit_leg, debit_leg.c.tx_id == credit_leg.c.tx_id)
-        .join(accounts, debit_leg.c.account_id == accounts.c.id)
-        .where(debit_leg.c.direction == "DEBIT")
-        .where(credit_leg.c.direction == "CREDIT")
+        .select_from(accounts.outerjoin(account_balances, account_balances.c.account_id == accounts.c.id))
+        .where((account_balances.c.balance + _bucket_sum(accounts.c.id)).is_distinct_from(expected))
     )
+    if account_id is not None:
+        query = query.where(accounts.c.id == account_id)
     res = await session.execute(query)
     return res.mappings().all()
+
+_transfer_columns = (
+    transfers.c.id, transfers.c.tx_id, transfers.c.from_account, transfers.c.to_account,
+    transfers.c.amount, transfers.c.currency, transfers.c.created_at,
+)
+
+EXPORT_PAGE_SIZE = 500
+
+async def get_entries_page(
+    session: AsyncSession,
+    after: Optional[Tuple[datetime, int]] = None,
+    since: Optional[datetime] = None,
+    account_id: Optional[str] = None,
+    limit: int = EXPORT_PAGE_SIZE,
+):
+    """One keyset page of transfers ordered by (created_at, transfer id).
+
+    A full export walks ``idx_transfers_created`` over the transfers whose debit
+    is on this shard and reads nothing else. An account export walks that
+    account's legs (``idx_account_entries_statement``) and fetches each
+    transfer row by primary key. Months that were archived are not included
+    (see ``archive.iter_transfers``).
+    """
+    if account_id:
+        pos = (account_entries.c.created_at, account_entries.c.transfer_id)
+        query = (
+            select(*_transfer_columns)
+            .select_from(account_entries.join(transfers, and_(
+                # the leg's created_at is its transfer's, which is the partition key
+                transfers.c.id == account_entries.c.transfer_id,
+                transfers.c.created_at == account_entries.c.created_at,
+            )))
+            .where(account_entries.c.account_id == account_id)
+        )
+    else:
+        pos = (transfers.c.created_at, transfers.c.id)
+        query = select(*_transfer_columns).where(transfers.c.has_debit)
+    if since is not None:
+        query = query.where(pos[0] >= since)
+    if after is not None:
+        query = query.where(tuple_(*pos) > tuple_(*after))
+    res = await session.execute(query.order_by(*pos).limit(limit))
+    return res.mappings().all()
+
+# A position in an account's legs: (created_at, transfer_id, direction), the order of
+# idx_account_entries_statement. A balance "at" a position includes the leg there.
+STATEMENT_ORIGIN = (datetime.min.replace(tzinfo=timezone.utc), 0, 0)
+STATEMENT_END = datetime.max.replace(tzinfo=timezone.utc)
+STATEMENT_PAGE_SIZE = 100
+STATEMENT_PAGE_MAX = 500
+
+def _anchor_sql(acct: str, at: str, transfer_id: str) -> str:
+    """Latest known balance of ``acct`` strictly before (``at``, ``transfer_id``).
+
+    The candidates are the latest checkpoint before it and the end of the
+    archived months (start_balance plus every archived delta). The latter also
+    covers an account that has no archive, from '-infinity'. Only valid at
+    positions after the archived months.
+    """
+    return f"""
+    SELECT created_at, transfer_id, balance FROM (
+        (SELECT c.created_at, c.transfer_id, c.balance FROM account_balance_checkpoints c
+         WHERE c.account_id = {acct} AND (c.created_at, c.transfer_id) < ({at}, {transfer_id})
+         ORDER BY c.created_at DESC, c.transfer_id DESC LIMIT 1)
+        UNION ALL
+        SELECT COALESCE((SELECT MAX(r.range_end) FROM ledger_archives r), '-infinity'), 0,
+               (SELECT acc.start_balance FROM accounts acc WHERE acc.id = {acct}::text)
+               + COALESCE((SELECT SUM(d.delta) FROM ledger_archive_deltas d WHERE d.account_id = {acct}), 0)
+    ) candidates
+    ORDER BY created_at DESC, transfer_id DESC LIMIT 1
+    """
+
+_ACCT = "CAST(:account_id AS uuid)"
+_POS = "(CAST(:pos_at AS timestamptz), CAST(:pos_id AS bigint), CAST(:pos_dir AS smallint))"
+
+# The balance at :pos (the anchor plus the few legs after it), then the next
+# :limit legs with their running balance. A page with no legs still returns one
+# row carrying the opening balance.
+_STATEMENT_SQL = text(f"""
+WITH anchor AS ({_anchor_sql(_ACCT, "CAST(:pos_at AS timestamptz)", "CAST(:pos_id AS bigint)")}),
+seed AS (
+    SELECT anchor.balance + COALESCE((
+        SELECT SUM(e.amount * e.direction) FROM account_entries e
+        WHERE e.account_id = {_ACCT}
+          AND (e.created_at, e.transfer_id) > (anchor.created_at, anchor.transfer_id)
+          AND (e.created_at, e.transfer_id, e.direction) <= {_POS}
+    ), 0) AS balance
+    FROM anchor
+),
+page AS (
+    SELECT e.created_at, e.transfer_id, e.direction, e.amount FROM account_entries e
+    WHERE e.account_id = {_ACCT}
+      AND (e.created_at, e.transfer_id, e.direction) > {_POS}
+      AND e.created_at < CAST(:until AS timestamptz)
+    ORDER BY e.created_at, e.transfer_id, e.direction
+    LIMIT :limit
+)
+SELECT seed.balance AS opening, p.created_at, p.transfer_id, p.direction, p.amount,
+       seed.balance + SUM(p.amount * p.direction)
+           OVER (ORDER BY p.created_at, p.transfer_id, p.direction) AS balance_after,
+       t.tx_id::text AS tx_id,
+       (CASE WHEN p.direction < 0 THEN t.to_account ELSE t.from_account END)::text AS counterparty
+FROM seed
+LEFT JOIN (page p JOIN transfers t ON t.id = p.transfer_id AND t.created_at = p.created_at) ON true
+ORDER BY p.created_at, p.transfer_id, p.direction
+""")
+
+async def get_statement_page(
+    session: AsyncSession,
+    account_id: str,
+    pos: Tuple[datetime, int, int] = STATEMENT_ORIGIN,
+    until: datetime = STATEMENT_END,
+    limit: int = STATEMENT_PAGE_SIZE,
+):
+    """(opening balance, lines): the account's legs after ``pos`` and before ``until``, with running balances.
+
+    The opening balance is seeded from the nearest checkpoint, so the cost of
+    a page depends on the legs since that checkpoint, not on the account's age.
+    ``pos`` must not fall inside an archived month (see
+    ``archive.statement_lines``).
+    """
+    res = await session.execute(_STATEMENT_SQL, {
+        "account_id": account_id, "pos_at": pos[0], "pos_id": pos[1], "pos_dir": pos[2],
+        "until": until, "limit": limit,
+    })
+    rows = res.all()
+    opening = int(rows[0].opening) if rows and rows[0].opening is not None else 0
+    return opening, [r for r in rows if r.created_at is not None]
+
+# One checkpoint per account with at least :min_entries legs since its latest
+# anchor, at its last leg before :upto.
+_CHECKPOINT_SQL = text(f"""
+INSERT INTO account_balance_checkpoints (account_id, created_at, transfer_id, balance)
+SELECT o.id, last.created_at, last.transfer_id, anchor.balance + tail.delta
+FROM (SELECT CAST(id AS uuid) AS id FROM unnest(CAST(:ids AS text[])) AS ids(id)) o
+CROSS JOIN LATERAL ({_anchor_sql("o.id", "CAST(:upto AS timestamptz)", "0")}) anchor
+CROSS JOIN LATERAL (
+    SELECT COALESCE(SUM(e.amount * e.direction), 0) AS delta, count(*) AS n FROM account_entries e
+    WHERE e.account_id = o.id
+      AND (e.created_at, e.transfer_id) > (anchor.created_at, anchor.transfer_id)
+      AND e.created_at < CAST(:upto AS timestamptz)
+) tail
+CROSS JOIN LATERAL (
+    SELECT e.created_at, e.transfer_id FROM account_entries e
+    WHERE e.account_id = o.id AND e.created_at < CAST(:upto AS timestamptz)
+    ORDER BY e.created_at DESC, e.transfer_id DESC, e.direction DESC LIMIT 1
+) last
+WHERE tail.n >= :min_entries
+ON CONFLICT DO NOTHING
+""")
+
+async def write_checkpoints(
+    session: AsyncSession, upto: datetime, min_entries: int, after: str = "", batch: int = 1000,
+) -> Tuple[Optional[str], int]:
+    """Checkpoint the next ``batch`` accounts after id ``after``; returns (last account id or None, rows written).
+
+    ``upto`` must be far enough in the past that no transaction still in
+    flight can add a leg before it: a checkpoint never sees legs committed
+    behind it.
+    """
+    ids = (await session.execute(
+        select(accounts.c.id).where(accounts.c.id > after).order_by(accounts.c.id).limit(batch)
+    )).scalars().all()
+    if not ids:
+        return None, 0
+    res = await session.execute(_CHECKPOINT_SQL, {"ids": list(ids), "upto": upto, "min_entries": min_entries})
+    return ids[-1], res.rowcount
+
+# Every account in :ids (all when NULL) with its balance after the legs at or
+# before :at: the latest anchor at or before :at plus the legs since.
+_BALANCES_AT_SQL = text(f"""
+SELECT o.id, o.currency, anchor.balance + COALESCE(tail.delta, 0) AS balance
+FROM (
+    SELECT id, currency, CAST(id AS uuid) AS uid FROM accounts
+    WHERE CAST(:ids AS text[]) IS NULL OR id = ANY(CAST(:ids AS text[]))
+) o
+CROSS JOIN LATERAL ({_anchor_sql("o.uid", "CAST(:at AS timestamptz)", "9223372036854775807")}) anchor
+CROSS JOIN LATERAL (
+    SELECT SUM(e.amount * e.direction) AS delta FROM account_entries e
+    WHERE e.account_id = o.uid
+      AND (e.created_at, e.transfer_id) > (anchor.created_at, anchor.transfer_id)
+      AND e.created_at <= CAST(:at AS timestamptz)
+) tail
+ORDER BY o.id
+""")
+
+async def balances_at(
+    session: AsyncSession, at: datetime, account_ids: Optional[List[str]] = None, batch: int = EXPORT_PAGE_SIZE,
+):
+    """Pages of (account_id, currency, balance) as of ``at``, in account id order, from one streamed query.
+
+    Each balance is the nearest checkpoint at or before ``at`` plus the legs
+    after it. ``at`` must not fall inside an archived month (see
+    ``archive.balances_at``).
+    """
+    result = await session.stream(_BALANCES_AT_SQL, {"at": at, "ids": account_ids})
+    async for chunk in result.partitions(batch):
+        yield [(r.id, r.currency, int(r.balance)) for r in chunk]
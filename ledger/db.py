@@ -1,10 +1,19 @@
 """Async DB engine & schema metadata for the ledger service."""
 
+import asyncio
 import os
+import time
 from typing import Optional
-from sqlalchemy import MetaData, Table, Column, String, BigInteger, DateTime, text, JSON as SA_JSON
+from sqlalchemy import (
+    MetaData, Table, Column, String, BigInteger, Integer, SmallInteger, Boolean, DateTime, ForeignKey, text, event,
+    JSON as SA_JSON,
+)
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from loguru import logger
+
+from common import metrics, tracing
 
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
@@ -26,16 +35,94 @@ accounts = Table(
     Column("currency", String, nullable=False, server_default=text("'INR'")),
     Column("start_balance", BigInteger, nullable=False, server_default=text("0")),
     Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+    Column("hot_buckets", Integer, nullable=False, server_default=text("0")),
 )
 
-ledger_entries = Table(
-    "ledger_entries", metadata,
+# One row per transfer; has_debit is false only on the credit shard of a cross-shard transfer.
+# This table and account_entries are partitioned by month on created_at (see ledger.partitions).
+transfers = Table(
+    "transfers", metadata,
     Column("id", BigInteger, primary_key=True, autoincrement=True),
-    Column("tx_id", String, nullable=False),
+    Column("tx_id", UUID(as_uuid=False), nullable=False, index=True),
+    Column("from_account", UUID(as_uuid=False), nullable=False),
+    Column("to_account", UUID(as_uuid=False), nullable=False),
+    Column("amount", BigInteger, nullable=False),
+    Column("currency", String, nullable=False),
+    Column("created_at", DateTime(timezone=True), primary_key=True, server_default=text("now()")),
+    Column("has_debit", Boolean, nullable=False, server_default=text("true")),
+)
+
+# the legs of each transfer held on this shard
+account_entries = Table(
+    "account_entries", metadata,
+    Column("transfer_id", BigInteger, primary_key=True),
+    Column("account_id", UUID(as_uuid=False), nullable=False),
+    Column("amount", BigInteger, nullable=False),
+    Column("created_at", DateTime(timezone=True), primary_key=True),
+    Column("direction", SmallInteger, primary_key=True),
+)
+
+# account_entries.direction: the sign of the leg's effect on the balance
+DEBIT, CREDIT = -1, 1
+DIRECTIONS = {"DEBIT": DEBIT, "CREDIT": CREDIT}
+
+# posted balance of an account after all of its legs up to (created_at, transfer_id)
+account_balance_checkpoints = Table(
+    "account_balance_checkpoints", metadata,
+    Column("account_id", UUID(as_uuid=False), primary_key=True),
+    Column("created_at", DateTime(timezone=True), primary_key=True),
+    Column("transfer_id", BigInteger, primary_key=True),
+    Column("balance", BigInteger, nullable=False),
+)
+
+# closed months moved out to Parquet files by ledger.partitions
+ledger_archives = Table(
+    "ledger_archives", metadata,
+    Column("name", String, primary_key=True),
+    Column("range_start", DateTime(timezone=True)),
+    Column("range_end", DateTime(timezone=True), nullable=False),
+    Column("transfers_path", String, nullable=False),
+    Column("entries_path", String, nullable=False),
+    Column("transfer_count", BigInteger, nullable=False),
+    Column("entry_count", BigInteger, nullable=False),
+    Column("archived_at", DateTime(timezone=True), server_default=text("now()")),
+)
+
+# what each archive adds to each account's balance
+ledger_archive_deltas = Table(
+    "ledger_archive_deltas", metadata,
+    Column("account_id", UUID(as_uuid=False), primary_key=True),
+    Column("archive", String, ForeignKey("ledger_archives.name"), primary_key=True),
+    Column("delta", BigInteger, nullable=False),
+    Column("entry_count", BigInteger, nullable=False),
+)
+
+account_balances = Table(
+    "account_balances", metadata,
+    Column("account_id", String, primary_key=True),
+    Column("balance", BigInteger, nullable=False),
+    Column("version", BigInteger, nullable=False, server_default=text("0")),
+    Column("updated_at", DateTime(timezone=True), server_default=text("now()")),
+)
+
+# unconsolidated credits of hot accounts; the balance is the main row plus these
+account_balance_buckets = Table(
+    "account_balance_buckets", metadata,
+    Column("account_id", String, primary_key=True),
+    Column("bucket", Integer, primary_key=True),
+    Column("delta", BigInteger, nullable=False, server_default=text("0")),
+)
+
+transfer_legs = Table(
+    "transfer_legs", metadata,
+    Column("tx_id", String, primary_key=True),
+    Column("direction", String, primary_key=True),
     Column("account_id", String, nullable=False),
-    Column("direction", String, nullable=False),
+    Column("counterparty", String, nullable=False),
     Column("amount", BigInteger, nullable=False),
+    Column("state", String, nullable=False),
     Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+    Column("updated_at", DateTime(timezone=True), server_default=text("now()")),
 )
 
 idempotency_keys = Table(
@@ -47,15 +134,125 @@ idempotency_keys = Table(
     Column("created_at", DateTime(timezone=True), server_default=text("now()")),
 )
 
+# keys of applied transfers, for ledger-side dedupe (see crud.claim_idempotency_key)
+ledger_idempotency_keys = Table(
+    "ledger_idempotency_keys", metadata,
+    Column("key", String, primary_key=True),
+    Column("tx_id", String),
+    Column("response", SA_JSON),
+    Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+)
+
+# set on shard servers that own a database of their own (see ensure_database)
+LEDGER_CREATE_DATABASE = os.getenv("LEDGER_CREATE_DATABASE", "0") == "1"
+# per-process connection pool; the supervisor overrides these from LEDGER_DB_CONN_BUDGET
+LEDGER_DB_POOL_SIZE = int(os.getenv("LEDGER_DB_POOL_SIZE", "5"))
+LEDGER_DB_MAX_OVERFLOW = int(os.getenv("LEDGER_DB_MAX_OVERFLOW", "10"))
+# streaming replica for read-only RPCs; empty = every read goes to the primary
+POSTGRES_READ_HOST = os.getenv("POSTGRES_READ_HOST", "")
+POSTGRES_READ_PORT = int(os.getenv("POSTGRES_READ_PORT", str(POSTGRES_PORT)))
+# replica reads fall back to the primary while replay lag is above this or unknown
+REPLICA_MAX_LAG_S = float(os.getenv("REPLICA_MAX_LAG_S", "1"))
+REPLICA_LAG_CHECK_S = float(os.getenv("REPLICA_LAG_CHECK_S", "0.5"))
+
+READ_DATABASE_URL = (
+    f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}"
+    f"@{POSTGRES_READ_HOST}:{POSTGRES_READ_PORT}/{POSTGRES_DB}"
+)
+
 _engine: Optional[AsyncEngine] = None
 _async_session = None
+_read_engine: Optional[AsyncEngine] = None
+_read_session = None
+# last sampled replay lag; None = not checked yet or replica unreachable
+_replica_lag: Optional[float] = None
+_pool_size = LEDGER_DB_POOL_SIZE
+_max_overflow = LEDGER_DB_MAX_OVERFLOW
+
+db_query_seconds = metrics.Histogram(
+    "ledger_db_query_seconds", "Postgres statement latency by statement type",
+)
+db_pool_connections = metrics.Gauge(
+    "ledger_db_pool_connections", "Connections in this process's SQLAlchemy pool by state",
+)
+row_lock_hold_seconds = metrics.Histogram(
+    "ledger_row_lock_hold_seconds", "Time balance rows stay locked (first FOR UPDATE to commit/rollback)",
+)
+db_reads_total = metrics.Counter(
+    "ledger_db_reads_total", "Read-only sessions by target (replica, primary) and routing reason",
+)
+replica_lag_seconds = metrics.Gauge(
+    "ledger_replica_lag_seconds", "Read replica replay lag at the last check (-1 = unreachable)",
+)
+
+def _instrument(engine: AsyncEngine):
+    # the async driver runs inside these hooks, so the span covers the round trip
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        op = statement.lstrip().split(None, 1)[0].upper()
+        s = tracing.span(f"db {op}", kind=tracing.CLIENT, **{"db.statement": statement[:500]})
+        conn.info.setdefault("query_start", []).append((time.perf_counter(), op, s))
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        start, op, s = conn.info["query_start"].pop()
+        db_query_seconds.observe(time.perf_counter() - start, op=op)
+        s.end()
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _error(exc_context):
+        conn = exc_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            _, _, s = conn.info["query_start"].pop()
+            s.fail(str(exc_context.original_exception))
+            s.end()
+
+@metrics.on_collect
+def _sample_pool():
+    for role, engine in (("primary", _engine), ("replica", _read_engine)):
+        if engine is not None:
+            pool = engine.pool
+            db_pool_connections.set(pool.checkedout(), state="checked_out", role=role)
+            db_pool_connections.set(pool.checkedin(), state="idle", role=role)
+
+# crud.lock_balances stamps session.info["locked_at"]; the locks go away with the transaction
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _locks_released(session):
+    locked_at = session.info.pop("locked_at", None)
+    if locked_at is not None:
+        row_lock_hold_seconds.observe(time.perf_counter() - locked_at)
+
+def configure_pool(pool_size: int, max_overflow: int):
+    """Set the pool size for this process; must run before the engine is created."""
+    global _pool_size, _max_overflow
+    _pool_size, _max_overflow = pool_size, max_overflow
 
 async def get_engine() -> AsyncEngine:
     global _engine
     if _engine is None:
-        _engine = create_async_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
+        _engine = create_async_engine(
+            DATABASE_URL, echo=False, pool_pre_ping=True, pool_size=_pool_size, max_overflow=_max_overflow,
+        )
+        _instrument(_engine)
     return _engine
 
+async def get_read_engine() -> AsyncEngine:
+    global _read_engine
+    if _read_engine is None:
+        _read_engine = create_async_engine(
+            READ_DATABASE_URL, echo=False, pool_pre_ping=True, pool_size=_pool_size, max_overflow=_max_overflow,
+        )
+        _instrument(_read_engine)
+    return _read_engine
+
+async def dispose_engine():
+    global _engine, _async_session, _read_engine, _read_session
+    for engine in (_engine, _read_engine):
+        if engine is not None:
+            await engine.dispose()
+    _engine, _async_session, _read_engine, _read_session = None, None, None, None
+
 async def get_session() -> AsyncSession:
     global _async_session
     if _async_session is None:
@@ -63,12 +260,86 @@ async def get_session() -> AsyncSession:
         _async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
     return _async_session()
 
-async def apply_migrations():
+def _read_route(consistent: bool) -> str:
+    """Why a read goes to the primary, or ``ok`` for the replica."""
+    if consistent:
+        return "consistent"
+    if not POSTGRES_READ_HOST:
+        return "no_replica"
+    if _replica_lag is None:
+        return "unreachable"
+    if _replica_lag > REPLICA_MAX_LAG_S:
+        return "lagging"
+    return "ok"
+
+async def get_read_session(consistent: bool = False) -> AsyncSession:
+    """Session for read-only work: the replica while it is within REPLICA_MAX_LAG_S, else the primary.
+
+    ``consistent`` forces the primary, for callers that must see their own
+    writes. Replica sessions carry ``info["replica"] = True``.
+    """
+    global _read_session
+    route = _read_route(consistent)
+    if route != "ok":
+        db_reads_total.inc(target="primary", reason=route)
+        return await get_session()
+    db_reads_total.inc(target="replica", reason=route)
+    if _read_session is None:
+        engine = await get_read_engine()
+        _read_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession, info={"replica": True})
+    return _read_session()
+
+# an idle primary sends no new WAL, so a replica that has replayed everything it received is current
+_REPLICA_LAG_SQL = text("""
+SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                     ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0)
+""")
+
+async def _sample_replica_lag() -> float:
+    engine = await get_read_engine()
+    async with engine.connect() as conn:
+        return float((await conn.execute(_REPLICA_LAG_SQL)).scalar_one())
+
+async def monitor_replica():
+    """Sample the replica's replay lag every REPLICA_LAG_CHECK_S; get_read_session routes on the last sample."""
+    global _replica_lag
+    while True:
+        try:
+            lag = await asyncio.wait_for(_sample_replica_lag(), timeout=max(2.0, REPLICA_LAG_CHECK_S))
+        except Exception as e:
+            if _replica_lag is not None:
+                logger.warning(f"Read replica unreachable, reading from the primary: {e!r}")
+            lag = None
+        if lag is not None and _replica_lag is None:
+            logger.info(f"Read replica available (lag {lag:.3f}s)")
+        _replica_lag = lag
+        replica_lag_seconds.set(-1 if lag is None else lag)
+        await asyncio.sleep(REPLICA_LAG_CHECK_S)
+
+async def ensure_database():
+    """CREATE DATABASE for this ledger (shard) if it does not exist yet."""
+    admin_url = DATABASE_URL.rsplit("/", 1)[0] + "/postgres"
+    admin = create_async_engine(admin_url, isolation_level="AUTOCOMMIT")
+    try:
+        async with admin.connect() as conn:
+            res = await conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :db"), {"db": POSTGRES_DB})
+            if res.scalar_one_or_none() is None:
+                await conn.execute(text(f'CREATE DATABASE "{POSTGRES_DB}"'))
+    finally:
+        await admin.dispose()
+
+async def apply_migrations(conn=None):
+    """Run migrations.sql in one transaction, or on ``conn`` inside the caller's."""
     # run raw SQL file
-    engine = await get_engine()
     sql_path = os.path.join(os.path.dirname(__file__), "migrations.sql")
     with open(sql_path, "r", encoding="utf-8") as f:
         sql_text = f.read()
-    async with engine.begin() as conn:
-        for statement in sql_text.split(';')[:-1]: # Split by semicolon and ignore the last empty string
-            await conn.execute(text(statement))
+    statements = sql_text.split(';')[:-1] # Split by semicolon and ignore the last empty string
+    if conn is None:
+        engine = await get_engine()
+        async with engine.begin() as conn:
+            for statement in statements:
+                await conn.execute(text(statement))
+        return
+    for statement in statements:
+        await conn.execute(text(statement))
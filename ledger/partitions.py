@@ -0,0 +1,321 @@
+"""Monthly partitions of ``transfers`` and ``account_entries``, and archival of closed months.
+
+Usage (inside the ledger container):
+  python -m ledger.partitions ensure [--ahead 3]
+  python -m ledger.partitions list
+  python -m ledger.partitions archive [--keep-months 3] [--keep-detached] [--dry-run]
+  python -m ledger.partitions convert
+
+Both tables are range partitioned on ``created_at``, one partition per UTC
+calendar month, named ``<table>_pYYYY_MM``. ``ensure`` creates the partitions
+from this month to ``--ahead`` months out. The ledger server does the same at
+startup and every ``LEDGER_PARTITION_CHECK_S``, so an insert never finds its
+month missing.
+
+``archive`` handles every month that ended more than ``--keep-months`` months
+ago:
+
+1. It exports both partitions to Parquet files in ``LEDGER_ARCHIVE_DIR`` and
+   checks each file's row count and amount total against its table.
+2. In one transaction, it stores each account's net change for the month in
+   ``ledger_archive_deltas``, records the files in ``ledger_archives`` and
+   detaches both partitions.
+3. It drops the detached tables, unless ``--keep-detached`` is given.
+
+Balances add ``ledger_archive_deltas`` to the live legs, so archiving a month
+does not change them. Exports read archived months back from the files.
+
+``convert`` partitions the plain tables created by earlier releases. The
+existing rows become one partition that ends at a month boundary. The indexes
+that partition needs are built concurrently first. The swap itself holds
+both tables locked for a moment.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from loguru import logger
+from sqlalchemy import text
+
+from . import archive, db
+
+# months of partitions kept ready beyond the current one
+LEDGER_PARTITION_AHEAD_MONTHS = int(os.getenv("LEDGER_PARTITION_AHEAD_MONTHS", "3"))
+# how often the server re-runs ensure (0 = only at startup)
+LEDGER_PARTITION_CHECK_S = float(os.getenv("LEDGER_PARTITION_CHECK_S", "3600"))
+# complete months kept in Postgres by `archive`
+LEDGER_ARCHIVE_KEEP_MONTHS = int(os.getenv("LEDGER_ARCHIVE_KEEP_MONTHS", "3"))
+
+PARTITIONED = ("transfers", "account_entries")
+
+# bounds of every partition of :parent; range_start is NULL for FROM (MINVALUE)
+_PARTITIONS_SQL = text(r"""
+SELECT c.relname AS name,
+       (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'FROM \(''([^'']+)''\)'))[1]::timestamptz AS range_start,
+       (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''([^'']+)''\)'))[1]::timestamptz AS range_end,
+       GREATEST(c.reltuples, 0)::bigint AS rows, pg_total_relation_size(c.oid) AS bytes
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = CAST(:parent AS regclass)
+ORDER BY range_end
+""")
+
+def month_start(ts: datetime) -> datetime:
+    ts = ts.astimezone(timezone.utc)
+    return datetime(ts.year, ts.month, 1, tzinfo=timezone.utc)
+
+def add_months(month: datetime, n: int) -> datetime:
+    m = month.year * 12 + month.month - 1 + n
+    return datetime(m // 12, m % 12 + 1, 1, tzinfo=timezone.utc)
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+async def _is_partitioned(conn, table: str) -> bool:
+    # compared in SQL: asyncpg returns the "char" relkind as bytes
+    res = await conn.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:t)"), {"t": table})
+    return bool(res.scalar_one_or_none())
+
+async def _partitions(conn, table: str) -> list:
+    return (await conn.execute(_PARTITIONS_SQL, {"parent": table})).all()
+
+async def _create_months(conn, first: datetime, last: datetime) -> List[str]:
+    archived = (await conn.execute(text("SELECT range_start, range_end FROM ledger_archives"))).all()
+    created = []
+    for table in PARTITIONED:
+        if not await _is_partitioned(conn, table):
+            logger.warning(f"{table} is not partitioned yet; run python -m ledger.partitions convert")
+            continue
+        # never recreate a month that was archived, or overlap the open-ended partition left by convert
+        taken = [(p.range_start, p.range_end) for p in await _partitions(conn, table)] + list(archived)
+        month = first
+        while month <= last:
+            end = add_months(month, 1)
+            if not any((start is None or start < end) and stop > month for start, stop in taken):
+                name = partition_name(table, month)
+                await conn.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{end.isoformat()}')"
+                ))
+                created.append(name)
+            month = end
+    return created
+
+async def ensure(first: Optional[datetime] = None, ahead: int = LEDGER_PARTITION_AHEAD_MONTHS) -> List[str]:
+    """Create the monthly partitions from ``first`` (default: this month) to ``ahead`` months out."""
+    this_month = month_start(datetime.now(timezone.utc))
+    engine = await db.get_engine()
+    async with engine.begin() as conn:
+        # several ledger processes (and shards sharing a database) run this at startup
+        await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('ledger.partitions'))"))
+        # creating a partition locks the parent; give up rather than queue transfers behind a long read
+        await conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+        created = await _create_months(conn, month_start(first or this_month), add_months(this_month, ahead))
+    if created:
+        logger.info(f"Created partitions {', '.join(created)}")
+    return created
+
+async def run_maintainer(interval_s: float):
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            await ensure()
+        except Exception as e:
+            logger.error(f"Partition maintenance failed: {e}")
+
+async def _archive_month(engine, name: str, range_start, range_end, out_dir: str, keep_detached: bool):
+    """Export, check, detach and drop the ``<table>_<name>`` partitions of one month."""
+    tables = {kind: f"{kind}_{name}" for kind in PARTITIONED}
+    paths = {kind: os.path.join(out_dir, f"{kind}_{name}.parquet") for kind in PARTITIONED}
+    written = {}
+    for kind in PARTITIONED:
+        async with engine.connect() as conn:
+            written[kind] = await archive.export_table(conn, kind, tables[kind], paths[kind])
+        if await asyncio.to_thread(archive.file_totals, paths[kind]) != written[kind]:
+            raise RuntimeError(f"{paths[kind]} does not read back what was written")
+    async with engine.begin() as conn:
+        await conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+        # closed months take no writes, but make sure nothing lands between the check and the detach
+        await conn.execute(text(f"LOCK TABLE {tables['transfers']}, {tables['account_entries']} IN SHARE MODE"))
+        for kind in PARTITIONED:
+            res = await conn.execute(text(f"SELECT count(*), COALESCE(SUM(amount), 0) FROM {tables[kind]}"))
+            if tuple(res.one()) != written[kind]:
+                raise RuntimeError(f"{tables[kind]} changed while it was being exported")
+        await conn.execute(
+            text(
+                "INSERT INTO ledger_archives "
+                "(name, range_start, range_end, transfers_path, entries_path, transfer_count, entry_count) "
+                "VALUES (:name, :range_start, :range_end, :transfers_path, :entries_path, :transfers, :entries)"
+            ),
+            dict(
+                name=name, range_start=range_start, range_end=range_end,
+                transfers_path=paths["transfers"], entries_path=paths["account_entries"],
+                transfers=written["transfers"][0], entries=written["account_entries"][0],
+            ),
+        )
+        await conn.execute(text(
+            "INSERT INTO ledger_archive_deltas (account_id, archive, delta, entry_count) "
+            f"SELECT account_id, :name, SUM(amount * direction), count(*) FROM {tables['account_entries']} "
+            "GROUP BY account_id"
+        ), {"name": name})
+        for kind in reversed(PARTITIONED):
+            await conn.execute(text(f"ALTER TABLE {kind} DETACH PARTITION {tables[kind]}"))
+    if not keep_detached:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP TABLE {tables['account_entries']}, {tables['transfers']}"))
+    logger.info(
+        f"Archived {name}: {written['transfers'][0]} transfers, {written['account_entries'][0]} legs -> {out_dir}"
+    )
+
+async def archive_closed(
+    keep_months: int = LEDGER_ARCHIVE_KEEP_MONTHS, keep_detached: bool = False, dry_run: bool = False,
+) -> List[str]:
+    """Archive and detach every month that ended more than ``keep_months`` months ago; returns their names."""
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -max(0, keep_months))
+    engine = await db.get_engine()
+    async with engine.connect() as conn:
+        for table in PARTITIONED:
+            if not await _is_partitioned(conn, table):
+                logger.error(f"{table} is not partitioned; run python -m ledger.partitions convert first")
+                return []
+        closed = [p for p in await _partitions(conn, "transfers") if p.range_end <= cutoff]
+    out_dir = archive.archive_dir()
+    os.makedirs(out_dir, exist_ok=True)
+    done = []
+    for p in closed:
+        name = p.name[len("transfers_"):]
+        if dry_run:
+            logger.info(f"Would archive {name} (up to {p.range_end}, ~{p.rows} transfers)")
+            continue
+        await _archive_month(engine, name, p.range_start, p.range_end, out_dir, keep_detached)
+        done.append(name)
+    return done
+
+async def show():
+    engine = await db.get_engine()
+    async with engine.connect() as conn:
+        for table in PARTITIONED:
+            if not await _is_partitioned(conn, table):
+                print(f"{table}: not partitioned")
+                continue
+            print(f"{table}:")
+            for p in await _partitions(conn, table):
+                start = p.range_start.date() if p.range_start else "MINVALUE"
+                print(f"  {p.name:<32} {start} .. {p.range_end.date()}  ~{p.rows} rows  {p.bytes / 2**20:.1f} MB")
+        archives = (await conn.execute(text(
+            "SELECT name, range_end, transfer_count, entry_count, transfers_path "
+            "FROM ledger_archives ORDER BY range_end"
+        ))).all()
+    if archives:
+        print("archived:")
+    for a in archives:
+        print(
+            f"  {a.name:<32} until {a.range_end.date()}  {a.transfer_count} transfers  {a.entry_count} legs"
+            f"  {os.path.dirname(a.transfers_path)}"
+        )
+
+# (table, primary key columns, indexes that migrations.sql puts on the partitioned table)
+_CONVERT = (
+    ("transfers", "id, created_at", ("idx_transfers_created", "idx_transfers_tx")),
+    ("account_entries", "transfer_id, direction, created_at", ("idx_account_entries_statement",)),
+)
+
+async def convert() -> bool:
+    """Turn plain ``transfers``/``account_entries`` into partitioned tables; returns False if not possible."""
+    engine = await db.get_engine()
+    async with engine.connect() as conn:
+        plain = [t for t in PARTITIONED if not await _is_partitioned(conn, t)]
+    if not plain:
+        logger.info("transfers and account_entries are already partitioned")
+        return True
+    if len(plain) != len(PARTITIONED):
+        logger.error(f"Only {', '.join(plain)} is unpartitioned; expected both tables in the same layout")
+        return False
+    # the existing table keeps every row before the month after next, so inserts made during the convert fit
+    bound = add_months(month_start(datetime.now(timezone.utc)), 2).isoformat()
+
+    # Phase 1 takes no lock that blocks transfers. The bound check and the
+    # indexes let ATTACH PARTITION skip its scan and its index builds.
+    auto = engine.execution_options(isolation_level="AUTOCOMMIT")
+    async with auto.connect() as conn:
+        await conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transfers_tx ON transfers (tx_id)"))
+        await conn.execute(text(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_account_entries_statement "
+            "ON account_entries (account_id, created_at, transfer_id, direction) INCLUDE (amount)"
+        ))
+        for table, pk, _ in _CONVERT:
+            await conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_initial_bound"))
+            await conn.execute(text(
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_initial_bound CHECK (created_at < '{bound}') NOT VALID"
+            ))
+            await conn.execute(text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_initial_bound"))
+            await conn.execute(text(
+                f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {table}_initial_pkey ON {table} ({pk})"
+            ))
+        logger.info("Indexes for the initial partitions built; swapping tables")
+
+    # Phase 2: rename the plain tables out of the way, create the partitioned
+    # ones and attach the old tables as their first partition.
+    async with engine.begin() as conn:
+        await conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+        await conn.execute(text("LOCK TABLE transfers, account_entries IN ACCESS EXCLUSIVE MODE"))
+        # seeds missing balance rows while the legs are still visible under the old names
+        await db.apply_migrations(conn)
+        await conn.execute(text(
+            "ALTER TABLE account_entries DROP CONSTRAINT IF EXISTS account_entries_transfer_id_fkey"
+        ))
+        await conn.execute(text("ALTER TABLE transfers DROP CONSTRAINT IF EXISTS transfers_tx_id_key"))
+        for table, _, indexes in _CONVERT:
+            await conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {table}_pkey"))
+            await conn.execute(text(
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_initial_pkey PRIMARY KEY USING INDEX {table}_initial_pkey"
+            ))
+            await conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_initial"))
+            for index in indexes:
+                await conn.execute(text(f"ALTER INDEX IF EXISTS {index} RENAME TO {index}_initial"))
+        # the new table's BIGSERIAL takes over the name and continues the ids
+        await conn.execute(text("ALTER SEQUENCE transfers_id_seq RENAME TO transfers_initial_id_seq"))
+        await db.apply_migrations(conn)
+        for table, _, _ in _CONVERT:
+            await conn.execute(text(
+                f"ALTER TABLE {table} ATTACH PARTITION {table}_initial FOR VALUES FROM (MINVALUE) TO ('{bound}')"
+            ))
+            await conn.execute(text(f"ALTER TABLE {table}_initial DROP CONSTRAINT {table}_initial_bound"))
+        await conn.execute(text(
+            "SELECT setval(pg_get_serial_sequence('transfers', 'id'), "
+            "(SELECT COALESCE(MAX(id), 0) + 1 FROM transfers_initial), false)"
+        ))
+    logger.info(f"Partitioned transfers and account_entries; rows before {bound} are in the *_initial partitions")
+    await ensure()
+    return True
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="ledger.partitions")
+    parser.add_argument("command", choices=["ensure", "list", "archive", "convert"])
+    parser.add_argument("--ahead", type=int, default=LEDGER_PARTITION_AHEAD_MONTHS, help="months to create ahead")
+    parser.add_argument(
+        "--keep-months", type=int, default=LEDGER_ARCHIVE_KEEP_MONTHS, help="complete months to keep in Postgres",
+    )
+    parser.add_argument("--keep-detached", action="store_true", help="leave archived partitions as plain tables")
+    parser.add_argument("--dry-run", action="store_true", help="only list the months `archive` would move")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "convert":
+            return 0 if await convert() else 1
+        await db.apply_migrations()
+        if args.command == "ensure":
+            await ensure(ahead=args.ahead)
+        elif args.command == "list":
+            await show()
+        else:
+            await archive_closed(args.keep_months, args.keep_detached, args.dry_run)
+        return 0
+    finally:
+        await db.dispose_engine()
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,20 +1,84 @@
 """gRPC Ledger Service."""
 
 import asyncio
+import base64
+import hmac
+import json
 import os
+import signal
+from datetime import datetime, timezone
+from typing import Optional
+
 import grpc
 from loguru import logger
 
-from . import db, crud
-from .db import get_session
+from common import metrics, profiler, tracing
+
+from . import db, crud, balances, compact, partitions, archive
+from .db import get_session, get_read_session
+from .batcher import TransferBatcher, LEDGER_BATCH_ENABLED
 
 import payment_pb2
 import payment_pb2_grpc
 
 LEDGER_GRPC_PORT = int(os.getenv("LEDGER_GRPC_PORT", "50051"))
+# how often hot-account buckets are folded into their main rows (0 = never)
+LEDGER_CONSOLIDATE_INTERVAL_S = float(os.getenv("LEDGER_CONSOLIDATE_INTERVAL_S", "5"))
+# > 1: run under ledger.supervisor with this many worker processes
+LEDGER_WORKERS = int(os.getenv("LEDGER_WORKERS", "1"))
+# how long in-flight RPCs may run after SIGTERM before they are cancelled
+LEDGER_DRAIN_GRACE_S = float(os.getenv("LEDGER_DRAIN_GRACE_S", "10"))
+# Prometheus text on this port (+ worker id under the supervisor); 0 = off
+LEDGER_METRICS_PORT = int(os.getenv("LEDGER_METRICS_PORT", "9110"))
+# sampling follows the gateway's traceparent; these only say where sampled spans go
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+# LedgerAdmin gRPC on this port (+ worker id); off unless both port and token are set
+LEDGER_ADMIN_PORT = int(os.getenv("LEDGER_ADMIN_PORT", "0"))
+LEDGER_ADMIN_TOKEN = os.getenv("LEDGER_ADMIN_TOKEN", "")
+# profile every RPC slower than this (0 = off) into PROFILE_DIR
+PROFILE_SLOW_REQUEST_MS = float(os.getenv("PROFILE_SLOW_REQUEST_MS", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+# log event-loop blocks longer than this, with the blocking stack (0 = off)
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100"))
+
+rpc_seconds = metrics.Histogram("ledger_rpc_seconds", "Ledger RPC handling time by method")
+transfers_total = metrics.Counter("ledger_transfers_total", "Transfer RPC results by status and reason")
+batch_queue_depth = metrics.Gauge("ledger_batch_queue_depth", "Transfers waiting for the group-commit batcher")
+loop_block_seconds = metrics.Histogram(
+    "ledger_event_loop_block_seconds", "Event-loop blocks longer than LOOP_BLOCK_THRESHOLD_MS",
+)
+
+def _parse_time(value: str) -> Optional[datetime]:
+    """ISO-8601 timestamp, UTC if it has no offset; None for an empty string."""
+    if not value:
+        return None
+    ts = datetime.fromisoformat(value)
+    return ts if ts.tzinfo is not None else ts.replace(tzinfo=timezone.utc)
+
+def _encode_statement_cursor(line) -> str:
+    raw = json.dumps([line.created_at.isoformat(), line.transfer_id, line.direction])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_statement_cursor(cursor: str):
+    created_at, transfer_id, direction = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(created_at), int(transfer_id), int(direction)
 
 class LedgerService(payment_pb2_grpc.LedgerServiceServicer):
+    def __init__(self, batcher: Optional[TransferBatcher] = None):
+        self.batcher = batcher
+
     async def Transfer(self, request, context):  # type: ignore[override]
+        try:
+            resp = await self._transfer(request)
+        except crud.InvalidTransfer as e:
+            transfers_total.inc(status="INVALID_ARGUMENT", reason=metrics.reason_label(str(e)))
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        transfers_total.inc(status=resp.status, reason=metrics.reason_label(resp.message))
+        return resp
+
+    @metrics.timed(rpc_seconds, method="Transfer")
+    async def _transfer(self, request):
         from_acct = request.from_account
         to_acct = request.to_account
         amount = request.amount
@@ -28,25 +92,20 @@ class LedgerService(payment_pb2_grpc.LedgerServiceServicer):
                 status="FAILED", message="Amount must be > 0",
             )
 
-        session = await get_session()
+        # ledger-side dedupe only when the caller asks for it (gateway fast path)
+        key = request.idempotency_key if request.ledger_dedupe else ""
         try:
-            async with session.begin():
-                # ensure accounts exist
-                from_curr = await crud.get_account_currency(session, from_acct)
-                to_curr = await crud.get_account_currency(session, to_acct)
-                if from_curr is None or to_curr is None:
-                    raise ValueError("Account not found")
-                if from_curr != to_curr:
-                    raise ValueError("Currency mismatch")
-
-                # check balance sufficiency
-                from_bal_before = await crud.get_balance(session, from_acct)
-                if from_bal_before < amount:
-                    raise ValueError("Insufficient funds")
-
-                tx_id, from_bal_after, to_bal_after = await crud.record_transfer(
-                    session, from_acct, to_acct, amount, from_curr
-                )
+            if self.batcher is not None:
+                response, replayed = await self.batcher.submit(from_acct, to_acct, amount, currency, key)
+            else:
+                session = await get_session()
+                async with session.begin():
+                    # dedupe, accounts exist, same currency, sufficient funds, entries
+                    response, replayed = await crud.apply_transfer(
+                        session, from_acct, to_acct, amount, currency, idempotency_key=key
+                    )
+        except crud.InvalidTransfer:
+            raise
         except Exception as e:  # rollback auto on error
             logger.exception("Transfer error")
             return payment_pb2.TransferResponse(
@@ -56,46 +115,310 @@ class LedgerService(payment_pb2_grpc.LedgerServiceServicer):
             )
         else:
             return payment_pb2.TransferResponse(
-                tx_id=tx_id, from_account=from_acct, to_account=to_acct, amount=amount,
-                currency=currency, from_balance_after=from_bal_after, to_balance_after=to_bal_after,
-                status="SUCCESS", message="",
+                tx_id=response["tx_id"], from_account=response["from_account"],
+                to_account=response["to_account"], amount=response["amount"],
+                currency=response["currency"], from_balance_after=response["from_balance_after"],
+                to_balance_after=response["to_balance_after"],
+                status=response["status"], message=response["message"] or "", replayed=replayed,
+                # responses stored before versions existed replay as unversioned
+                from_version=response.get("from_version", 0), to_version=response.get("to_version", 0),
             )
 
+    @metrics.timed(rpc_seconds, method="GetBalance")
     async def GetBalance(self, request, context):  # type: ignore[override]
         acct = request.account_id
-        session = await get_session()
+        session = await get_read_session(request.consistent)
+        curr, bal, version = await self._read_balance(session, acct)
+        if version < request.min_version and session.info.get("replica"):
+            # the caller has seen a newer version than the replica has replayed
+            db.db_reads_total.inc(target="primary", reason="stale_version")
+            curr, bal, version = await self._read_balance(await get_session(), acct)
+        return payment_pb2.BalanceResponse(account_id=acct, balance=bal, currency=curr, version=version)
+
+    async def _read_balance(self, session, acct):
         async with session.begin():
             curr = await crud.get_account_currency(session, acct) or "INR"
-            bal = await crud.get_balance(session, acct)
-        return payment_pb2.BalanceResponse(account_id=acct, balance=bal, currency=curr)
+            bal, version = await crud.get_balance_version(session, acct)
+        return curr, bal, version
 
-    async def GetAllEntries(self, request, context):
-        session = await get_session()
-        async with session.begin():
-            entries = await crud.get_all_entries(session)
-        return payment_pb2.GetAllResponse(
-            entries=[
-                payment_pb2.LedgerEntry(
-                    tx_id=e.tx_id,
-                    from_account=e.from_account,
-                    to_account=e.to_account,
-                    amount=e.amount,
-                    currency=e.currency,
-                    created_at=str(e.created_at),
+    @metrics.timed(rpc_seconds, method="GetBalanceAt")
+    async def GetBalanceAt(self, request, context):  # type: ignore[override]
+        try:
+            at = _parse_time(request.at)
+        except ValueError:
+            at = None
+        if at is None:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "at must be an ISO-8601 timestamp")
+        session = await get_read_session(request.consistent)
+        async with session:
+            rows = [row async for page in balances.balances_at(session, at, [request.account_id]) for row in page]
+        if not rows:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "account not found")
+        acct, currency, balance = rows[0]
+        return payment_pb2.BalanceAtResponse(account_id=acct, balance=balance, currency=currency, at=at.isoformat())
+
+    async def GetBalancesAt(self, request, context):
+        try:
+            at = _parse_time(request.at)
+        except ValueError:
+            at = None
+        if at is None:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "at must be an ISO-8601 timestamp")
+        account_ids = list(request.account_ids) or None
+        session = await get_read_session(request.consistent)
+        async with session:
+            async for page in balances.balances_at(session, at, account_ids):
+                for acct, currency, balance in page:
+                    yield payment_pb2.BalanceAtResponse(
+                        account_id=acct, balance=balance, currency=currency, at=at.isoformat(),
+                    )
+
+    async def ExportEntries(self, request, context):
+        try:
+            since = _parse_time(request.since)
+        except ValueError:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "since must be an ISO-8601 timestamp")
+        page_size = request.page_size if request.page_size > 0 else crud.EXPORT_PAGE_SIZE
+        account_id = request.account_id or None
+        session = await get_read_session(request.consistent)
+        after = None
+        async with session:
+            async with session.begin():
+                archives = await archive.list_archives(session, since)
+            # archived months all precede the live partitions
+            async for page in archive.iter_transfers(archives, since, account_id, page_size):
+                for e in page:
+                    yield self._export_entry(e)
+            while True:
+                # short transaction per page; nothing is held open between pages
+                async with session.begin():
+                    page = await crud.get_entries_page(
+                        session, after=after, since=since, account_id=account_id, limit=page_size
+                    )
+                for e in page:
+                    yield self._export_entry(e)
+                if len(page) < page_size:
+                    break
+                after = (page[-1].created_at, page[-1].id)
+
+    @staticmethod
+    def _export_entry(e):
+        return payment_pb2.LedgerEntry(
+            tx_id=e.tx_id,
+            from_account=e.from_account,
+            to_account=e.to_account,
+            amount=e.amount,
+            currency=e.currency,
+            created_at=str(e.created_at),
+            entry_id=e.id,
+        )
+
+    @metrics.timed(rpc_seconds, method="GetStatement")
+    async def GetStatement(self, request, context):  # type: ignore[override]
+        acct = request.account_id
+        try:
+            since = _parse_time(request.since)
+            until = _parse_time(request.until) or crud.STATEMENT_END
+            pos = _decode_statement_cursor(request.cursor) if request.cursor else None
+        except (ValueError, TypeError):
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT, "since and until must be ISO-8601 timestamps, cursor a next_cursor",
+            )
+        if pos is None:
+            # sorts before every leg at `since`
+            pos = (since, -1, -2) if since is not None else crud.STATEMENT_ORIGIN
+        limit = max(1, min(request.limit or crud.STATEMENT_PAGE_SIZE, crud.STATEMENT_PAGE_MAX))
+        session = await get_read_session(request.consistent)
+        async with session:
+            async with session.begin():
+                currency = await crud.get_account_currency(session, acct)
+                archives = await archive.list_archives(session, pos[0])
+                balance = await archive.opening_balance(session, acct, archives[0]) if archives else 0
+            if currency is None:
+                await context.abort(grpc.StatusCode.NOT_FOUND, "account not found")
+            opening, lines = None, []
+            if archives:
+                opening, lines = await archive.statement_lines(archives, acct, pos, until, limit, balance)
+                # whatever is left of the page comes from the live partitions, which start where the archives end
+                pos = (archives[-1].range_end, 0, 0)
+            if len(lines) < limit:
+                async with session.begin():
+                    live_opening, live = await crud.get_statement_page(session, acct, pos, until, limit - len(lines))
+                opening = live_opening if opening is None else opening
+                lines += live
+        return payment_pb2.StatementResponse(
+            account_id=acct,
+            currency=currency,
+            opening_balance=opening,
+            lines=[
+                payment_pb2.StatementLine(
+                    tx_id=line.tx_id,
+                    counterparty=line.counterparty,
+                    direction="DEBIT" if line.direction < 0 else "CREDIT",
+                    amount=line.amount,
+                    balance_after=int(line.balance_after),
+                    created_at=str(line.created_at),
+                    entry_id=line.transfer_id,
                 )
-                for e in entries
-            ]
+                for line in lines
+            ],
+            next_cursor=_encode_statement_cursor(lines[-1]) if len(lines) == limit else "",
         )
 
-async def serve():
+    async def _leg(self, request, context, op):
+        try:
+            session = await get_session()
+            async with session.begin():
+                state, balance = await op(session)
+        except crud.InvalidTransfer as e:
+            # rejected like the Transfer RPC, so the gateway answers 400 either way
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        except ValueError as e:
+            return payment_pb2.LegResponse(ok=False, message=str(e))
+        except Exception as e:
+            logger.exception(f"{op.__name__} error")
+            return payment_pb2.LegResponse(ok=False, message=str(e))
+        return payment_pb2.LegResponse(ok=True, state=state, balance_after=balance)
+
+    @metrics.timed(rpc_seconds, method="ReserveLeg")
+    async def ReserveLeg(self, request, context):  # type: ignore[override]
+        async def reserve(session):
+            bal = await crud.reserve_leg(
+                session, request.tx_id, request.account_id, request.direction,
+                request.amount, request.currency or "INR", request.counterparty,
+            )
+            return crud.LEG_RESERVED, bal
+        return await self._leg(request, context, reserve)
+
+    @metrics.timed(rpc_seconds, method="CommitLeg")
+    async def CommitLeg(self, request, context):  # type: ignore[override]
+        async def commit(session):
+            return crud.LEG_COMMITTED, await crud.commit_leg(session, request.tx_id, request.direction)
+        return await self._leg(request, context, commit)
+
+    @metrics.timed(rpc_seconds, method="AbortLeg")
+    async def AbortLeg(self, request, context):  # type: ignore[override]
+        async def abort(session):
+            await crud.abort_leg(
+                session, request.tx_id, request.account_id, request.direction, request.amount, request.counterparty,
+            )
+            return crud.LEG_ABORTED, 0
+        return await self._leg(request, context, abort)
+
+async def prepare_database():
+    if db.LEDGER_CREATE_DATABASE:
+        await db.ensure_database()
     await db.apply_migrations()
-    server = grpc.aio.server()
-    payment_pb2_grpc.add_LedgerServiceServicer_to_server(LedgerService(), server)
+    if await compact.pending():
+        raise RuntimeError("ledger_entries has not been compacted; run `python -m ledger.compact migrate` first")
+    await partitions.ensure()
+
+class LedgerAdminService(payment_pb2_grpc.LedgerAdminServicer):
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+
+    async def Profile(self, request, context):  # type: ignore[override]
+        token = dict(context.invocation_metadata()).get("x-admin-token", "")
+        if not hmac.compare_digest(token, LEDGER_ADMIN_TOKEN):
+            await context.abort(grpc.StatusCode.PERMISSION_DENIED, "admin token required")
+        interval_s = (request.interval_ms or 5.0) / 1000.0
+        text, samples = await profiler.profile(request.seconds or 10.0, interval_s)
+        return payment_pb2.ProfileResponse(collapsed=text, samples=samples, worker_id=self.worker_id)
+
+async def _start_admin(worker_id: int):
+    admin = grpc.aio.server()
+    payment_pb2_grpc.add_LedgerAdminServicer_to_server(LedgerAdminService(worker_id), admin)
+    admin.add_insecure_port(f"[::]:{LEDGER_ADMIN_PORT + worker_id}")
+    await admin.start()
+    return admin
+
+async def serve(worker_id: int = 0, migrate: bool = True):
+    """Run one ledger gRPC server until SIGTERM/SIGINT, then drain and exit.
+
+    Under the supervisor every worker binds the same port (SO_REUSEPORT), the
+    supervisor has already migrated, and only worker 0 runs the consolidator,
+    the partition maintainer and the balance checkpointer.
+    """
+    if migrate:
+        await prepare_database()
+    tracing.configure("ledger", path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT)
+    tracing.start()
+    interceptors = [tracing.ServerInterceptor()]
+    slow_profiler = None
+    if PROFILE_SLOW_REQUEST_MS > 0:
+        slow_profiler = profiler.SlowRequestProfiler(PROFILE_SLOW_REQUEST_MS, PROFILE_DIR)
+        slow_profiler.start()
+        interceptors.append(profiler.SlowRpcInterceptor(slow_profiler, tag=tracing.current_trace_id))
+    loop_watchdog = None
+    if LOOP_BLOCK_THRESHOLD_MS > 0:
+        loop_watchdog = profiler.LoopWatchdog(LOOP_BLOCK_THRESHOLD_MS, on_block=loop_block_seconds.observe)
+        loop_watchdog.start()
+    server = grpc.aio.server(interceptors=interceptors, options=[("grpc.so_reuseport", 1)])
+    batcher = None
+    if LEDGER_BATCH_ENABLED:
+        batcher = TransferBatcher()
+        logger.info(f"Transfer batching on (max_wait={batcher.max_wait * 1000}ms, max_batch={batcher.max_batch})")
+    payment_pb2_grpc.add_LedgerServiceServicer_to_server(LedgerService(batcher), server)
     listen_addr = f"[::]:{LEDGER_GRPC_PORT}"
     server.add_insecure_port(listen_addr)
-    logger.info(f"Ledger gRPC listening on {listen_addr}")
+    logger.info(f"Ledger gRPC worker {worker_id} (pid {os.getpid()}) listening on {listen_addr}")
     await server.start()
-    await server.wait_for_termination()
+    admin_server = None
+    if LEDGER_ADMIN_PORT and LEDGER_ADMIN_TOKEN:
+        admin_server = await _start_admin(worker_id)
+    metrics_server = None
+    if LEDGER_METRICS_PORT:
+        metrics_server = await metrics.serve(LEDGER_METRICS_PORT + worker_id)
+        if batcher is not None:
+            metrics.on_collect(lambda: batch_queue_depth.set(batcher._queue.qsize()))
+    replica_monitor = None
+    if db.POSTGRES_READ_HOST:
+        replica_monitor = asyncio.create_task(db.monitor_replica())
+        logger.info(f"Read-only RPCs routed to {db.POSTGRES_READ_HOST} (max lag {db.REPLICA_MAX_LAG_S}s)")
+    consolidator = None
+    if LEDGER_CONSOLIDATE_INTERVAL_S > 0 and worker_id == 0:
+        consolidator = asyncio.create_task(balances.run_consolidator(LEDGER_CONSOLIDATE_INTERVAL_S))
+    partition_maintainer = None
+    if partitions.LEDGER_PARTITION_CHECK_S > 0 and worker_id == 0:
+        partition_maintainer = asyncio.create_task(partitions.run_maintainer(partitions.LEDGER_PARTITION_CHECK_S))
+    checkpointer = None
+    if balances.LEDGER_CHECKPOINT_INTERVAL_S > 0 and worker_id == 0:
+        checkpointer = asyncio.create_task(balances.run_checkpointer(balances.LEDGER_CHECKPOINT_INTERVAL_S))
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+
+    # refuse new RPCs, let in-flight ones (and their batches) finish
+    logger.info(f"Ledger worker {worker_id} draining (grace {LEDGER_DRAIN_GRACE_S}s)")
+    await server.stop(LEDGER_DRAIN_GRACE_S)
+    if consolidator is not None:
+        consolidator.cancel()
+    if partition_maintainer is not None:
+        partition_maintainer.cancel()
+    if checkpointer is not None:
+        checkpointer.cancel()
+    if replica_monitor is not None:
+        replica_monitor.cancel()
+    if batcher is not None:
+        await batcher.stop()
+    if metrics_server is not None:
+        metrics_server.close()
+    if admin_server is not None:
+        await admin_server.stop(0)
+    if slow_profiler is not None:
+        slow_profiler.stop()
+    if loop_watchdog is not None:
+        loop_watchdog.stop()
+    await tracing.shutdown()
+    await db.dispose_engine()
+    logger.info(f"Ledger worker {worker_id} stopped")
 
 if __name__ == "__main__":
-    asyncio.run(serve())
+    if LEDGER_WORKERS > 1:
+        from .supervisor import main
+        main(LEDGER_WORKERS)
+    else:
+        asyncio.run(serve())
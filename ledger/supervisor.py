@@ -0,0 +1,106 @@
+"""Multi-process ledger: a supervisor and N gRPC worker processes on one port.
+
+Usage (inside the ledger container):
+  LEDGER_WORKERS=4 python -m ledger.server      # or: python -m ledger.supervisor 4
+
+The supervisor creates the database and applies migrations once, then starts
+the workers. Each worker runs its own event loop and binds ``LEDGER_GRPC_PORT``
+with SO_REUSEPORT, and the kernel spreads incoming connections over them.
+``LEDGER_DB_CONN_BUDGET`` is the total number of Postgres connections the
+ledger may hold; every worker gets an equal share as its pool size, with no
+overflow. Without a budget, workers use ``LEDGER_DB_POOL_SIZE`` and
+``LEDGER_DB_MAX_OVERFLOW``.
+
+On SIGTERM/SIGINT the supervisor forwards SIGTERM to every worker. Each worker
+stops accepting RPCs and drains in-flight ones for ``LEDGER_DRAIN_GRACE_S``.
+Workers that are still alive after that, plus a few seconds, are killed. A
+worker that exits on its own is restarted.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from loguru import logger
+
+from . import db
+
+LEDGER_DB_CONN_BUDGET = int(os.getenv("LEDGER_DB_CONN_BUDGET", "0"))
+# worker N listens on LEDGER_METRICS_PORT + N and LEDGER_ADMIN_PORT + N; the
+# compose file publishes those ranges for this many workers
+LEDGER_MAX_WORKERS = int(os.getenv("LEDGER_MAX_WORKERS", "4"))
+# minimum seconds between restarts of the same worker slot
+RESTART_BACKOFF_S = 1.0
+
+def pool_share(budget: int, workers: int):
+    """(pool_size, max_overflow) per worker for a global connection budget."""
+    if budget <= 0:
+        return db.LEDGER_DB_POOL_SIZE, db.LEDGER_DB_MAX_OVERFLOW
+    return max(1, budget // workers), 0
+
+def _worker_main(worker_id: int, pool_size: int, max_overflow: int):
+    from . import server
+
+    db.configure_pool(pool_size, max_overflow)
+    asyncio.run(server.serve(worker_id=worker_id, migrate=False))
+
+def main(workers: int):
+    from . import server
+
+    if not 1 <= workers <= LEDGER_MAX_WORKERS:
+        raise SystemExit(f"LEDGER_WORKERS must be between 1 and LEDGER_MAX_WORKERS ({LEDGER_MAX_WORKERS}), got {workers}")
+    asyncio.run(_prepare(server))
+    pool_size, max_overflow = pool_share(LEDGER_DB_CONN_BUDGET, workers)
+    logger.info(f"Ledger supervisor starting {workers} workers (pool {pool_size}+{max_overflow} each)")
+
+    # spawn, not fork: a forked child would inherit the parent's gRPC/asyncpg state
+    ctx = multiprocessing.get_context("spawn")
+    procs = {}
+    started = {}
+
+    def start(worker_id: int):
+        p = ctx.Process(target=_worker_main, args=(worker_id, pool_size, max_overflow), daemon=False)
+        p.start()
+        procs[worker_id], started[worker_id] = p, time.monotonic()
+
+    stopping = False
+
+    def on_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    for i in range(workers):
+        start(i)
+    while not stopping:
+        time.sleep(0.5)
+        for i, p in list(procs.items()):
+            if not p.is_alive() and not stopping:
+                logger.warning(f"Ledger worker {i} exited with {p.exitcode}; restarting")
+                time.sleep(max(0.0, RESTART_BACKOFF_S - (time.monotonic() - started[i])))
+                start(i)
+
+    logger.info("Ledger supervisor draining workers")
+    for p in procs.values():
+        if p.is_alive():
+            p.terminate()  # SIGTERM -> graceful drain in the worker
+    deadline = time.monotonic() + server.LEDGER_DRAIN_GRACE_S + 5
+    for p in procs.values():
+        p.join(max(0.0, deadline - time.monotonic()))
+        if p.is_alive():
+            logger.warning(f"Ledger worker pid {p.pid} did not drain in time; killing")
+            p.kill()
+            p.join()
+
+async def _prepare(server):
+    await server.prepare_database()
+    # the workers open their own pools
+    await db.dispose_engine()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("LEDGER_WORKERS", "2")))
@@ -6,36 +6,133 @@ from loguru import logger
 import payment_pb2
 import payment_pb2_grpc
 
+from common import metrics, profiler, tracing
+
+from .writer import LogWriter
+
 NOTIFY_GRPC_PORT = int(os.getenv("NOTIFY_GRPC_PORT", "50052"))
+# "message": every RPC returns after its lines are on disk
+# "batch":   RPCs return once buffered; the writer flushes on size/time
+NOTIFY_FLUSH_MODE = os.getenv("NOTIFY_FLUSH_MODE", "message")
+# client-streaming RPCs hand lines to the writer in chunks of this size
+NOTIFY_STREAM_CHUNK = int(os.getenv("NOTIFY_STREAM_CHUNK", "256"))
+# Prometheus text on this port; 0 = off
+NOTIFY_METRICS_PORT = int(os.getenv("NOTIFY_METRICS_PORT", "9102"))
+# sampling follows the caller's traceparent; these only say where sampled spans go
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+# profile every RPC slower than this (0 = off) into PROFILE_DIR
+PROFILE_SLOW_REQUEST_MS = float(os.getenv("PROFILE_SLOW_REQUEST_MS", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+# log event-loop blocks longer than this, with the blocking stack (0 = off)
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100"))
+
+rpc_seconds = metrics.Histogram("notify_rpc_seconds", "Notification RPC handling time by method")
+delivered_total = metrics.Counter("notifications_delivered_total", "Notifications handed to the log writer")
+buffered_lines = metrics.Gauge("notify_writer_buffered_lines", "Lines waiting for the next log flush")
+flush_waiters = metrics.Gauge("notify_writer_flush_waiters", "RPCs blocked until their lines are on disk")
+loop_block_seconds = metrics.Histogram(
+    "notify_event_loop_block_seconds", "Event-loop blocks longer than LOOP_BLOCK_THRESHOLD_MS",
+)
+
+def _format(request) -> str:
+    return (
+        f"NOTIFY acct={request.account_id} dir={request.direction} amt={request.amount} "
+        f"cur={request.currency} tx={request.tx_id} msg={request.message}"
+    )
 
 class NotificationService(payment_pb2_grpc.NotificationServiceServicer):
+    def __init__(self, writer: LogWriter, flush_mode: str = NOTIFY_FLUSH_MODE):
+        self.writer = writer
+        self.wait_for_flush = flush_mode == "message"
+
+    async def _deliver(self, requests):
+        lines = [_format(r) for r in requests]
+        for line in lines:
+            logger.info(line)
+        # extend: send email/SMS/webhook
+        await self.writer.write(lines, wait=self.wait_for_flush)
+        delivered_total.inc(len(lines))
+
+    @metrics.timed(rpc_seconds, method="Notify")
     async def Notify(self, request, context):  # type: ignore[override]
         try:
-            log_message = (
-                f"NOTIFY acct={request.account_id} dir={request.direction} amt={request.amount} "
-                f"cur={request.currency} tx={request.tx_id} msg={request.message}"
-            )
-            logger.info(log_message)
-            with open("/app/notifications.log", "a") as f:
-                f.write(log_message + "\n")
-            # extend: send email/SMS/webhook
+            await self._deliver([request])
             return payment_pb2.NotificationResponse(ok=True)
         except Exception as e:
             logger.error(f"Error in Notify method: {e}")
             raise
 
+    @metrics.timed(rpc_seconds, method="NotifyBatch")
+    async def NotifyBatch(self, request, context):  # type: ignore[override]
+        try:
+            await self._deliver(request.notifications)
+            return payment_pb2.NotificationBatchResponse(ok=True, accepted=len(request.notifications))
+        except Exception as e:
+            logger.error(f"Error in NotifyBatch method: {e}")
+            raise
+
+    @metrics.timed(rpc_seconds, method="NotifyStream")
+    async def NotifyStream(self, request_iterator, context):  # type: ignore[override]
+        accepted = 0
+        chunk = []
+        try:
+            async for request in request_iterator:
+                chunk.append(request)
+                if len(chunk) >= NOTIFY_STREAM_CHUNK:
+                    await self._deliver(chunk)
+                    accepted += len(chunk)
+                    chunk = []
+            if chunk:
+                await self._deliver(chunk)
+                accepted += len(chunk)
+            return payment_pb2.NotificationBatchResponse(ok=True, accepted=accepted)
+        except Exception as e:
+            logger.error(f"Error in NotifyStream method: {e}")
+            raise
+
 async def serve():
-    server = grpc.aio.server()
-    payment_pb2_grpc.add_NotificationServiceServicer_to_server(NotificationService(), server)
+    tracing.configure("notifications", path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT)
+    writer = LogWriter()
+    interceptors = [tracing.ServerInterceptor()]
+    slow_profiler = None
+    if PROFILE_SLOW_REQUEST_MS > 0:
+        slow_profiler = profiler.SlowRequestProfiler(PROFILE_SLOW_REQUEST_MS, PROFILE_DIR)
+        interceptors.append(profiler.SlowRpcInterceptor(slow_profiler, tag=tracing.current_trace_id))
+    loop_watchdog = None
+    if LOOP_BLOCK_THRESHOLD_MS > 0:
+        loop_watchdog = profiler.LoopWatchdog(LOOP_BLOCK_THRESHOLD_MS, on_block=loop_block_seconds.observe)
+    server = grpc.aio.server(interceptors=interceptors)
+    payment_pb2_grpc.add_NotificationServiceServicer_to_server(NotificationService(writer), server)
     listen_addr = f"[::]:{NOTIFY_GRPC_PORT}"
     server.add_insecure_port(listen_addr)
-    logger.info(f"Notification gRPC listening on {listen_addr}")
+    logger.info(f"Notification gRPC listening on {listen_addr} (flush mode: {NOTIFY_FLUSH_MODE})")
+    metrics_server = None
     try:
+        tracing.start()
+        if slow_profiler is not None:
+            slow_profiler.start()
+        if loop_watchdog is not None:
+            loop_watchdog.start()
+        writer.start()
         await server.start()
+        if NOTIFY_METRICS_PORT:
+            metrics.on_collect(lambda: buffered_lines.set(len(writer._buf)))
+            metrics.on_collect(lambda: flush_waiters.set(len(writer._waiters)))
+            metrics_server = await metrics.serve(NOTIFY_METRICS_PORT)
         await server.wait_for_termination()
     except Exception as e:
         logger.error(f"Error starting or running gRPC server: {e}")
         raise
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await writer.stop()
+        if slow_profiler is not None:
+            slow_profiler.stop()
+        if loop_watchdog is not None:
+            loop_watchdog.stop()
+        await tracing.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(serve())
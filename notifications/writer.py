@@ -0,0 +1,174 @@
+"""Buffered, rotating notification log writer.
+
+All appends go through one writer task. Lines are buffered and flushed to disk
+(off the event loop, via ``asyncio.to_thread``) when ``flush_bytes`` are queued
+or at the latest every ``flush_interval_ms``. The file is rotated to
+``<path>.1`` .. ``<path>.<backups>`` once it exceeds ``max_bytes``.
+
+A failed flush keeps its lines and retries up to ``retries`` times, doubling
+the pause from ``retry_backoff_ms``; lines appended meanwhile queue behind
+them. Only then are the lines dropped (logged with their count and counted in
+``notify_writer_dropped_lines_total``).
+
+Callers choose their durability: ``write(..., wait=True)`` resolves only after
+the lines hit the file (the writer flushes immediately when a waiter is
+queued), ``wait=False`` returns as soon as the lines are buffered. Waiters of
+dropped lines get the write error.
+"""
+
+import asyncio
+import contextlib
+import os
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from common import metrics
+
+NOTIFY_LOG_PATH = os.getenv("NOTIFY_LOG_PATH", "/app/notifications.log")
+NOTIFY_FLUSH_BYTES = int(os.getenv("NOTIFY_FLUSH_BYTES", str(64 * 1024)))
+NOTIFY_FLUSH_INTERVAL_MS = float(os.getenv("NOTIFY_FLUSH_INTERVAL_MS", "50"))
+NOTIFY_LOG_MAX_BYTES = int(os.getenv("NOTIFY_LOG_MAX_BYTES", str(100 * 1024 * 1024)))
+NOTIFY_LOG_BACKUPS = int(os.getenv("NOTIFY_LOG_BACKUPS", "5"))
+NOTIFY_FLUSH_RETRIES = int(os.getenv("NOTIFY_FLUSH_RETRIES", "5"))
+NOTIFY_FLUSH_RETRY_BACKOFF_MS = float(os.getenv("NOTIFY_FLUSH_RETRY_BACKOFF_MS", "100"))
+
+flush_seconds = metrics.Histogram("notify_writer_flush_seconds", "Time to write and flush one buffer to disk")
+dropped_lines_total = metrics.Counter(
+    "notify_writer_dropped_lines_total", "Lines dropped after every flush retry failed",
+)
+
+class LogWriter:
+    def __init__(
+        self,
+        path: str = NOTIFY_LOG_PATH,
+        flush_bytes: int = NOTIFY_FLUSH_BYTES,
+        flush_interval_ms: float = NOTIFY_FLUSH_INTERVAL_MS,
+        max_bytes: int = NOTIFY_LOG_MAX_BYTES,
+        backups: int = NOTIFY_LOG_BACKUPS,
+        retries: int = NOTIFY_FLUSH_RETRIES,
+        retry_backoff_ms: float = NOTIFY_FLUSH_RETRY_BACKOFF_MS,
+    ):
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.retries = max(0, retries)
+        self.retry_backoff = retry_backoff_ms / 1000.0
+        self._buf: List[str] = []
+        self._buf_bytes = 0
+        self._waiters: List[asyncio.Future] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._file = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+        if self._file is not None:
+            await asyncio.to_thread(self._file.close)
+            self._file = None
+
+    async def write(self, lines: List[str], wait: bool = False):
+        self.start()
+        for line in lines:
+            self._buf.append(line + "\n")
+            self._buf_bytes += len(line) + 1
+        if wait:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            self._wakeup.set()
+            await fut
+        elif self._buf_bytes >= self.flush_bytes:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._buf:
+                await self._flush()
+
+    async def _flush(self):
+        buf, waiters = self._buf, self._waiters
+        self._buf, self._buf_bytes, self._waiters = [], 0, []
+        if not buf:
+            for w in waiters:
+                if not w.done():
+                    w.set_result(None)
+            return
+        data = "".join(buf)
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write_blocking, data)
+                break
+            except Exception as e:
+                error = e
+            if attempt == self.retries:
+                logger.error(
+                    f"Notification log flush failed {attempt + 1} time(s), dropping {len(buf)} line(s): {error}"
+                )
+                dropped_lines_total.inc(len(buf))
+                for w in waiters:
+                    if not w.done():
+                        w.set_exception(error)
+                return
+            logger.warning(f"Notification log flush failed, retrying {len(buf)} line(s) in {delay:.2f}s: {error}")
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # stopping: hand the lines back so stop()'s final flush retries them first
+                self._buf[:0] = buf
+                self._buf_bytes += len(data)
+                self._waiters[:0] = waiters
+                raise
+            delay *= 2
+        flush_seconds.observe(time.perf_counter() - start)
+        for w in waiters:
+            if not w.done():
+                w.set_result(None)
+
+    def _write_blocking(self, data: str):
+        # runs in a worker thread; only the writer task calls it, so no locking
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        try:
+            self._file.write(data)
+            self._file.flush()
+        except OSError:
+            # reopen on the next attempt (the file may have been removed or its disk remounted)
+            with contextlib.suppress(OSError):
+                self._file.close()
+            self._file = None
+            raise
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
@@ -0,0 +1,364 @@
+"""Open-loop benchmark harness for the gateway.
+
+Requests arrive as a Poisson process at ``--rate`` per second for
+``--duration`` seconds, whether or not earlier ones have finished. Latency is
+measured from each request's *scheduled* start, so a stalled server shows up in
+the tail instead of silently lowering the offered load (no coordinated
+omission). Per-endpoint latencies go into log-linear (HDR-style) histograms.
+
+Workloads:
+  uniform      transfers between uniformly random accounts
+  zipf         transfers whose accounts follow a Zipf distribution (hot accounts)
+  retry-storm  every transfer is sent --dup times concurrently with one idempotency key
+  read-heavy   --read-ratio of arrivals are GET /balance (Zipf accounts), the rest transfers
+
+Targets:
+  --target http://gateway:8000   a running gateway (docker compose stack)
+  --target inprocess             the gateway app in this process (httpx ASGI transport) with
+                                 in-process fake ledger/notification gRPC services; still
+                                 needs the gateway's Postgres and Redis
+
+Usage:
+  docker compose run --rm gateway python scripts/bench.py run --workload zipf --rate 500 --out zipf.json
+  docker compose run --rm gateway python scripts/bench.py compare base.json zipf.json
+"""
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import asyncpg
+import httpx
+import redis.asyncio as redis
+
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
+POSTGRES_DB = os.getenv("POSTGRES_DB", "easpayments")
+POSTGRES_USER = os.getenv("POSTGRES_USER", "easuser")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "easpass")
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+ACCOUNTS_CHANGED_CHANNEL = "accounts:changed"  # see gateway/db.py
+
+ACCOUNT_NAMESPACE = uuid.UUID("6f1c2b1e-5d55-4c38-9a8e-0b3f7a0c2d11")
+START_BALANCE = 10 ** 12
+
+WORKLOADS = {
+    "uniform": dict(dist="uniform", read_ratio=0.0, dup=1),
+    "zipf": dict(dist="zipf", read_ratio=0.0, dup=1),
+    "retry-storm": dict(dist="uniform", read_ratio=0.0, dup=5),
+    "read-heavy": dict(dist="zipf", read_ratio=0.9, dup=1),
+}
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+class LatencyHistogram:
+    """Log-linear histogram over microseconds: ~1% relative error, fixed memory.
+
+    Values below 2**SUB_BITS us are exact; above that every power of two is
+    split into 2**SUB_BITS linear sub-buckets, as HdrHistogram does.
+    """
+
+    SUB_BITS = 7
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+
+    def _index(self, us: int) -> int:
+        sub = 1 << self.SUB_BITS
+        if us < sub:
+            return us
+        shift = us.bit_length() - 1 - self.SUB_BITS
+        return ((shift + 1) << self.SUB_BITS) + (us >> shift) - sub
+
+    def _upper(self, idx: int) -> int:
+        sub = 1 << self.SUB_BITS
+        if idx < sub:
+            return idx
+        shift = (idx >> self.SUB_BITS) - 1
+        mantissa = (idx & (sub - 1)) + sub
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds: float):
+        us = max(0, int(seconds * 1_000_000))
+        idx = self._index(us)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.total += 1
+        self.sum_us += us
+        self.max_us = max(self.max_us, us)
+
+    def percentile(self, p: float) -> int:
+        if not self.total:
+            return 0
+        rank = max(1, int(round(p / 100.0 * self.total)))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._upper(idx), self.max_us)
+        return self.max_us
+
+    def summary(self) -> dict:
+        out = {f"p{p:g}_ms": self.percentile(p) / 1000.0 for p in PERCENTILES}
+        out["max_ms"] = self.max_us / 1000.0
+        out["mean_ms"] = (self.sum_us / self.total / 1000.0) if self.total else 0.0
+        out["count"] = self.total
+        return out
+
+    def to_json(self) -> dict:
+        return {"sub_bits": self.SUB_BITS, "counts": {str(k): v for k, v in sorted(self.counts.items())}}
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.outcomes: Dict[str, int] = {}
+
+    def record(self, seconds: float, outcome: str):
+        self.latency.record(seconds)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+class ZipfSampler:
+    def __init__(self, n: int, s: float, rng: random.Random):
+        weights = [1.0 / (k ** s) for k in range(1, n + 1)]
+        self.cum = list(itertools.accumulate(weights))
+        self.rng = rng
+
+    def __call__(self) -> int:
+        return bisect.bisect_left(self.cum, self.rng.random() * self.cum[-1])
+
+def account_ids(n: int) -> List[str]:
+    # deterministic, so repeated runs reuse the same accounts
+    return [str(uuid.uuid5(ACCOUNT_NAMESPACE, f"bench-{i}")) for i in range(n)]
+
+async def ensure_accounts(ids: List[str]):
+    conn = await asyncpg.connect(
+        host=POSTGRES_HOST, port=POSTGRES_PORT, user=POSTGRES_USER, password=POSTGRES_PASSWORD, database=POSTGRES_DB
+    )
+    await conn.executemany(
+        "INSERT INTO accounts (id, name, currency, start_balance) VALUES ($1, 'bench', 'INR', $2) "
+        "ON CONFLICT (id) DO NOTHING",
+        [(i, START_BALANCE) for i in ids],
+    )
+    await conn.close()
+
+class Bench:
+    def __init__(self, client: httpx.AsyncClient, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.ids = account_ids(args.accounts)
+        if args.dist == "zipf":
+            zipf = ZipfSampler(len(self.ids), args.zipf_s, self.rng)
+            # shuffle so the hot accounts are not always the first ids
+            order = self.ids[:]
+            self.rng.shuffle(order)
+            self.pick = lambda: order[zipf()]
+        else:
+            self.pick = lambda: self.rng.choice(self.ids)
+        self.stats: Dict[str, EndpointStats] = {}
+        self.inflight = 0
+        self.dropped = 0
+        self.tasks = set()
+
+    def _stats(self, endpoint: str) -> EndpointStats:
+        s = self.stats.get(endpoint)
+        if s is None:
+            s = self.stats[endpoint] = EndpointStats()
+        return s
+
+    async def _request(self, endpoint: str, scheduled: float, method: str, url: str, body: Optional[dict] = None):
+        self.inflight += 1
+        try:
+            resp = await self.client.request(method, url, json=body, timeout=self.args.timeout)
+            outcome = str(resp.status_code)
+            if resp.status_code == 200 and endpoint == "POST /transfer":
+                outcome += " " + resp.json().get("status", "")
+        except Exception as e:
+            outcome = f"error {type(e).__name__}"
+        finally:
+            self.inflight -= 1
+        self._stats(endpoint).record(time.perf_counter() - scheduled, outcome)
+
+    def _arrival(self, scheduled: float):
+        a = self.args
+        if self.rng.random() < a.read_ratio:
+            reqs = [("GET /balance", "GET", f"/balance/{self.pick()}", None)]
+        else:
+            src = self.pick()
+            dst = self.pick()
+            while dst == src:
+                dst = self.pick()
+            body = dict(from_account=src, to_account=dst, amount=1, currency="INR", idempotency_key=str(uuid.uuid4()))
+            reqs = [("POST /transfer", "POST", "/transfer", body)] * a.dup
+        for endpoint, method, url, body in reqs:
+            if self.inflight >= a.max_inflight:
+                self.dropped += 1
+                continue
+            task = asyncio.create_task(self._request(endpoint, scheduled, method, url, body))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self) -> float:
+        a = self.args
+        start = time.perf_counter()
+        next_at = start
+        end = start + a.duration
+        while True:
+            next_at += self.rng.expovariate(a.rate)
+            if next_at >= end:
+                break
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._arrival(next_at)
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        return time.perf_counter() - start
+
+async def _inprocess_client(args, ids: List[str]):
+    """Gateway app over an ASGI transport, talking to fake gRPC services in this process."""
+    from fake_services import start_fakes
+    from gateway.config import settings
+
+    server, ledger_target, notify_target, ledger, _ = await start_fakes(
+        ids, START_BALANCE, ledger_latency_s=args.fake_ledger_latency_ms / 1000.0
+    )
+    # stubs are created lazily, so retargeting before the first call is enough
+    settings.ledger_grpc_target = ledger_target
+    settings.ledger_shard_targets = ""
+    settings.notify_grpc_target = notify_target
+    from gateway import app as gateway_app, db
+
+    await gateway_app.app.router.startup()
+    db.account_cache.invalidate()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway_app.app), base_url="http://bench")
+
+    async def close():
+        await client.aclose()
+        await gateway_app.app.router.shutdown()
+        for name in ("account_invalidation_task", "outbox_task", "shard_recovery_task"):
+            task = getattr(gateway_app.app.state, name, None)
+            if task is not None:
+                task.cancel()
+        await server.stop(None)
+
+    return client, close
+
+async def run(args) -> int:
+    for k, v in WORKLOADS[args.workload].items():
+        if getattr(args, k) is None:
+            setattr(args, k, v)
+    ids = account_ids(args.accounts)
+    await ensure_accounts(ids)
+
+    if args.target == "inprocess":
+        client, close = await _inprocess_client(args, ids)
+    else:
+        r = redis.from_url(REDIS_URL, decode_responses=True)
+        await r.publish(ACCOUNTS_CHANGED_CHANNEL, "*")  # drop cached negatives for the new accounts
+        await r.aclose()
+        limits = httpx.Limits(max_connections=args.max_inflight, max_keepalive_connections=args.max_inflight)
+        client = httpx.AsyncClient(base_url=args.target, limits=limits)
+        close = client.aclose
+
+    bench = Bench(client, args)
+    try:
+        elapsed = await bench.run()
+    finally:
+        await close()
+
+    result = dict(
+        config={k: v for k, v in vars(args).items() if k not in ("func", "out")},
+        elapsed_s=elapsed,
+        dropped=bench.dropped,
+        endpoints={
+            name: dict(
+                throughput_rps=s.latency.total / elapsed,
+                outcomes=s.outcomes,
+                **s.latency.summary(),
+                histogram=s.latency.to_json(),
+            )
+            for name, s in sorted(bench.stats.items())
+        },
+    )
+    _print_result(result)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.out}")
+    return 0
+
+def _print_result(result: dict):
+    cfg = result["config"]
+    print(
+        f"workload={cfg['workload']} target={cfg['target']} rate={cfg['rate']}/s duration={cfg['duration']}s "
+        f"elapsed={result['elapsed_s']:.1f}s dropped={result['dropped']}"
+    )
+    cols = [f"p{p:g}_ms" for p in PERCENTILES] + ["max_ms"]
+    print(f"{'endpoint':<16}{'count':>8}{'rps':>9}" + "".join(f"{c:>11}" for c in cols))
+    for name, ep in result["endpoints"].items():
+        print(f"{name:<16}{ep['count']:>8}{ep['throughput_rps']:>9.1f}" + "".join(f"{ep[c]:>11.2f}" for c in cols))
+        print(f"{'':<16}outcomes: {ep['outcomes']}")
+
+def compare(args) -> int:
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    metrics = ["throughput_rps"] + [f"p{p:g}_ms" for p in PERCENTILES] + ["max_ms"]
+    print(f"{'endpoint':<16}{'metric':<16}{'base':>12}{'new':>12}{'change':>10}")
+    for name in sorted(set(base["endpoints"]) | set(new["endpoints"])):
+        b = base["endpoints"].get(name)
+        n = new["endpoints"].get(name)
+        if b is None or n is None:
+            print(f"{name:<16}only in {'new' if b is None else 'base'}")
+            continue
+        for m in metrics:
+            change = (n[m] - b[m]) / b[m] * 100.0 if b[m] else 0.0
+            print(f"{name:<16}{m:<16}{b[m]:>12.2f}{n[m]:>12.2f}{change:>9.1f}%")
+    return 0
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="bench")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="run one workload")
+    p.add_argument("--workload", choices=sorted(WORKLOADS), default="uniform")
+    p.add_argument("--target", default=os.getenv("API_URL", "http://gateway:8000"),
+                   help="gateway base URL, or 'inprocess'")
+    p.add_argument("--rate", type=float, default=200.0, help="arrivals per second (open loop)")
+    p.add_argument("--duration", type=float, default=30.0, help="seconds of arrivals")
+    p.add_argument("--accounts", type=int, default=1000)
+    p.add_argument("--dist", choices=["uniform", "zipf"], default=None, help="override the workload's account distribution")
+    p.add_argument("--zipf-s", type=float, default=1.1)
+    p.add_argument("--read-ratio", type=float, default=None, help="override the workload's share of balance reads")
+    p.add_argument("--dup", type=int, default=None, help="override copies sent per idempotency key")
+    p.add_argument("--max-inflight", type=int, default=1000, help="arrivals beyond this many open requests are dropped")
+    p.add_argument("--timeout", type=float, default=30.0)
+    p.add_argument("--fake-ledger-latency-ms", type=float, default=0.0, help="inprocess: added ledger RPC latency")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", default=None, help="write JSON results here")
+    p.set_defaults(func=run)
+
+    c = sub.add_parser("compare", help="compare two JSON results")
+    c.add_argument("base")
+    c.add_argument("new")
+    c.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    if args.func is run:
+        return asyncio.run(run(args))
+    return compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""Hot-account benchmark: credit throughput into one receiver vs bucket count.
+
+Many distinct payers send concurrent transfers straight to the ledger gRPC
+service, all to the same receiver. The receiver is re-created for every bucket
+count (0 = regular account, credits serialize on its balance row) and the run
+prints transfers/s per setting, then checks that the receiver's balance (main
+row plus buckets) equals the credits that succeeded.
+
+Usage:
+  docker compose run --rm gateway python scripts/bench_hot_account.py
+"""
+
+import os
+import sys
+import asyncio
+import time
+import uuid
+
+import asyncpg
+import grpc
+
+from gateway import payment_pb2, payment_pb2_grpc
+
+LEDGER_GRPC_TARGET = os.getenv("LEDGER_GRPC_TARGET", "ledger:50051")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
+POSTGRES_DB = os.getenv("POSTGRES_DB", "easpayments")
+POSTGRES_USER = os.getenv("POSTGRES_USER", "easuser")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "easpass")
+
+TOTAL = int(os.getenv("BENCH_TOTAL", "5000"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "64"))
+BUCKETS = [int(b) for b in os.getenv("BENCH_BUCKETS", "0,4,16,64").split(",")]
+AMOUNT = 10
+
+async def setup(conn, buckets: int):
+    receiver = str(uuid.uuid4())
+    payers = [str(uuid.uuid4()) for _ in range(CONCURRENCY)]
+    await conn.execute(
+        "INSERT INTO accounts (id, name, currency, start_balance, hot_buckets) VALUES ($1, 'bench-hot', 'INR', 0, $2)",
+        receiver, buckets,
+    )
+    # hot accounts need their main balance row before credits land in buckets
+    await conn.execute("INSERT INTO account_balances (account_id, balance) VALUES ($1, 0)", receiver)
+    await conn.executemany(
+        "INSERT INTO accounts (id, name, currency, start_balance) VALUES ($1, 'bench-payer', 'INR', $2)",
+        [(p, TOTAL * AMOUNT) for p in payers],
+    )
+    return receiver, payers
+
+async def run(stub, receiver: str, payers) -> tuple:
+    per = TOTAL // len(payers)
+
+    async def worker(payer: str):
+        ok = 0
+        for _ in range(per):
+            resp = await stub.Transfer(payment_pb2.TransferRequest(
+                from_account=payer, to_account=receiver, amount=AMOUNT, currency="INR",
+            ))
+            ok += resp.status == "SUCCESS"
+        return ok
+
+    t0 = time.perf_counter()
+    ok = sum(await asyncio.gather(*(worker(p) for p in payers)))
+    return ok, per * len(payers), time.perf_counter() - t0
+
+async def main() -> int:
+    conn = await asyncpg.connect(
+        host=POSTGRES_HOST, port=POSTGRES_PORT, user=POSTGRES_USER, password=POSTGRES_PASSWORD, database=POSTGRES_DB
+    )
+    failures = 0
+    async with grpc.aio.insecure_channel(LEDGER_GRPC_TARGET) as channel:
+        stub = payment_pb2_grpc.LedgerServiceStub(channel)
+        for buckets in BUCKETS:
+            receiver, payers = await setup(conn, buckets)
+            ok, sent, elapsed = await run(stub, receiver, payers)
+            balance = await conn.fetchval(
+                """
+                SELECT b.balance + COALESCE((SELECT SUM(delta) FROM account_balance_buckets WHERE account_id = $1), 0)
+                FROM account_balances b WHERE b.account_id = $1
+                """,
+                receiver,
+            )
+            consistent = balance == ok * AMOUNT
+            failures += not consistent
+            print(
+                f"buckets={buckets:<3} {ok}/{sent} ok in {elapsed:.2f}s -> {sent / elapsed:.0f} transfers/s"
+                f" balance={'OK' if consistent else f'MISMATCH {balance} != {ok * AMOUNT}'}"
+            )
+    await conn.close()
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,73 @@
+"""Ledger group-commit benchmark: transfers/s vs Postgres commits/s.
+
+Talks to the ledger gRPC service directly (bypassing the gateway's locks) and
+samples ``pg_stat_database.xact_commit`` around the run, so the two numbers can
+be compared with batching on and off:
+
+  LEDGER_BATCH_ENABLED=0 docker compose up -d ledger
+  docker compose run --rm gateway python scripts/bench_ledger_batching.py
+  LEDGER_BATCH_ENABLED=1 docker compose up -d ledger
+  docker compose run --rm gateway python scripts/bench_ledger_batching.py
+"""
+
+import os
+import asyncio
+import time
+
+import asyncpg
+import grpc
+
+from gateway import payment_pb2, payment_pb2_grpc
+
+LEDGER_GRPC_TARGET = os.getenv("LEDGER_GRPC_TARGET", "ledger:50051")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
+POSTGRES_DB = os.getenv("POSTGRES_DB", "easpayments")
+POSTGRES_USER = os.getenv("POSTGRES_USER", "easuser")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "easpass")
+
+ALICE = "00000000-0000-0000-0000-0000000000a1"
+BOB = "00000000-0000-0000-0000-0000000000b1"
+
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "64"))
+TOTAL = int(os.getenv("BENCH_TOTAL", "5000"))
+AMOUNT = 1  # paise
+
+async def commit_count(conn) -> int:
+    return await conn.fetchval(
+        "SELECT xact_commit FROM pg_stat_database WHERE datname = current_database()"
+    )
+
+async def worker(stub, n: int, stats: dict):
+    for i in range(n):
+        # alternate direction so neither account drains
+        src, dst = (ALICE, BOB) if i % 2 == 0 else (BOB, ALICE)
+        resp = await stub.Transfer(payment_pb2.TransferRequest(
+            from_account=src, to_account=dst, amount=AMOUNT, currency="INR",
+        ))
+        stats[resp.status] = stats.get(resp.status, 0) + 1
+
+async def main():
+    conn = await asyncpg.connect(
+        host=POSTGRES_HOST, port=POSTGRES_PORT, user=POSTGRES_USER, password=POSTGRES_PASSWORD, database=POSTGRES_DB
+    )
+    async with grpc.aio.insecure_channel(LEDGER_GRPC_TARGET) as channel:
+        stub = payment_pb2_grpc.LedgerServiceStub(channel)
+        stats: dict = {}
+        per_worker = TOTAL // CONCURRENCY
+        commits_before = await commit_count(conn)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(stub, per_worker, stats) for _ in range(CONCURRENCY)))
+        elapsed = time.perf_counter() - t0
+        # pg_stat counters are flushed asynchronously by backends
+        await asyncio.sleep(1)
+        commits = await commit_count(conn) - commits_before
+    await conn.close()
+
+    done = sum(stats.values())
+    print(f"transfers: {done} in {elapsed:.2f}s -> {done / elapsed:.0f} transfers/s ({stats})")
+    print(f"commits:   {commits} -> {commits / elapsed:.0f} commits/s")
+    print(f"transfers per commit: {done / max(commits, 1):.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
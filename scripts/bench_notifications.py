@@ -0,0 +1,69 @@
+"""Notifications throughput benchmark: Notify vs NotifyBatch vs NotifyStream.
+
+Sends the same number of notifications through each RPC shape and prints
+notifications/s. Run it once per ``NOTIFY_FLUSH_MODE`` to compare per-message
+and per-batch flushing:
+
+  docker compose run --rm gateway python scripts/bench_notifications.py
+"""
+
+import os
+import asyncio
+import time
+import uuid
+
+import grpc
+
+from gateway import payment_pb2, payment_pb2_grpc
+
+NOTIFY_GRPC_TARGET = os.getenv("NOTIFY_GRPC_TARGET", "notifications:50052")
+TOTAL = int(os.getenv("BENCH_TOTAL", "20000"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "64"))
+BATCH = int(os.getenv("BENCH_BATCH", "100"))
+
+def make_request(i: int):
+    return payment_pb2.NotificationRequest(
+        account_id="00000000-0000-0000-0000-0000000000a1",
+        tx_id=str(uuid.uuid4()),
+        amount=i,
+        direction="DEBIT",
+        currency="INR",
+        message=f"bench {i}",
+    )
+
+async def bench_unary(stub):
+    async def worker(start: int, n: int):
+        for i in range(start, start + n):
+            await stub.Notify(make_request(i))
+    per = TOTAL // CONCURRENCY
+    await asyncio.gather(*(worker(w * per, per) for w in range(CONCURRENCY)))
+    return per * CONCURRENCY
+
+async def bench_batch(stub):
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(start: int):
+        async with sem:
+            reqs = [make_request(i) for i in range(start, min(start + BATCH, TOTAL))]
+            await stub.NotifyBatch(payment_pb2.NotificationBatchRequest(notifications=reqs))
+    await asyncio.gather(*(one(s) for s in range(0, TOTAL, BATCH)))
+    return TOTAL
+
+async def bench_stream(stub):
+    async def gen():
+        for i in range(TOTAL):
+            yield make_request(i)
+    resp = await stub.NotifyStream(gen())
+    return resp.accepted
+
+async def main():
+    async with grpc.aio.insecure_channel(NOTIFY_GRPC_TARGET) as channel:
+        stub = payment_pb2_grpc.NotificationServiceStub(channel)
+        for name, fn in (("Notify", bench_unary), ("NotifyBatch", bench_batch), ("NotifyStream", bench_stream)):
+            t0 = time.perf_counter()
+            sent = await fn(stub)
+            elapsed = time.perf_counter() - t0
+            print(f"{name:<13} {sent} notifications in {elapsed:.2f}s -> {sent / elapsed:.0f}/s")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,17 +4,27 @@ Usage (from repo root):
   docker compose run --rm gateway python scripts/create_accounts.py
 
 This script is idempotent: it will not duplicate accounts.
+
+With a sharded ledger (``LEDGER_SHARD_DBS=db0,db1,...`` in shard order) each
+account is also written to the database of the shard that owns it;
+``POSTGRES_DB`` then only holds the gateway's account directory.
 """
 
 import os
 import asyncio
 import asyncpg
+import redis.asyncio as redis
+
+from gateway.utils import shard_for
 
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
 POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
 POSTGRES_DB = os.getenv("POSTGRES_DB", "easpayments")
 POSTGRES_USER = os.getenv("POSTGRES_USER", "easuser")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "easpass")
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+LEDGER_SHARD_DBS = [d for d in os.getenv("LEDGER_SHARD_DBS", "").split(",") if d]
+ACCOUNTS_CHANGED_CHANNEL = "accounts:changed"  # see gateway/db.py
 
 # hard-coded demo accounts
 ACCOUNTS = [
@@ -23,9 +33,9 @@ ACCOUNTS = [
     ("00000000-0000-0000-0000-0000000000c1", "Charlie", 0),
 ]
 
-async def main():
+async def ensure_accounts(database: str, accounts):
     conn = await asyncpg.connect(
-        host=POSTGRES_HOST, port=POSTGRES_PORT, user=POSTGRES_USER, password=POSTGRES_PASSWORD, database=POSTGRES_DB
+        host=POSTGRES_HOST, port=POSTGRES_PORT, user=POSTGRES_USER, password=POSTGRES_PASSWORD, database=database
     )
 
     # ensure tables exist (in case ledger hasn't started yet)
@@ -41,7 +51,7 @@ async def main():
         """
     )
 
-    for acct_id, name, start_balance in ACCOUNTS:
+    for acct_id, name, start_balance in accounts:
         await conn.execute(
             """
             INSERT INTO accounts (id, name, currency, start_balance)
@@ -52,6 +62,18 @@ async def main():
         )
 
     await conn.close()
+
+async def main():
+    await ensure_accounts(POSTGRES_DB, ACCOUNTS)
+    for shard, database in enumerate(LEDGER_SHARD_DBS):
+        owned = [a for a in ACCOUNTS if shard_for(a[0], len(LEDGER_SHARD_DBS)) == shard]
+        await ensure_accounts(database, owned)
+
+    # drop stale negative/Bloom entries in running gateways
+    r = redis.from_url(REDIS_URL, decode_responses=True)
+    for acct_id, _, _ in ACCOUNTS:
+        await r.publish(ACCOUNTS_CHANGED_CHANNEL, acct_id)
+    await r.aclose()
     print("Accounts created / ensured.")
 
 if __name__ == "__main__":
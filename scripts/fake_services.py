@@ -0,0 +1,107 @@
+"""In-process fakes of the ledger and notification gRPC services.
+
+Real ``grpc.aio`` servers on ephemeral localhost ports, backed by dicts, so the
+gateway can be benchmarked (or poked at) without the ledger database or the
+notifications container. Used by ``scripts/bench.py --target inprocess``.
+"""
+
+import asyncio
+from typing import Dict, Iterable, Tuple
+import uuid
+
+import grpc
+
+from gateway import payment_pb2, payment_pb2_grpc
+
+class FakeLedger(payment_pb2_grpc.LedgerServiceServicer):
+    """Single-event-loop ledger: balance updates happen between awaits, so they are atomic."""
+
+    def __init__(self, balances: Dict[str, int], currency: str = "INR", latency_s: float = 0.0):
+        self.balances = balances
+        self.versions: Dict[str, int] = {a: 0 for a in balances}
+        self.currency = currency
+        self.latency_s = latency_s
+        self.responses: Dict[str, payment_pb2.TransferResponse] = {}
+        self.transfers = 0
+
+    def _failed(self, request, message: str):
+        return payment_pb2.TransferResponse(
+            from_account=request.from_account, to_account=request.to_account, amount=request.amount,
+            currency=request.currency, status="FAILED", message=message,
+        )
+
+    async def Transfer(self, request, context):  # type: ignore[override]
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        key = request.idempotency_key if request.ledger_dedupe else ""
+        if key and key in self.responses:
+            resp = payment_pb2.TransferResponse()
+            resp.CopyFrom(self.responses[key])
+            resp.replayed = True
+            return resp
+        if request.amount <= 0:
+            return self._failed(request, "Amount must be > 0")
+        if request.from_account not in self.balances or request.to_account not in self.balances:
+            return self._failed(request, "Account not found")
+        if self.balances[request.from_account] < request.amount:
+            return self._failed(request, "Insufficient funds")
+        self.balances[request.from_account] -= request.amount
+        self.balances[request.to_account] += request.amount
+        self.versions[request.from_account] += 1
+        self.versions[request.to_account] += 1
+        self.transfers += 1
+        resp = payment_pb2.TransferResponse(
+            tx_id=str(uuid.uuid4()), from_account=request.from_account, to_account=request.to_account,
+            amount=request.amount, currency=request.currency or self.currency,
+            from_balance_after=self.balances[request.from_account],
+            to_balance_after=self.balances[request.to_account], status="SUCCESS",
+            from_version=self.versions[request.from_account], to_version=self.versions[request.to_account],
+        )
+        if key:
+            self.responses[key] = resp
+        return resp
+
+    async def GetBalance(self, request, context):  # type: ignore[override]
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        return payment_pb2.BalanceResponse(
+            account_id=request.account_id, balance=self.balances.get(request.account_id, 0), currency=self.currency,
+            version=self.versions.get(request.account_id, 0),
+        )
+
+    async def ExportEntries(self, request, context):  # type: ignore[override]
+        return
+        yield
+
+class FakeNotifications(payment_pb2_grpc.NotificationServiceServicer):
+    def __init__(self):
+        self.delivered = 0
+
+    async def Notify(self, request, context):  # type: ignore[override]
+        self.delivered += 1
+        return payment_pb2.NotificationResponse(ok=True)
+
+    async def NotifyBatch(self, request, context):  # type: ignore[override]
+        self.delivered += len(request.notifications)
+        return payment_pb2.NotificationBatchResponse(ok=True, accepted=len(request.notifications))
+
+    async def NotifyStream(self, request_iterator, context):  # type: ignore[override]
+        accepted = 0
+        async for _ in request_iterator:
+            accepted += 1
+        self.delivered += accepted
+        return payment_pb2.NotificationBatchResponse(ok=True, accepted=accepted)
+
+async def start_fakes(
+    accounts: Iterable[str], start_balance: int, ledger_latency_s: float = 0.0
+) -> Tuple[grpc.aio.Server, str, str, FakeLedger, FakeNotifications]:
+    """Start both fakes on one server; returns (server, ledger_target, notify_target, ledger, notifications)."""
+    ledger = FakeLedger({a: start_balance for a in accounts}, latency_s=ledger_latency_s)
+    notifications = FakeNotifications()
+    server = grpc.aio.server()
+    payment_pb2_grpc.add_LedgerServiceServicer_to_server(ledger, server)
+    payment_pb2_grpc.add_NotificationServiceServicer_to_server(notifications, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+    target = f"127.0.0.1:{port}"
+    return server, target, target, ledger, notifications
@@ -0,0 +1,68 @@
+"""Grab an on-demand sampling profile from the gateway or a ledger worker.
+
+Writes collapsed stacks (one ``frame;frame;frame count`` line per stack) to
+stdout or ``--out``; render with flamegraph.pl, inferno or speedscope.
+
+Usage:
+  docker compose run --rm gateway python scripts/profile.py gateway --seconds 15 > gateway.folded
+  docker compose run --rm gateway python scripts/profile.py ledger --target ledger:9120 --seconds 15 > ledger.folded
+
+The token comes from ``--token``, else ``ADMIN_TOKEN`` (for the ledger ``LEDGER_ADMIN_TOKEN`` first).
+With several ledger workers, worker N listens on ``LEDGER_ADMIN_PORT + N``.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+import grpc
+import httpx
+
+from gateway import payment_pb2, payment_pb2_grpc
+
+async def gateway_profile(base_url: str, token: str, seconds: float, interval_ms: float) -> str:
+    async with httpx.AsyncClient(base_url=base_url, timeout=seconds + 30) as client:
+        resp = await client.get(
+            "/admin/profile", params={"seconds": seconds, "interval_ms": interval_ms},
+            headers={"X-Admin-Token": token},
+        )
+        resp.raise_for_status()
+        print(f"{resp.headers.get('X-Profile-Samples', '?')} samples", file=sys.stderr)
+        return resp.text
+
+async def ledger_profile(target: str, token: str, seconds: float, interval_ms: float) -> str:
+    async with grpc.aio.insecure_channel(target) as channel:
+        stub = payment_pb2_grpc.LedgerAdminStub(channel)
+        resp = await stub.Profile(
+            payment_pb2.ProfileRequest(seconds=seconds, interval_ms=interval_ms),
+            metadata=(("x-admin-token", token),), timeout=seconds + 30,
+        )
+        print(f"{resp.samples} samples from ledger worker {resp.worker_id}", file=sys.stderr)
+        return resp.collapsed
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("service", choices=["gateway", "ledger"])
+    parser.add_argument("--target", default="", help="gateway base URL or ledger admin host:port")
+    parser.add_argument("--token", default="")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--interval-ms", type=float, default=5.0)
+    parser.add_argument("--out", default="", help="file to write instead of stdout")
+    args = parser.parse_args()
+
+    if args.service == "gateway":
+        token = args.token or os.getenv("ADMIN_TOKEN", "")
+        text = await gateway_profile(args.target or "http://localhost:8000", token, args.seconds, args.interval_ms)
+    else:
+        token = args.token or os.getenv("LEDGER_ADMIN_TOKEN") or os.getenv("ADMIN_TOKEN", "")
+        text = await ledger_profile(args.target or "ledger:9120", token, args.seconds, args.interval_ms)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,102 @@
+"""Concurrency stress test: the ledger alone must never overdraw an account.
+
+Creates a fresh payer with a small balance and a few payees, then fires many
+concurrent transfers straight at the ledger gRPC service (no gateway, no Redis
+locks), each for more than a fair share of the payer's funds. Afterwards it
+checks that:
+
+  * no account balance went negative,
+  * successful transfers never moved more than the payer started with,
+  * the materialized balances match the entry sums.
+
+Exits non-zero on any violation.
+
+Usage:
+  docker compose run --rm gateway python scripts/stress_no_negative.py
+"""
+
+import os
+import sys
+import asyncio
+import uuid
+
+import asyncpg
+import grpc
+
+from gateway import payment_pb2, payment_pb2_grpc
+
+LEDGER_GRPC_TARGET = os.getenv("LEDGER_GRPC_TARGET", "ledger:50051")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
+POSTGRES_DB = os.getenv("POSTGRES_DB", "easpayments")
+POSTGRES_USER = os.getenv("POSTGRES_USER", "easuser")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "easpass")
+
+START_BALANCE = 10_000
+AMOUNT = 700
+PAYEES = 4
+CONCURRENCY = int(os.getenv("STRESS_CONCURRENCY", "200"))
+
+async def main() -> int:
+    conn = await asyncpg.connect(
+        host=POSTGRES_HOST, port=POSTGRES_PORT, user=POSTGRES_USER, password=POSTGRES_PASSWORD, database=POSTGRES_DB
+    )
+    payer = str(uuid.uuid4())
+    payees = [str(uuid.uuid4()) for _ in range(PAYEES)]
+    await conn.execute(
+        "INSERT INTO accounts (id, name, currency, start_balance) VALUES ($1, 'stress-payer', 'INR', $2)",
+        payer, START_BALANCE,
+    )
+    for p in payees:
+        await conn.execute(
+            "INSERT INTO accounts (id, name, currency, start_balance) VALUES ($1, 'stress-payee', 'INR', 0)", p
+        )
+
+    async with grpc.aio.insecure_channel(LEDGER_GRPC_TARGET) as channel:
+        stub = payment_pb2_grpc.LedgerServiceStub(channel)
+
+        async def one(i: int):
+            # payees also pay each other so credits race with debits on the same rows
+            src, dst = (payer, payees[i % PAYEES]) if i % 3 else (payees[i % PAYEES], payees[(i + 1) % PAYEES])
+            return src, await stub.Transfer(payment_pb2.TransferRequest(
+                from_account=src, to_account=dst, amount=AMOUNT, currency="INR",
+            ))
+
+        results = await asyncio.gather(*(one(i) for i in range(CONCURRENCY)))
+
+    payer_successes = sum(1 for src, r in results if src == payer and r.status == "SUCCESS")
+    ids = [payer] + payees
+    balances = dict(await conn.fetch(
+        "SELECT account_id, balance FROM account_balances WHERE account_id = ANY($1)", ids
+    ))
+    drift = await conn.fetch(
+        """
+        SELECT a.id FROM accounts a JOIN account_balances b ON b.account_id = a.id
+        WHERE a.id = ANY($1) AND b.balance <> a.start_balance + COALESCE((
+            SELECT SUM(e.amount * e.direction) FROM account_entries e WHERE e.account_id = a.id::uuid), 0)
+          + COALESCE((SELECT SUM(d.delta) FROM ledger_archive_deltas d WHERE d.account_id = a.id::uuid), 0)
+        """,
+        ids,
+    )
+    await conn.close()
+
+    failures = []
+    negative = {k: v for k, v in balances.items() if v < 0}
+    if negative:
+        failures.append(f"negative balances: {negative}")
+    if payer_successes * AMOUNT > START_BALANCE:
+        failures.append(f"payer overdrawn: {payer_successes} x {AMOUNT} > {START_BALANCE}")
+    if sum(balances.values()) != START_BALANCE:
+        failures.append(f"money not conserved: {sum(balances.values())} != {START_BALANCE}")
+    if drift:
+        failures.append(f"materialized balance drift on {[r['id'] for r in drift]}")
+
+    print(f"{CONCURRENCY} concurrent transfers, payer successes={payer_successes}, balances={balances}")
+    for f in failures:
+        print("FAIL:", f)
+    if not failures:
+        print("OK: no negative balances, no overdraft, balances consistent")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,105 @@
+"""Offline tail-latency report over exported trace files.
+
+Reads the OTLP/JSON lines written by ``TRACE_FILE`` in each service, joins
+the spans by trace id and prints:
+
+  * per span name: count and p50/p99/max duration, plus p99 *self* time
+    (duration minus time covered by child spans), which points at the stage
+    that actually spent the time
+  * the slowest root traces as indented span trees
+
+Usage:
+  python scripts/trace_report.py traces/*.jsonl [--top 10] [--root "POST /transfer"]
+"""
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+def load(paths) -> Dict[str, dict]:
+    spans = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                for rs in json.loads(line).get("resourceSpans", []):
+                    service = next(
+                        (a["value"].get("stringValue") for a in rs["resource"]["attributes"] if a["key"] == "service.name"),
+                        "?",
+                    )
+                    for ss in rs["scopeSpans"]:
+                        for s in ss["spans"]:
+                            start, end = int(s["startTimeUnixNano"]), int(s["endTimeUnixNano"])
+                            spans[s["spanId"]] = dict(
+                                trace_id=s["traceId"], span_id=s["spanId"], parent_id=s.get("parentSpanId", ""),
+                                name=s["name"], service=service, start=start, dur=end - start,
+                                error=s.get("status", {}).get("message"), children=[],
+                            )
+    for s in spans.values():
+        parent = spans.get(s["parent_id"])
+        if parent is not None:
+            parent["children"].append(s)
+    return spans
+
+def _covered(children: List[dict]) -> int:
+    """Wall time covered by the union of the children's intervals (they may run concurrently)."""
+    total, cur_start, cur_end = 0, None, None
+    for c in sorted(children, key=lambda c: c["start"]):
+        s, e = c["start"], c["start"] + c["dur"]
+        if cur_end is None or s > cur_end:
+            if cur_end is not None:
+                total += cur_end - cur_start
+            cur_start, cur_end = s, e
+        else:
+            cur_end = max(cur_end, e)
+    if cur_end is not None:
+        total += cur_end - cur_start
+    return total
+
+def _pct(sorted_vals: List[int], p: float) -> float:
+    return sorted_vals[min(len(sorted_vals) - 1, int(p * len(sorted_vals)))] / 1e6
+
+def summarize(spans: Dict[str, dict]):
+    durs, selfs = defaultdict(list), defaultdict(list)
+    for s in spans.values():
+        key = f"{s['service']}: {s['name']}"
+        durs[key].append(s["dur"])
+        selfs[key].append(max(0, s["dur"] - _covered(s["children"])))
+    print(f"{'span':<56} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'p99 self':>9}")
+    for key in sorted(durs, key=lambda k: -_pct(sorted(selfs[k]), 0.99)):
+        d, sf = sorted(durs[key]), sorted(selfs[key])
+        print(
+            f"{key[:56]:<56} {len(d):>7} {_pct(d, 0.50):>9.2f} {_pct(d, 0.99):>9.2f} {d[-1] / 1e6:>9.2f}"
+            f" {_pct(sf, 0.99):>9.2f}"
+        )
+
+def _print_tree(s: dict, t0: int, depth: int = 0):
+    err = f"  ERROR {s['error']}" if s["error"] else ""
+    print(f"  {'  ' * depth}{s['service']}: {s['name']}  +{(s['start'] - t0) / 1e6:.2f}ms  {s['dur'] / 1e6:.2f}ms{err}")
+    for c in sorted(s["children"], key=lambda c: c["start"]):
+        _print_tree(c, t0, depth + 1)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--top", type=int, default=5, help="slowest traces to print")
+    parser.add_argument("--root", default="", help="only root spans with this name")
+    args = parser.parse_args()
+
+    spans = load(args.files)
+    if not spans:
+        print("no spans found")
+        return 1
+    summarize(spans)
+    roots = [s for s in spans.values() if s["parent_id"] not in spans and (not args.root or s["name"] == args.root)]
+    roots.sort(key=lambda s: -s["dur"])
+    for s in roots[:args.top]:
+        print(f"\ntrace {s['trace_id']}  {s['dur'] / 1e6:.2f}ms")
+        _print_tree(s, s["start"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""Shared fixtures: generated gRPC stubs, a scratch Postgres database per test and Redis.
+
+Database tests connect with the services' own ``POSTGRES_HOST``, ``POSTGRES_PORT``,
+``POSTGRES_USER`` and ``POSTGRES_PASSWORD`` (by default the compose database on
+localhost), create a fresh database for every test and drop it afterwards. Redis
+tests use ``REDIS_URL`` (by default localhost:6379) with random keys. Tests are
+skipped when their server is not reachable, unless ``TESTS_REQUIRE_SERVICES=1``
+(set in CI) turns that into a failure:
+
+  docker compose up -d postgres redis
+  pip install -r tests/requirements.txt
+  python -m pytest -q
+"""
+
+import asyncio
+import contextlib
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# the gateway's settings default to the compose service names; tests run on the host
+os.environ.setdefault("POSTGRES_HOST", "localhost")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+REQUIRE_SERVICES = os.getenv("TESTS_REQUIRE_SERVICES", "0") == "1"
+
+# the ledger imports the stubs as top-level modules, like its Dockerfile generates them
+_STUBS = tempfile.mkdtemp(prefix="eas-stubs-")
+from grpc_tools import protoc  # noqa: E402
+
+protoc.main([
+    "grpc_tools.protoc", f"-I{ROOT}/proto", f"--python_out={_STUBS}", f"--grpc_python_out={_STUBS}",
+    f"{ROOT}/proto/payment.proto",
+])
+sys.path.insert(0, _STUBS)
+
+# the gateway imports them from its own package (its Dockerfile generates them there)
+import gateway  # noqa: E402
+import payment_pb2  # noqa: E402
+import payment_pb2_grpc  # noqa: E402
+
+for _name, _module in (("payment_pb2", payment_pb2), ("payment_pb2_grpc", payment_pb2_grpc)):
+    sys.modules[f"gateway.{_name}"] = _module
+    setattr(gateway, _name, _module)
+
+import asyncpg  # noqa: E402
+
+def _dsn(database: str) -> str:
+    return (
+        f"postgresql://{os.getenv('POSTGRES_USER', 'easuser')}:{os.getenv('POSTGRES_PASSWORD', 'easpass')}"
+        f"@{os.getenv('POSTGRES_HOST', 'localhost')}:{os.getenv('POSTGRES_PORT', '5432')}/{database}"
+    )
+
+async def _admin(sql: str):
+    conn = await asyncpg.connect(_dsn("postgres"), timeout=3)
+    try:
+        await conn.execute(sql)
+    finally:
+        await conn.close()
+
+def _unavailable(reason: str):
+    if REQUIRE_SERVICES:
+        pytest.fail(reason, pytrace=False)
+    pytest.skip(reason)
+
+@pytest.fixture(scope="session")
+def postgres():
+    try:
+        asyncio.run(_admin("SELECT 1"))
+    except (OSError, asyncpg.PostgresError, asyncio.TimeoutError) as e:
+        _unavailable(f"no Postgres at {_dsn('postgres')}: {e}")
+
+@pytest.fixture(scope="session")
+def redis_server():
+    """``REDIS_URL``, once it answers a PING."""
+    import redis.asyncio as redis
+    from redis.exceptions import RedisError
+
+    url = os.environ["REDIS_URL"]
+
+    async def ping():
+        client = redis.from_url(url, socket_connect_timeout=3)
+        try:
+            await client.ping()
+        finally:
+            await client.aclose()
+    try:
+        asyncio.run(ping())
+    except (OSError, RedisError) as e:
+        _unavailable(f"no Redis at {url}: {e}")
+    return url
+
+@pytest.fixture
+def gateway_redis(redis_server, monkeypatch):
+    """The gateway's ``redis_lock`` module talking to the test Redis (a fresh client per ``run``)."""
+    from gateway import redis_lock
+    from gateway.config import settings
+    monkeypatch.setattr(settings, "redis_url", redis_server)
+    return redis_lock
+
+@pytest.fixture
+def scratch_database(postgres):
+    """Name of a database that does not exist yet; dropped after the test."""
+    name = f"eas_test_{uuid.uuid4().hex[:12]}"
+    yield name
+    asyncio.run(_admin(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)'))
+
+@pytest.fixture
+def ledger_db(scratch_database, monkeypatch):
+    """The ``ledger.db`` module pointed at an empty scratch database (created on first use)."""
+    from ledger import db
+    monkeypatch.setattr(db, "POSTGRES_DB", scratch_database)
+    monkeypatch.setattr(db, "DATABASE_URL", db.DATABASE_URL.rsplit("/", 1)[0] + "/" + scratch_database)
+    monkeypatch.setattr(db, "POSTGRES_READ_HOST", "")
+    return db
+
+@pytest.fixture
+def ledger(ledger_db, run, monkeypatch):
+    """A scratch ledger database booted like a fresh deployment: created, migrated and partitioned."""
+    from ledger import server
+    monkeypatch.setattr(ledger_db, "LEDGER_CREATE_DATABASE", True)
+    run(server.prepare_database())
+    return ledger_db
+
+@pytest.fixture
+def open_account(ledger):
+    """``await open_account(balance, currency="INR")`` inserts an account and returns its id."""
+    async def _open(balance: int, currency: str = "INR") -> str:
+        account_id = str(uuid.uuid4())
+        engine = await ledger.get_engine()
+        async with engine.begin() as conn:
+            await conn.execute(ledger.accounts.insert().values(
+                id=account_id, name=account_id[:8], currency=currency, start_balance=balance,
+            ))
+        return account_id
+    return _open
+
+@pytest.fixture
+def gateway_db(ledger, run, monkeypatch):
+    """The ``gateway.db`` module on the same scratch database, with its own tables created."""
+    from gateway import db
+    monkeypatch.setattr(db, "DATABASE_URL", db.DATABASE_URL.rsplit("/", 1)[0] + "/" + ledger.POSTGRES_DB)
+    monkeypatch.setattr(db, "_engine", None)
+    monkeypatch.setattr(db, "_async_session", None)
+    run(db.ensure_tables_exist())
+    return db
+
+@pytest.fixture
+def ledger_server(ledger):
+    """``async with ledger_server() as target``: an in-process LedgerService listening on ``target``."""
+    import grpc
+    import payment_pb2_grpc
+    from ledger.server import LedgerService
+
+    @contextlib.asynccontextmanager
+    async def _serve():
+        server = grpc.aio.server()
+        payment_pb2_grpc.add_LedgerServiceServicer_to_server(LedgerService(), server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            yield f"127.0.0.1:{port}"
+        finally:
+            await server.stop(None)
+    return _serve
+
+@pytest.fixture
+def ledger_stub(ledger_server):
+    """``async with ledger_stub() as stub``: a LedgerService stub talking to an in-process server."""
+    import grpc
+    import payment_pb2_grpc
+
+    @contextlib.asynccontextmanager
+    async def _stub():
+        async with ledger_server() as target, grpc.aio.insecure_channel(target) as channel:
+            yield payment_pb2_grpc.LedgerServiceStub(channel)
+    return _stub
+
+@pytest.fixture
+def ledger_shards(gateway_db, ledger_server, monkeypatch):
+    """``async with ledger_shards(n) as grpc_clients``: the gateway's clients routing ``n`` shards to one
+    in-process ledger, so cross-shard transfers run their two phases against a single database."""
+    from gateway import grpc_clients
+    from gateway.config import settings
+
+    @contextlib.asynccontextmanager
+    async def _shards(n: int = 2):
+        async with ledger_server() as target:
+            monkeypatch.setattr(settings, "ledger_shard_targets", ",".join([target] * n))
+            monkeypatch.setattr(grpc_clients, "_ledger_channels", [])
+            monkeypatch.setattr(grpc_clients, "_ledger_stubs", [])
+            try:
+                yield grpc_clients
+            finally:
+                for channel in grpc_clients._ledger_channels:
+                    await channel.close()
+    return _shards
+
+async def _close_gateway_redis():
+    # the client and its registered scripts belong to this loop
+    redis_lock = sys.modules.get("gateway.redis_lock")
+    if redis_lock is None or redis_lock._redis_client is None:
+        return
+    await redis_lock._redis_client.aclose()
+    redis_lock._redis_client = None
+    redis_lock._acquire_script = redis_lock._release_script = None
+    balance_cache = sys.modules.get("gateway.balance_cache")
+    if balance_cache is not None:
+        balance_cache._put_script = None
+
+@pytest.fixture
+def run():
+    """Run a coroutine on a fresh event loop, closing the service engines and Redis client before it closes."""
+    def _run(coro):
+        async def wrapper():
+            try:
+                return await coro
+            finally:
+                from ledger import db
+                await db.dispose_engine()
+                gateway_db = sys.modules.get("gateway.db")
+                if gateway_db is not None and gateway_db._engine is not None:
+                    await gateway_db._engine.dispose()
+                await _close_gateway_redis()
+        return asyncio.run(wrapper())
+    return _run
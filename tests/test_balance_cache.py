@@ -0,0 +1,19 @@
+import uuid
+
+def test_cache_keeps_the_newest_version(gateway_redis, run):
+    from gateway import balance_cache
+
+    async def scenario():
+        acct = str(uuid.uuid4())
+        await balance_cache.put(acct, 750, 8, "INR")
+        # a read that fetched version 7 arrives after the transfer that wrote version 8
+        await balance_cache.put(acct, 1000, 7, "INR")
+        cached = await balance_cache.get(acct)
+        too_old = await balance_cache.get(acct, min_version=9)
+        await balance_cache.invalidate(acct)
+        return cached, too_old, await balance_cache.get(acct)
+
+    cached, too_old, after_invalidate = run(scenario())
+    assert cached == (750, "INR", 8)
+    assert too_old is None
+    assert after_invalidate is None
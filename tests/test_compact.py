@@ -0,0 +1,64 @@
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+# the two-row layout every ledger before the compact schema wrote
+_LEGACY_SCHEMA = [
+    """CREATE TABLE accounts (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        currency TEXT NOT NULL DEFAULT 'INR',
+        start_balance BIGINT NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )""",
+    """CREATE TABLE ledger_entries (
+        id BIGSERIAL PRIMARY KEY,
+        tx_id TEXT NOT NULL,
+        account_id TEXT NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+        direction TEXT NOT NULL CHECK (direction IN ('DEBIT','CREDIT')),
+        amount BIGINT NOT NULL CHECK (amount > 0),
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )""",
+]
+
+async def _legacy_database(ledger_db, payer: str, payee: str):
+    await ledger_db.ensure_database()
+    engine = await ledger_db.get_engine()
+    async with engine.begin() as conn:
+        for statement in _LEGACY_SCHEMA:
+            await conn.execute(text(statement))
+        await conn.execute(text(
+            "INSERT INTO accounts (id, name, start_balance) VALUES"
+            " (:payer, 'payer', 1000), (:payee, 'payee', 0), ('house-account', 'house', 50)"
+        ), {"payer": payer, "payee": payee})
+        for tx_id, amount in ((str(uuid.uuid4()), 300), (str(uuid.uuid4()), 25)):
+            await conn.execute(text(
+                "INSERT INTO ledger_entries (tx_id, account_id, direction, amount, created_at) VALUES"
+                " (:tx, :payer, 'DEBIT', :amount, now() - interval '40 days'),"
+                " (:tx, :payee, 'CREDIT', :amount, now() - interval '40 days')"
+            ), {"tx": tx_id, "payer": payer, "payee": payee, "amount": amount})
+
+def test_upgrading_a_legacy_database_keeps_its_balances(ledger_db, run):
+    from ledger import compact, crud, server
+
+    payer, payee = str(uuid.uuid4()), str(uuid.uuid4())
+
+    async def scenario():
+        await _legacy_database(ledger_db, payer, payee)
+        # the new version must not serve balances that miss the legacy history
+        with pytest.raises(RuntimeError):
+            await server.prepare_database()
+        copied = await compact.migrate(batch=1, pause_s=0)
+        await server.prepare_database()
+        session = await ledger_db.get_session()
+        async with session.begin():
+            balances = [await crud.get_balance(session, a) for a in (payer, payee, "house-account")]
+            mismatches = await crud.verify_balances(session)
+        return copied, balances, mismatches, await compact.verify()
+
+    copied, balances, mismatches, missing = run(scenario())
+    assert copied == 4
+    assert balances == [675, 325, 50]
+    assert list(mismatches) == []
+    assert missing == 0
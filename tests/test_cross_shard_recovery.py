@@ -0,0 +1,147 @@
+import uuid
+
+import grpc
+import pytest
+from sqlalchemy import select, text
+
+def _transfer(from_account: str, to_account: str, amount: int) -> dict:
+    return dict(
+        tx_id=str(uuid.uuid4()), idempotency_key=None, from_account=from_account, to_account=to_account,
+        amount=amount, currency="INR", from_shard=0, to_shard=1,
+    )
+
+@pytest.fixture
+def invalidated(monkeypatch):
+    """Account ids the coordinator dropped from the balance cache."""
+    from gateway import balance_cache
+
+    dropped = []
+
+    async def invalidate(*account_ids):
+        dropped.extend(account_ids)
+    monkeypatch.setattr(balance_cache, "invalidate", invalidate)
+    return dropped
+
+async def _stall(gateway_db, tx_id: str):
+    # the coordinator crashed long enough ago for recovery to pick the row up
+    engine = await gateway_db.get_engine()
+    async with engine.begin() as conn:
+        await conn.execute(
+            text("UPDATE shard_transfers SET updated_at = now() - interval '1 hour' WHERE tx_id = :tx_id"),
+            {"tx_id": tx_id},
+        )
+
+async def _ledger_state(ledger, tx_id: str, *accts: str):
+    from ledger import crud
+    session = await ledger.get_session()
+    async with session.begin():
+        balances = [await crud.get_balance(session, a) for a in accts]
+        legs = (await session.execute(
+            select(ledger.transfer_legs.c.direction, ledger.transfer_legs.c.state)
+            .where(ledger.transfer_legs.c.tx_id == tx_id)
+        )).all()
+        return balances, dict(legs), list(await crud.verify_balances(session))
+
+async def _shard_state(gateway_db, tx_id: str) -> dict:
+    async with await gateway_db.get_session() as session:
+        q = select(gateway_db.shard_transfers).where(gateway_db.shard_transfers.c.tx_id == tx_id)
+        return dict((await session.execute(q)).mappings().one())
+
+def test_recovery_aborts_a_transfer_stalled_after_reserve(
+    ledger, gateway_db, ledger_shards, open_account, run, invalidated,
+):
+    from gateway import sharding
+
+    async def scenario():
+        alice, bob = await open_account(1000), await open_account(0)
+        t = _transfer(alice, bob, 250)
+        async with ledger_shards():
+            assert await gateway_db.log_shard_transfer(t) is None
+            assert all(ok for ok, _ in await sharding._call_legs(t, "ReserveLeg"))
+            held, _, _ = await _ledger_state(ledger, t["tx_id"], alice, bob)
+            await _stall(gateway_db, t["tx_id"])
+            recovered = await sharding.recover_once()
+        return (alice, bob), held, recovered, await _ledger_state(ledger, t["tx_id"], alice, bob), \
+            await _shard_state(gateway_db, t["tx_id"])
+
+    accts, held, recovered, (balances, legs, mismatches), row = run(scenario())
+    assert held == [750, 0]
+    assert recovered == 1
+    assert row["state"] == sharding.ABORTED
+    assert balances == [1000, 0]
+    assert legs == {"DEBIT": "ABORTED", "CREDIT": "ABORTED"}
+    assert mismatches == []
+    # the cached balance may have been read while the hold was in place
+    assert sorted(invalidated) == sorted(accts)
+
+def test_recovery_commits_a_transfer_stalled_while_committing(
+    ledger, gateway_db, ledger_shards, open_account, run, invalidated,
+):
+    from gateway import sharding
+
+    async def scenario():
+        alice, bob = await open_account(1000), await open_account(0)
+        t = _transfer(alice, bob, 250)
+        async with ledger_shards():
+            await gateway_db.log_shard_transfer(t)
+            await sharding._call_legs(t, "ReserveLeg")
+            assert await gateway_db.transition_shard_transfer(t["tx_id"], [sharding.PREPARING], sharding.COMMITTING)
+            await _stall(gateway_db, t["tx_id"])
+            recovered = await sharding.recover_once()
+            again = await sharding.recover_once()
+        return (alice, bob), recovered, again, await _ledger_state(ledger, t["tx_id"], alice, bob), \
+            await _shard_state(gateway_db, t["tx_id"])
+
+    accts, recovered, again, (balances, legs, mismatches), row = run(scenario())
+    assert (recovered, again) == (1, 0)
+    assert row["state"] == sharding.COMMITTED
+    assert (row["from_balance_after"], row["to_balance_after"]) == (750, 250)
+    assert balances == [750, 250]
+    assert legs == {"DEBIT": "COMMITTED", "CREDIT": "COMMITTED"}
+    assert mismatches == []
+    assert sorted(invalidated) == sorted(accts)
+
+def test_failed_reserve_releases_the_hold(ledger, gateway_db, ledger_shards, open_account, run, invalidated):
+    from gateway import sharding
+
+    async def scenario():
+        alice, bob = await open_account(100), await open_account(0)
+        async with ledger_shards():
+            resp = await sharding.cross_shard_transfer(0, 1, alice, bob, 250)
+        return resp, await _ledger_state(ledger, "", alice, bob)
+
+    resp, (balances, _, mismatches) = run(scenario())
+    assert resp.status == "FAILED" and resp.message == "Insufficient funds"
+    assert balances == [100, 0]
+    assert mismatches == []
+
+def test_cross_shard_currency_mismatch_is_invalid_argument(
+    ledger, gateway_db, ledger_shards, open_account, run, invalidated,
+):
+    from gateway import sharding
+    from ledger import crud
+
+    async def scenario():
+        alice, bob = await open_account(1000), await open_account(0, currency="USD")
+        async with ledger_shards():
+            with pytest.raises(grpc.aio.AioRpcError) as err:
+                await sharding.cross_shard_transfer(0, 1, alice, bob, 250, "INR")
+        session = await ledger.get_session()
+        async with session.begin():
+            balances = [await crud.get_balance(session, a) for a in (alice, bob)]
+        async with await gateway_db.get_session() as session:
+            states = (await session.execute(select(gateway_db.shard_transfers.c.state))).scalars().all()
+        return err.value.code(), balances, states
+
+    code, balances, states = run(scenario())
+    # the same 400 a same-shard transfer gets, with the debit's hold released
+    assert code == grpc.StatusCode.INVALID_ARGUMENT
+    assert balances == [1000, 0]
+    assert states == [sharding.ABORTED]
+
+def test_doubling_the_shards_splits_each_hash_range():
+    from gateway.utils import shard_for
+
+    for account_id in (str(uuid.uuid4()) for _ in range(500)):
+        shard = shard_for(account_id, 2)
+        assert shard_for(account_id, 4) in (2 * shard, 2 * shard + 1)
@@ -0,0 +1,237 @@
+import uuid
+
+import grpc
+import pytest
+from sqlalchemy import select, text
+
+def _key() -> str:
+    return f"test-{uuid.uuid4()}"
+
+async def _expire_claim(gateway_db, key: str, age_s: float = 3600):
+    # the owner died mid-request and left its claim behind
+    engine = await gateway_db.get_engine()
+    async with engine.begin() as conn:
+        await conn.execute(
+            text("UPDATE idempotency_keys SET claimed_at = now() - make_interval(secs => :age) WHERE key = :key"),
+            {"age": age_s, "key": key},
+        )
+
+def _notification(key: str, tx_id: str) -> dict:
+    return dict(
+        id=str(uuid.uuid4()), account_id=str(uuid.uuid4()), tx_id=tx_id, amount=1,
+        direction="DEBIT", currency="INR", message=key,
+    )
+
+def test_gateway_replays_a_finalized_key(gateway_db, run):
+    async def scenario():
+        key = _key()
+        first = await gateway_db.claim_idempotency_record(key)
+        duplicate = await gateway_db.claim_idempotency_record(key)
+        await gateway_db.finalize_idempotency_record(
+            key, first["token"], "SUCCESS", "tx-1", {"tx_id": "tx-1", "status": "SUCCESS"}
+        )
+        replay = await gateway_db.claim_idempotency_record(key)
+        return first, duplicate, replay
+
+    first, duplicate, replay = run(scenario())
+    assert first["claimed"]
+    assert not duplicate["claimed"] and duplicate["status"] == "IN_PROGRESS"
+    assert not replay["claimed"] and replay["response"] == {"tx_id": "tx-1", "status": "SUCCESS"}
+
+def test_gateway_reclaims_a_key_after_a_failed_transfer(gateway_db, run):
+    async def scenario():
+        key = _key()
+        first = await gateway_db.claim_idempotency_record(key)
+        await gateway_db.finalize_idempotency_record(key, first["token"], "FAILED", "", {"status": "FAILED"})
+        return await gateway_db.claim_idempotency_record(key)
+
+    assert run(scenario())["claimed"]
+
+def test_stale_owner_cannot_finalize_or_release_after_a_takeover(gateway_db, run):
+    async def scenario():
+        key = _key()
+        stale = await gateway_db.claim_idempotency_record(key)
+        await _expire_claim(gateway_db, key)
+        owner = await gateway_db.claim_idempotency_record(key)
+        stale_finalized = await gateway_db.finalize_idempotency_record(
+            key, stale["token"], "SUCCESS", "tx-stale", {"tx_id": "tx-stale"}, [_notification(key, "tx-stale")],
+        )
+        stale_released = await gateway_db.release_idempotency_record(key, stale["token"])
+        owner_finalized = await gateway_db.finalize_idempotency_record(
+            key, owner["token"], "SUCCESS", "tx-1", {"tx_id": "tx-1"}, [_notification(key, "tx-1")],
+        )
+        async with await gateway_db.get_session() as session:
+            notified = (await session.execute(
+                select(gateway_db.notifications.c.tx_id).where(gateway_db.notifications.c.message == key)
+            )).scalars().all()
+        return owner["claimed"], stale_finalized, stale_released, owner_finalized, \
+            await gateway_db.get_idempotency_record(key), notified
+
+    taken_over, stale_finalized, stale_released, owner_finalized, rec, notified = run(scenario())
+    assert taken_over
+    assert not stale_finalized and not stale_released
+    assert owner_finalized
+    assert (rec["status"], rec["response"]) == ("SUCCESS", {"tx_id": "tx-1"})
+    assert notified == ["tx-1"]
+
+@pytest.mark.parametrize("age_s, taken_over", [(5, False), (3600, True)])
+def test_gateway_takes_over_an_expired_claim(gateway_db, run, age_s, taken_over):
+    async def scenario():
+        key = _key()
+        await gateway_db.claim_idempotency_record(key)
+        await _expire_claim(gateway_db, key, age_s)
+        return await gateway_db.claim_idempotency_record(key)
+
+    assert run(scenario())["claimed"] is taken_over
+
+def test_ledger_dedupe_replays_the_stored_response(ledger, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        alice, bob = await open_account(1000), await open_account(0)
+        key = _key()
+        session = await ledger.get_session()
+        results = []
+        for _ in range(2):
+            async with session.begin():
+                results.append(await crud.apply_transfer(session, alice, bob, 100, "INR", idempotency_key=key))
+        async with session.begin():
+            balances = await crud.get_balance(session, alice), await crud.get_balance(session, bob)
+        return results, balances
+
+    [(first, first_replayed), (second, second_replayed)], balances = run(scenario())
+    assert not first_replayed and second_replayed
+    assert second["tx_id"] == first["tx_id"]
+    assert balances == (900, 100)
+
+def test_ledger_dedupe_retries_after_a_rejected_transfer(ledger, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        alice, bob = await open_account(50), await open_account(0)
+        key = _key()
+        session = await ledger.get_session()
+        with pytest.raises(ValueError):
+            async with session.begin():
+                await crud.apply_transfer(session, alice, bob, 100, "INR", idempotency_key=key)
+        # the rejection rolled the key back with it; the retry runs the transfer
+        async with session.begin():
+            response, replayed = await crud.apply_transfer(session, alice, bob, 50, "INR", idempotency_key=key)
+        return response, replayed
+
+    response, replayed = run(scenario())
+    assert response["status"] == "SUCCESS" and not replayed
+    assert (response["from_balance_after"], response["to_balance_after"]) == (0, 50)
+
+def test_ledger_dedupe_applies_once_under_a_gateway_claim(ledger, gateway_db, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        alice, bob = await open_account(1000), await open_account(0)
+        key = _key()
+        # the gateway's claim on the key shares the database with the ledger
+        assert (await gateway_db.claim_idempotency_record(key))["claimed"]
+        session = await ledger.get_session()
+        results = []
+        for _ in range(2):
+            async with session.begin():
+                results.append(await crud.apply_transfer(session, alice, bob, 100, "INR", idempotency_key=key))
+        async with session.begin():
+            return results, (await crud.get_balance(session, alice), await crud.get_balance(session, bob))
+
+    [(first, first_replayed), (second, second_replayed)], balances = run(scenario())
+    assert not first_replayed and second_replayed
+    assert second["tx_id"] == first["tx_id"]
+    assert balances == (900, 100)
+
+def _rpc_error(code):
+    return grpc.aio.AioRpcError(code, grpc.aio.Metadata(), grpc.aio.Metadata(), details=code.name)
+
+@pytest.mark.parametrize("code, kept", [
+    (grpc.StatusCode.UNAVAILABLE, True),
+    (grpc.StatusCode.DEADLINE_EXCEEDED, True),
+    (grpc.StatusCode.INVALID_ARGUMENT, False),
+])
+def test_gateway_keeps_the_claim_when_the_ledger_outcome_is_unknown(gateway_db, run, monkeypatch, code, kept):
+    from gateway import app, grpc_clients
+    from gateway.config import settings
+    from gateway.schemas import TransferIn
+
+    sent = []
+
+    async def ledger_transfer(**kwargs):
+        sent.append(kwargs)
+        raise _rpc_error(code)
+
+    async def account_exists(account_id):
+        return True
+
+    monkeypatch.setattr(grpc_clients, "ledger_transfer", ledger_transfer)
+    monkeypatch.setattr(gateway_db, "account_exists", account_exists)
+    monkeypatch.setattr(settings, "gateway_account_locks", False)
+    monkeypatch.setattr(settings, "transfer_fast_path", False)
+
+    async def scenario():
+        req = TransferIn(
+            from_account=str(uuid.uuid4()), to_account=str(uuid.uuid4()), amount=1, idempotency_key=_key(),
+        )
+        with pytest.raises(Exception):
+            await app._transfer(req)
+        return await gateway_db.get_idempotency_record(req.idempotency_key)
+
+    rec = run(scenario())
+    # an unknown outcome may have committed: the claim stays until the ledger can be asked again
+    assert (rec is not None and rec["status"] == "IN_PROGRESS") is kept
+    assert sent[0]["ledger_dedupe"] is True
+
+def test_coalesce_survives_the_first_caller_being_cancelled(run):
+    import asyncio
+
+    from gateway import idempotency
+
+    async def scenario():
+        key = _key()
+        release = asyncio.Event()
+        calls = []
+
+        async def transfer():
+            calls.append(key)
+            await release.wait()
+            return {"status": "SUCCESS"}
+
+        first = asyncio.create_task(idempotency.coalesce(key, transfer))
+        await asyncio.sleep(0)
+        duplicate = asyncio.create_task(idempotency.coalesce(key, transfer))
+        await asyncio.sleep(0)
+        # the first client disconnects while its transfer is still running
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        result = await duplicate
+        return first.cancelled(), result, calls, key in idempotency._inflight
+
+    first_cancelled, result, calls, still_inflight = run(scenario())
+    assert first_cancelled
+    assert result == {"status": "SUCCESS"}
+    assert len(calls) == 1
+    assert not still_inflight
+
+def test_duplicate_on_another_replica_gets_the_finalized_response(gateway_db, gateway_redis, run):
+    import asyncio
+
+    from gateway import idempotency
+
+    async def scenario():
+        key = _key()
+        owner = await idempotency.claim_idempotency(key)
+        duplicate = await idempotency.claim_idempotency(key)
+        # the duplicate's replica subscribes, then the owner's replica finalizes and publishes
+        waiter = asyncio.create_task(idempotency.wait_for_completion(key, timeout=5))
+        await asyncio.sleep(0.2)
+        response = {"tx_id": "tx-1", "status": "SUCCESS"}
+        await idempotency.finalize_idempotency(key, owner, "SUCCESS", "tx-1", response)
+        return owner.state, duplicate.state, await waiter
+
+    owner, duplicate, received = run(scenario())
+    assert (owner, duplicate) == ("OWNER", "IN_FLIGHT")
+    assert received == {"tx_id": "tx-1", "status": "SUCCESS"}
@@ -0,0 +1,211 @@
+import asyncio
+import random
+
+import grpc
+import pytest
+from sqlalchemy import select
+
+import payment_pb2
+
+def test_self_transfer_is_rejected(ledger, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        acct = await open_account(1000)
+        session = await ledger.get_session()
+        with pytest.raises(crud.InvalidTransfer):
+            async with session.begin():
+                await crud.apply_transfer(session, acct, acct, 1, "INR")
+        async with session.begin():
+            return await crud.get_balance(session, acct), await crud.verify_balances(session)
+
+    balance, mismatches = run(scenario())
+    assert balance == 1000
+    assert list(mismatches) == []
+
+def test_self_transfer_rpc_is_invalid_argument(ledger_stub, open_account, run):
+    async def scenario():
+        acct = await open_account(1000)
+        async with ledger_stub() as stub:
+            with pytest.raises(grpc.aio.AioRpcError) as err:
+                await stub.Transfer(payment_pb2.TransferRequest(
+                    from_account=acct, to_account=acct, amount=1, currency="INR",
+                ))
+        return err.value.code()
+
+    assert run(scenario()) == grpc.StatusCode.INVALID_ARGUMENT
+
+def test_balance_deltas_on_one_account_net_out(ledger, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        acct = await open_account(1000)
+        session = await ledger.get_session()
+        async with session.begin():
+            await crud.lock_balances(session, [acct])
+            (from_after, _), (to_after, _) = await crud.apply_balance_deltas(session, acct, acct, 7)
+        async with session.begin():
+            return from_after, to_after, await crud.verify_balances(session)
+
+    from_after, to_after, mismatches = run(scenario())
+    assert from_after == to_after == 1000
+    assert list(mismatches) == []
+
+def test_transfer_in_another_currency_is_rejected(ledger, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        alice, bob = await open_account(1000, "USD"), await open_account(0, "USD")
+        session = await ledger.get_session()
+        with pytest.raises(crud.InvalidTransfer):
+            async with session.begin():
+                await crud.apply_transfer(session, alice, bob, 100, "INR")
+        async with session.begin():
+            response, _ = await crud.apply_transfer(session, alice, bob, 100, "USD")
+            stored = (await session.execute(
+                select(ledger.transfers.c.currency).where(ledger.transfers.c.tx_id == response["tx_id"])
+            )).scalars().all()
+        return response, stored
+
+    response, stored = run(scenario())
+    assert response["currency"] == "USD"
+    assert stored == ["USD"]
+
+def test_concurrent_overdrafts_never_go_negative(ledger, open_account, run):
+    from ledger import crud
+
+    async def transfer(src, dst):
+        session = await ledger.get_session()
+        try:
+            async with session.begin():
+                await crud.apply_transfer(session, src, dst, 30, "INR")
+            return True
+        except ValueError:
+            return False
+        finally:
+            await session.close()
+
+    async def scenario():
+        alice, bob = await open_account(100), await open_account(0)
+        results = await asyncio.gather(*(transfer(alice, bob) for _ in range(10)))
+        session = await ledger.get_session()
+        async with session.begin():
+            balances = await crud.get_balance(session, alice), await crud.get_balance(session, bob)
+            return results, balances, await crud.verify_balances(session)
+
+    results, balances, mismatches = run(scenario())
+    assert results.count(True) == 3
+    assert balances == (10, 90)
+    assert list(mismatches) == []
+
+def test_materialized_balances_match_the_entries(ledger, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        accts = [await open_account(500) for _ in range(4)]
+        rng = random.Random(7)
+        session = await ledger.get_session()
+        for _ in range(40):
+            src, dst = rng.sample(accts, 2)
+            try:
+                async with session.begin():
+                    await crud.apply_transfer(session, src, dst, rng.randint(1, 200), "INR")
+            except ValueError:
+                pass  # insufficient funds, rolled back
+        async with session.begin():
+            materialized = [await crud.get_balance(session, a) for a in accts]
+            mismatches = list(await crud.verify_balances(session))
+            rebuilt = await crud.rebuild_balances(session)
+            after_rebuild = [await crud.get_balance(session, a) for a in accts]
+        return materialized, mismatches, rebuilt, after_rebuild
+
+    materialized, mismatches, rebuilt, after_rebuild = run(scenario())
+    assert mismatches == []
+    assert all(b >= 0 for b in materialized)
+    assert sum(materialized) == 4 * 500
+    assert rebuilt == 4 and after_rebuild == materialized
+
+def test_demoted_hot_account_buckets_are_swept(ledger, open_account, run):
+    from ledger import balances, crud
+
+    async def scenario():
+        payer, hot = await open_account(1000), await open_account(0)
+        session = await ledger.get_session()
+        async with session.begin():
+            await crud.set_hot_buckets(session, hot, 4)
+        async with session.begin():
+            await crud.apply_transfer(session, payer, hot, 100, "INR")
+        async with session.begin():
+            await crud.set_hot_buckets(session, hot, 0)
+        # a credit that still saw the account as hot lands after the demotion
+        async with session.begin():
+            await crud.record_transfer(session, payer, hot, 50, "INR", to_buckets=4)
+        swept = await balances.consolidate()
+        async with session.begin():
+            left = (await session.execute(select(ledger.account_balance_buckets))).all()
+            return swept, left, await crud.get_balance(session, hot), list(await crud.verify_balances(session))
+
+    swept, left, balance, mismatches = run(scenario())
+    assert swept == 1
+    assert left == []
+    assert balance == 150
+    assert mismatches == []
+
+def test_rebuild_holds_off_consolidation_until_it_commits(ledger, open_account, run):
+    from ledger import crud
+
+    async def scenario():
+        payer, hot = await open_account(1000), await open_account(0)
+        session = await ledger.get_session()
+        async with session.begin():
+            await crud.set_hot_buckets(session, hot, 4)
+        for amount in (100, 200):
+            async with session.begin():
+                await crud.apply_transfer(session, payer, hot, amount, "INR")
+
+        async def consolidate():
+            other = await ledger.get_session()
+            async with other.begin():
+                return await crud.consolidate_account(other, hot)
+
+        rebuild = await ledger.get_session()
+        async with rebuild.begin():
+            await crud.rebuild_balances(rebuild)
+            folding = asyncio.create_task(consolidate())
+            await asyncio.sleep(0.3)
+            waited = not folding.done()
+        folded = await folding
+        async with session.begin():
+            return waited, folded, await crud.get_balance(session, hot), list(await crud.verify_balances(session))
+
+    waited, folded, balance, mismatches = run(scenario())
+    assert waited
+    assert folded == balance == 300
+    assert mismatches == []
+
+def test_batches_sharing_accounts_in_opposite_order_do_not_deadlock(ledger, open_account, run):
+    from ledger import crud
+    from ledger.batcher import TransferBatcher
+
+    async def scenario():
+        a, b, c, d = [await open_account(1000) for _ in range(4)]
+        # two ledger workers, each batching two transfers that the other batch takes in reverse
+        first, second = TransferBatcher(max_wait_ms=50), TransferBatcher(max_wait_ms=50)
+        try:
+            results = await asyncio.gather(
+                first.submit(a, b, 10, "INR"), first.submit(c, d, 10, "INR"),
+                second.submit(c, d, 10, "INR"), second.submit(a, b, 10, "INR"),
+                return_exceptions=True,
+            )
+        finally:
+            await first.stop()
+            await second.stop()
+        session = await ledger.get_session()
+        async with session.begin():
+            balances = [await crud.get_balance(session, x) for x in (a, b, c, d)]
+        return results, balances, first.commits + second.commits
+
+    results, balances, commits = run(scenario())
+    assert [r if isinstance(r, BaseException) else r[0]["status"] for r in results] == ["SUCCESS"] * 4
+    assert balances == [980, 1020, 980, 1020]
+    assert commits == 2
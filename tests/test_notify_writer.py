@@ -0,0 +1,47 @@
+import pytest
+
+def _failing(writer, failures: int):
+    """Make the writer's first ``failures`` disk writes raise, like a full disk."""
+    real = writer._write_blocking
+    calls = []
+
+    def write(data):
+        calls.append(data)
+        if len(calls) <= failures:
+            raise OSError(28, "No space left on device")
+        real(data)
+    writer._write_blocking = write
+    return calls
+
+def test_failed_flush_keeps_the_lines_and_retries(tmp_path, run):
+    from notifications.writer import LogWriter
+
+    path = tmp_path / "notifications.log"
+
+    async def scenario():
+        writer = LogWriter(str(path), retries=3, retry_backoff_ms=1)
+        calls = _failing(writer, 2)
+        await writer.write(["first", "second"], wait=True)
+        await writer.stop()
+        return len(calls)
+
+    assert run(scenario()) == 3
+    assert path.read_text() == "first\nsecond\n"
+
+def test_lines_are_dropped_and_counted_after_the_last_retry(tmp_path, run):
+    from notifications import writer as writer_module
+
+    dropped_before = sum(writer_module.dropped_lines_total._values.values())
+
+    async def scenario():
+        writer = writer_module.LogWriter(str(tmp_path / "notifications.log"), retries=1, retry_backoff_ms=1)
+        calls = _failing(writer, 2)
+        with pytest.raises(OSError):
+            await writer.write(["lost", "also lost"], wait=True)
+        await writer.write(["kept"], wait=True)
+        await writer.stop()
+        return len(calls)
+
+    assert run(scenario()) == 3
+    assert sum(writer_module.dropped_lines_total._values.values()) - dropped_before == 2
+    assert (tmp_path / "notifications.log").read_text() == "kept\n"
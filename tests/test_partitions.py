@@ -0,0 +1,32 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+def test_fresh_database_is_partitioned_and_takes_a_transfer(ledger, open_account, run):
+    from ledger import crud, partitions
+
+    async def scenario():
+        alice, bob = await open_account(1000), await open_account(0)
+        session = await ledger.get_session()
+        async with session.begin():
+            response, replayed = await crud.apply_transfer(session, alice, bob, 250, "INR")
+        engine = await ledger.get_engine()
+        async with engine.connect() as conn:
+            names = {
+                table: [p.name for p in await partitions._partitions(conn, table)] for table in partitions.PARTITIONED
+            }
+            legs = (await conn.execute(text("SELECT count(*) FROM account_entries"))).scalar_one()
+        return response, replayed, names, legs
+
+    response, replayed, names, legs = run(scenario())
+    this_month = partitions.month_start(datetime.now(timezone.utc))
+    for table in partitions.PARTITIONED:
+        assert partitions.partition_name(table, this_month) in names[table]
+        assert len(names[table]) == partitions.LEDGER_PARTITION_AHEAD_MONTHS + 1
+    assert response["status"] == "SUCCESS" and not replayed
+    assert (response["from_balance_after"], response["to_balance_after"]) == (750, 250)
+    assert legs == 2
+
+def test_ensure_is_idempotent(ledger, run):
+    from ledger import partitions
+    assert run(partitions.ensure()) == []
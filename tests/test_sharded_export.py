@@ -0,0 +1,73 @@
+import payment_pb2
+
+class _Call:
+    """Stands in for a server-streaming ExportEntries call on one shard."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.cancelled = False
+
+    async def _iter(self):
+        for entry in self.entries:
+            yield entry
+
+    def __aiter__(self):
+        return self._iter()
+
+    def cancel(self):
+        self.cancelled = True
+        return True
+
+class _Stub:
+    def __init__(self, call):
+        self.call = call
+
+    def ExportEntries(self, req, metadata=None):
+        return self.call
+
+def _entry(created_at: str, entry_id: int):
+    return payment_pb2.LedgerEntry(tx_id=str(entry_id), created_at=created_at, entry_id=entry_id)
+
+def _shards(monkeypatch, *shards):
+    from gateway import grpc_clients
+    from gateway.config import settings
+
+    calls = [_Call(entries) for entries in shards]
+
+    async def get_ledger_stub(shard: int = 0):
+        return _Stub(calls[shard])
+
+    monkeypatch.setattr(settings, "ledger_shard_targets", ",".join(f"shard{i}:1" for i in range(len(shards))))
+    monkeypatch.setattr(grpc_clients, "get_ledger_stub", get_ledger_stub)
+    return grpc_clients, calls
+
+def test_full_export_merges_shards_by_timestamp(monkeypatch, run):
+    # str(datetime) drops a zero fraction, so "...:05+00:00" sorts after "...:05.5+00:00" as a string
+    grpc_clients, calls = _shards(
+        monkeypatch,
+        [_entry("2026-10-17 10:00:05+00:00", 1), _entry("2026-10-17 10:00:07+00:00", 4)],
+        [_entry("2026-10-17 10:00:05.500000+00:00", 2), _entry("2026-10-17 12:00:06+02:00", 3)],
+    )
+
+    async def scenario():
+        return [e.entry_id async for e in grpc_clients.ledger_export_entries()]
+
+    assert run(scenario()) == [1, 2, 3, 4]
+    assert all(call.cancelled for call in calls)
+
+def test_abandoned_export_cancels_every_shard_stream(monkeypatch, run):
+    grpc_clients, calls = _shards(
+        monkeypatch,
+        [_entry("2026-10-17 10:00:01+00:00", 1), _entry("2026-10-17 10:00:03+00:00", 3)],
+        [_entry("2026-10-17 10:00:02+00:00", 2), _entry("2026-10-17 10:00:04+00:00", 4)],
+    )
+
+    async def scenario():
+        export = grpc_clients.ledger_export_entries()
+        first = await anext(export)
+        # the HTTP client went away after the first line
+        await export.aclose()
+        return first.entry_id
+
+    assert run(scenario()) == 1
+    assert all(call.cancelled for call in calls)
@@ -0,0 +1,13 @@
+import pytest
+
+from ledger import supervisor
+
+@pytest.mark.parametrize("workers", [0, supervisor.LEDGER_MAX_WORKERS + 1])
+def test_worker_count_outside_the_published_ports_is_refused(workers):
+    # refused before touching the database
+    with pytest.raises(SystemExit, match="LEDGER_MAX_WORKERS"):
+        supervisor.main(workers)
+
+def test_pool_share_splits_the_budget():
+    assert supervisor.pool_share(20, 4) == (5, 0)
+    assert supervisor.pool_share(3, 4) == (1, 0)